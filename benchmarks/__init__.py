@@ -0,0 +1,10 @@
+'''
+This package contains the benchmark suite of the library. It measures the
+throughput, the latency percentiles and the peak memory of the main
+operations (Stock creation and lookup, valuation, allocation, deviation,
+rebalance, invest_money, the parallel deviations, the PortfolioBook and the
+SparseBook) over synthetic universes and
+books, and compares the results against stored baselines.
+
+Run it with python -m benchmarks --help.
+'''
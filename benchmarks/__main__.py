@@ -0,0 +1,96 @@
+'''
+This is the command line of the benchmark suite.
+
+    python -m benchmarks --scale smoke
+    python -m benchmarks --save main
+    python -m benchmarks --compare main
+
+--save stores the results as a baseline in benchmarks/baselines/<name>.json
+(a path ending in .json is used as is), with an optional --note describing
+the machine, and --compare prints the comparison against a baseline and exits
+with status 1 if any case regressed. Comparing against a baseline that does
+not exist fails before running anything.
+
+benchmarks/baselines/main.json is the reference baseline of the default
+scale. Timings are only comparable on the machine described in its note, so
+record a local baseline with --save before comparing on another machine.
+'''
+
+from benchmarks.suite import SCALES, run_suite, compare, format_report
+import argparse
+import json
+import os
+import sys
+
+
+BASELINES_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+
+
+def get_baseline_path(name: str) -> str:
+    if name.endswith('.json'):
+        return name
+    return os.path.join(BASELINES_DIR, f'{name}.json')
+
+
+def print_result(name: str, result: dict) -> None:
+    print(f"{name:<60} {result['throughput']:>14,.0f} items/s  "
+          f"p50 {result['p50_us']:>10.1f} us  "
+          f"p95 {result['p95_us']:>10.1f} us  "
+          f"p99 {result['p99_us']:>10.1f} us  "
+          f"peak {result['peak_memory'] / 2**20:>9.1f} MiB", flush=True)
+
+
+def main(args: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmarks of valuation, deviation and rebalance.')
+    parser.add_argument('--scale', choices=list(SCALES), default='default')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='run only the cases containing it')
+    parser.add_argument('--save', metavar='BASELINE',
+                        help='store the results as a baseline')
+    parser.add_argument('--note',
+                        help='description of the machine, stored with --save')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare the results against a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='allowed change before a regression (0.1=10%%)')
+    options = parser.parse_args(args)
+
+    baseline = None
+    if options.compare is not None:
+        # Read the baseline first, so a missing file fails before running
+        path = get_baseline_path(options.compare)
+        if not os.path.exists(path):
+            parser.error(f'baseline {path} does not exist, record it first '
+                         f'with --save {options.compare}')
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline['meta']['scale'] != options.scale:
+            print(f"Warning: the baseline was recorded with --scale "
+                  f"{baseline['meta']['scale']}", file=sys.stderr)
+
+    current = run_suite(options.scale, options.seed, options.repeat,
+                        options.only, report=print_result)
+    if options.note is not None:
+        current['meta']['note'] = options.note
+
+    if options.save is not None:
+        path = get_baseline_path(options.save)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f'Baseline stored in {path}')
+
+    if baseline is None:
+        return 0
+
+    rows = compare(baseline, current, options.tolerance)
+    print()
+    print(format_report(rows))
+    return 1 if any(row['regressions'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+'''
+This module generates the synthetic universes and portfolios used by the
+benchmarks. They are modeled on the files of data/: the prices are spread
+around 100 like data/stocks.yaml, and each allocation holds between 8 and 20
+stocks with a few large weights and a long tail of small ones, like the
+allocations of data/allocations.
+
+Every generator takes a seed, so the same arguments always give the same
+universe and portfolios.
+'''
+
+from src.portfolio import Portfolio
+from src.sparse import CSRMatrix, SparseBook
+from src.stocks import Stock, StockRegistry
+import numpy as np
+
+
+def make_prices(n_symbols: int, seed: int = 0) -> np.ndarray:
+    '''
+    This function returns n_symbols prices with a log-normal distribution
+    around 100, rounded to cents.
+    '''
+    rng = np.random.default_rng(seed)
+    prices = np.round(rng.lognormal(np.log(100), 0.8, n_symbols), 2)
+    return np.maximum(prices, 0.01)
+
+
+def make_universe(n_symbols: int, seed: int = 0,
+                  registry: StockRegistry = None,
+                  prefix: str = 'SYM') -> list[Stock]:
+    '''
+    This function creates (or updates the prices of) n_symbols stocks named
+    prefix0, prefix1, ... in the registry.
+    '''
+    prices = make_prices(n_symbols, seed).tolist()
+    return [Stock(f'{prefix}{i}', price, registry=registry)
+            for i, price in enumerate(prices)]
+
+
+def make_allocation(stocks: list[Stock], rng: np.random.Generator,
+                    min_holdings: int = 8,
+                    max_holdings: int = 20) -> dict[str: float]:
+    '''
+    This function returns a random allocation of some of the stocks, with the
+    stock symbol as the key. The weights follow a Dirichlet distribution
+    with a small concentration, so a few stocks get most of the weight.
+    '''
+    max_holdings = min(max_holdings, len(stocks))
+    min_holdings = min(min_holdings, max_holdings)
+    holdings = int(rng.integers(min_holdings, max_holdings + 1))
+
+    chosen = rng.choice(len(stocks), size=holdings, replace=False)
+    weights = rng.dirichlet(np.full(holdings, 0.8))
+    # Very small weights are not valid allocations
+    weights = np.maximum(weights, 1e-6)
+    weights = weights / weights.sum()
+
+    return {stocks[i].symbol: float(weight)
+            for i, weight in zip(chosen.tolist(), weights.tolist())}
+
+
+def make_portfolios(stocks: list[Stock], n_portfolios: int, seed: int = 0,
+                    registry: StockRegistry = None,
+                    indexed: bool = False) -> list[Portfolio]:
+    '''
+    This function creates n_portfolios portfolios over the stocks. Each one
+    gets a random allocation and a value between 1,000 and 1,000,000.
+    '''
+    rng = np.random.default_rng(seed)
+    values = np.exp(rng.uniform(np.log(1e3), np.log(1e6), n_portfolios))
+    return [Portfolio(name=f'P{i}',
+                      stocks_allocation=make_allocation(stocks, rng),
+                      total_value=float(value),
+                      indexed=indexed,
+                      registry=registry)
+            for i, value in enumerate(values.tolist())]
+
+
+def make_book_arrays(stocks: list[Stock], n_portfolios: int,
+                     seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    This function returns the (portfolios x stocks) quantities and weights of
+    a book of n_portfolios portfolios over stocks of the default registry,
+    drifted from their targets. It does not create Portfolio objects, so it
+    can generate millions of portfolios.
+    '''
+    rng = np.random.default_rng(seed)
+    columns = len(Stock._book)
+    indexes = np.array([stock.index for stock in stocks])
+    prices = Stock._book.prices
+
+    weights = np.zeros((n_portfolios, columns))
+    weights[:, indexes] = rng.dirichlet(np.full(len(stocks), 0.8),
+                                        size=n_portfolios)
+    values = np.exp(rng.uniform(np.log(1e3), np.log(1e6), n_portfolios))
+    drift = rng.lognormal(0, 0.1, size=weights.shape)
+    qty = weights * drift * values[:, np.newaxis] / prices
+    return qty, weights
+
+
+def make_sparse_book(stocks: list[Stock], n_portfolios: int, seed: int = 0,
+                     registry: StockRegistry = None,
+                     min_holdings: int = 8,
+                     max_holdings: int = 40) -> SparseBook:
+    '''
+    This function returns a SparseBook of n_portfolios portfolios, each one
+    with between min_holdings and max_holdings stocks chosen at random from
+    a large universe, drifted from their targets. Like make_book_arrays it
+    does not create Portfolio objects.
+    '''
+    rng = np.random.default_rng(seed)
+    sizes = rng.integers(min_holdings, max_holdings + 1, n_portfolios)
+    rows = np.repeat(np.arange(n_portfolios), sizes)
+    columns = np.array([stock.index for stock in stocks])[
+        rng.integers(0, len(stocks), len(rows))]
+    # Repeated stocks of a portfolio are merged by from_coo
+    targets = CSRMatrix.from_coo(rows, columns,
+                                 rng.gamma(0.8, size=len(rows)),
+                                 n_portfolios)
+    targets.data /= targets.sum_rows(targets.data)[targets.get_row_ids()]
+
+    if registry is None:
+        registry = Stock.default_registry
+    values = np.exp(rng.uniform(np.log(1e3), np.log(1e6), n_portfolios))
+    prices = registry._gather(targets.indices)
+    drift = rng.lognormal(0, 0.1, targets.nnz)
+    holdings = CSRMatrix(targets.indptr, targets.indices,
+                         targets.data * drift *
+                         values[targets.get_row_ids()] / prices)
+    return SparseBook._from_arrays([f'P{i}' for i in range(n_portfolios)],
+                                   holdings, targets, registry)
@@ -0,0 +1,80 @@
+'''
+This module measures the memory kept by the stocks and the portfolios: the
+bytes retained per stock of a universe, and per portfolio and per position
+(a stock held by a portfolio) of a book of portfolios, after computing their
+deviation once so the cached deviation is included.
+
+    python -m benchmarks.memory --symbols 1000 --portfolios 10000
+
+It only uses the public API, so the same command can be run on an older
+checkout to compare the numbers before and after a change.
+'''
+
+from benchmarks.generators import make_universe, make_portfolios
+from src.stocks import StockRegistry
+import argparse
+import gc
+import tracemalloc
+
+
+def _retained(function):
+    '''
+    This function calls function() and returns its result and the bytes it
+    allocated that are still alive after it returns.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        result = function()
+        gc.collect()
+        after, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def measure_memory(symbols: int, portfolios: int,
+                   seed: int = 0) -> dict[str: float]:
+    '''
+    This function returns the bytes retained per stock, per portfolio and per
+    position.
+    '''
+    registry = StockRegistry()
+    stocks, universe_bytes = _retained(
+        lambda: make_universe(symbols, seed, registry))
+
+    def build():
+        book = make_portfolios(stocks, portfolios, seed, registry)
+        for portfolio in book:
+            portfolio.get_stocks_qty_deviation()
+        return book
+
+    book, book_bytes = _retained(build)
+    positions = sum(len(portfolio.stocks_collection.stocks)
+                    for portfolio in book)
+    return {
+        'bytes_per_stock': universe_bytes / symbols,
+        'bytes_per_portfolio': book_bytes / portfolios,
+        'bytes_per_position': book_bytes / positions,
+        'positions_per_portfolio': positions / portfolios,
+    }
+
+
+def main(args: list[str] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.memory',
+        description='Memory retained per stock, portfolio and position.')
+    parser.add_argument('--symbols', type=int, default=1000)
+    parser.add_argument('--portfolios', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args(args)
+
+    result = measure_memory(options.symbols, options.portfolios,
+                            options.seed)
+    for name, value in result.items():
+        print(f'{name:<25} {value:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
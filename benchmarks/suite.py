@@ -0,0 +1,550 @@
+'''
+This module contains the benchmark cases, the harness that measures them and
+the comparison against a baseline.
+
+Each case builds a Workload: an operation called count times per repeat, and
+optionally a function called before each repeat (untimed) to change the
+prices, so the cached values must be recomputed in every repeat. The harness
+measures:
+    - peak_memory: peak of the memory traced by tracemalloc while building
+      the workload and running one warm-up pass of the operation.
+    - throughput: items processed per second (an item is a call of the
+      operation, or a portfolio for the book cases).
+    - p50_us, p95_us and p99_us: latency percentiles of one call, in
+      microseconds.
+The timed passes run without tracemalloc, which slows the code down.
+'''
+
+from benchmarks.generators import make_universe, make_portfolios
+from benchmarks.generators import make_book_arrays, make_sparse_book
+from src.book import PortfolioBook
+from src.parallel import get_deviations_in_parallel, rebalance_in_parallel
+from src.parallel import rebalance_book_in_parallel
+from src.stocks import Stock, StockRegistry
+import numpy as np
+import os
+import platform
+import time
+import tracemalloc
+
+
+# Sizes of each scale: the universes of the Stock cases, the (symbols,
+# portfolios) grid of the portfolio cases and the books of the book cases
+SCALES = {
+    'smoke': {
+        'universes': [10, 1000],
+        'portfolio_grid': [(10, 1), (1000, 100)],
+        'books': [1000],
+        'book_symbols': 20,
+        'sparse_books': [(10_000, 1000)],
+        'parallel_books': [(100, 1000)],
+        'workers': [1, 2],
+    },
+    'default': {
+        'universes': [10, 10_000, 100_000],
+        'portfolio_grid': [(10, 1), (1000, 1000), (10_000, 1000)],
+        'books': [10_000, 100_000],
+        'book_symbols': 20,
+        'sparse_books': [(50_000, 100_000)],
+        'parallel_books': [(1000, 20_000)],
+        'workers': [1, 2, 4],
+    },
+    'full': {
+        'universes': [10, 10_000, 100_000],
+        'portfolio_grid': [(10, 1), (1000, 10_000), (100_000, 10_000)],
+        'books': [100_000, 1_000_000],
+        'book_symbols': 20,
+        'sparse_books': [(50_000, 100_000), (50_000, 1_000_000)],
+        'parallel_books': [(1000, 100_000)],
+        'workers': [1, 2, 4, 8],
+    },
+}
+
+
+class Workload:
+    '''
+    This class holds what a case measures: operation(i) is called for i in
+    range(count) in every repeat, and before_repeat() is called (untimed)
+    before each repeat. Each call processes items_per_op items.
+    Cheap workloads are repeated until they have min_samples latencies, so
+    their percentiles are stable.
+    '''
+    def __init__(self, operation, count: int, before_repeat=None,
+                 items_per_op: int = 1, min_samples: int = 100):
+        self.operation = operation
+        self.count = count
+        self.before_repeat = before_repeat
+        self.items_per_op = items_per_op
+        self.min_samples = min_samples
+
+
+def _price_shock(registry: StockRegistry, stocks: list[Stock], seed: int):
+    '''
+    This function returns a function that moves every price of the stocks a
+    little, so the values and targets cached by the portfolios are outdated.
+    '''
+    rng = np.random.default_rng(seed)
+    indexes = np.array([stock.index for stock in stocks])
+
+    def shock():
+        prices = registry._book.prices[indexes]
+        registry.update_prices(
+            (indexes, prices * rng.lognormal(0, 0.01, len(indexes))))
+
+    return shock
+
+
+def stock_lookup(symbols: int, seed: int) -> Workload:
+    '''
+    Stock(symbol) of a stock that already exists.
+    '''
+    registry = StockRegistry()
+    stocks = make_universe(symbols, seed, registry)
+    rng = np.random.default_rng(seed)
+    names = [stocks[i].symbol
+             for i in rng.integers(0, symbols, min(symbols, 10_000))]
+    return Workload(lambda i: Stock(names[i], registry=registry), len(names))
+
+
+def stock_create(symbols: int, seed: int) -> Workload:
+    '''
+    Stock(symbol, price) of new stocks, in a fresh registry every repeat.
+    '''
+    state = {}
+    prices = np.round(np.random.default_rng(seed).uniform(1, 500, symbols),
+                      2).tolist()
+    names = [f'NEW{i}' for i in range(symbols)]
+
+    def before_repeat():
+        state['registry'] = StockRegistry()
+
+    before_repeat()
+    return Workload(
+        lambda i: Stock(names[i], prices[i], registry=state['registry']),
+        symbols, before_repeat=before_repeat)
+
+
+def _portfolio_case(method):
+    '''
+    This function returns a case that calls method(portfolio) for every
+    portfolio, after a price change in each repeat.
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        registry = StockRegistry()
+        stocks = make_universe(symbols, seed, registry)
+        book = make_portfolios(stocks, portfolios, seed, registry)
+        return Workload(lambda i: method(book[i]), portfolios,
+                        before_repeat=_price_shock(registry, stocks, seed))
+
+    case.__doc__ = method.__doc__
+    return case
+
+
+def _get_value(portfolio):
+    '''
+    StockCollection.get_value of the holdings of a portfolio.
+    '''
+    return portfolio.stocks_collection.get_value()
+
+
+def _get_allocation(portfolio):
+    '''
+    StockCollection.get_allocation of the holdings of a portfolio.
+    '''
+    return portfolio.stocks_collection.get_allocation()
+
+
+def _get_deviation(portfolio):
+    '''
+    Portfolio.get_stocks_qty_deviation.
+    '''
+    return portfolio.get_stocks_qty_deviation()
+
+
+def _rebalance(portfolio):
+    '''
+    Portfolio.rebalance.
+    '''
+    portfolio.rebalance()
+
+
+def _invest_money(portfolio):
+    '''
+    Portfolio.invest_money, keeping the current allocation.
+    '''
+    portfolio.invest_money(100)
+
+
+def _book_case(method):
+    '''
+    This function returns a case that calls method(book) once per repeat,
+    over a book of many portfolios. The book lives in the default registry,
+    as PortfolioBook does.
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        stocks = make_universe(symbols, seed, prefix='BOOK')
+        qty, weights = make_book_arrays(stocks, portfolios, seed)
+        book = PortfolioBook._from_arrays(
+            [f'P{i}' for i in range(portfolios)], qty, weights)
+        return Workload(lambda i: method(book), 1,
+                        before_repeat=_price_shock(
+                            Stock.default_registry, stocks, seed),
+                        items_per_op=portfolios, min_samples=1)
+
+    case.__doc__ = method.__doc__
+    return case
+
+
+def _book_values(book):
+    '''
+    PortfolioBook.get_values.
+    '''
+    return book.get_values()
+
+
+def _book_trades(book):
+    '''
+    PortfolioBook.get_trades.
+    '''
+    return book.get_trades()
+
+
+def _book_rebalance(book):
+    '''
+    PortfolioBook.rebalance.
+    '''
+    book.rebalance()
+
+
+def _sparse_case(method):
+    '''
+    This function returns a case that calls method(book) once per repeat,
+    over a SparseBook of many portfolios in a large universe.
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        registry = StockRegistry()
+        stocks = make_universe(symbols, seed, registry)
+        book = make_sparse_book(stocks, portfolios, seed, registry)
+        return Workload(lambda i: method(book), 1,
+                        before_repeat=_price_shock(registry, stocks, seed),
+                        items_per_op=portfolios, min_samples=1)
+
+    case.__doc__ = method.__doc__
+    return case
+
+
+def _sparse_values(book):
+    '''
+    SparseBook.get_values.
+    '''
+    return book.get_values()
+
+
+def _sparse_trades(book):
+    '''
+    SparseBook.get_trades.
+    '''
+    return book.get_trades()
+
+
+def _sparse_exposures(book):
+    '''
+    SparseBook.get_exposures.
+    '''
+    return book.get_exposures()
+
+
+def _deviations_case(workers: int = None):
+    '''
+    This function returns a case that computes the deviations of a list of
+    portfolios once per repeat, after a price change: with
+    get_deviations_in_parallel and the given number of workers, or with a
+    loop of Portfolio.get_stocks_qty_deviation when workers is None.
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        registry = StockRegistry()
+        stocks = make_universe(symbols, seed, registry)
+        book = make_portfolios(stocks, portfolios, seed, registry)
+        if workers is None:
+            def operation(i):
+                return [portfolio.get_stocks_qty_deviation()
+                        for portfolio in book]
+        else:
+            def operation(i):
+                return get_deviations_in_parallel(book, workers,
+                                                  registry=registry)
+
+        return Workload(operation, 1,
+                        before_repeat=_price_shock(registry, stocks, seed),
+                        items_per_op=portfolios, min_samples=1)
+
+    return case
+
+
+def _rebalance_case(workers: int = None):
+    '''
+    This function returns a case that rebalances a list of portfolios once
+    per repeat, after a price change: with rebalance_in_parallel and the
+    given number of workers, or with a loop of Portfolio.rebalance when
+    workers is None.
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        registry = StockRegistry()
+        stocks = make_universe(symbols, seed, registry)
+        book = make_portfolios(stocks, portfolios, seed, registry)
+        if workers is None:
+            def operation(i):
+                for portfolio in book:
+                    portfolio.rebalance()
+        else:
+            def operation(i):
+                return rebalance_in_parallel(book, workers,
+                                             registry=registry)
+
+        return Workload(operation, 1,
+                        before_repeat=_price_shock(registry, stocks, seed),
+                        items_per_op=portfolios, min_samples=1)
+
+    return case
+
+
+def _sparse_rebalance_case(workers: int = None):
+    '''
+    This function returns a case that rebalances a SparseBook once per
+    repeat, after a price change: with rebalance_book_in_parallel and the
+    given number of workers, or with SparseBook.get_qty_deviation and
+    SparseBook.rebalance when workers is None (rebalance_book_in_parallel
+    returns the trades too).
+    '''
+    def case(symbols: int, portfolios: int, seed: int) -> Workload:
+        registry = StockRegistry()
+        stocks = make_universe(symbols, seed, registry)
+        book = make_sparse_book(stocks, portfolios, seed, registry)
+        if workers is None:
+            def operation(i):
+                trades = book.get_qty_deviation()
+                book.rebalance()
+                return trades
+        else:
+            def operation(i):
+                return rebalance_book_in_parallel(book, workers)
+
+        return Workload(operation, 1,
+                        before_repeat=_price_shock(registry, stocks, seed),
+                        items_per_op=portfolios, min_samples=1)
+
+    return case
+
+
+STOCK_CASES = {
+    'stock_lookup': stock_lookup,
+    'stock_create': stock_create,
+}
+
+PORTFOLIO_CASES = {
+    'get_value': _portfolio_case(_get_value),
+    'get_allocation': _portfolio_case(_get_allocation),
+    'get_stocks_qty_deviation': _portfolio_case(_get_deviation),
+    'rebalance': _portfolio_case(_rebalance),
+    'invest_money': _portfolio_case(_invest_money),
+}
+
+BOOK_CASES = {
+    'book_get_values': _book_case(_book_values),
+    'book_get_trades': _book_case(_book_trades),
+    'book_rebalance': _book_case(_book_rebalance),
+}
+
+SPARSE_CASES = {
+    'sparse_get_values': _sparse_case(_sparse_values),
+    'sparse_get_trades': _sparse_case(_sparse_trades),
+    'sparse_get_exposures': _sparse_case(_sparse_exposures),
+}
+
+
+def get_cases(scale: str) -> list[tuple[str, callable]]:
+    '''
+    This function returns the (name, build) pairs of every case of a scale.
+    build(seed) returns the Workload of the case.
+    '''
+    if scale not in SCALES:
+        raise ValueError(f"Scale {scale} not found.")
+    sizes = SCALES[scale]
+
+    cases = []
+    for name, case in STOCK_CASES.items():
+        for symbols in sizes['universes']:
+            cases.append((f'{name}[symbols={symbols}]',
+                          _bind(case, symbols)))
+
+    for name, case in PORTFOLIO_CASES.items():
+        for symbols, portfolios in sizes['portfolio_grid']:
+            cases.append((f'{name}[symbols={symbols},portfolios={portfolios}]',
+                          _bind(case, symbols, portfolios)))
+
+    for name, case in BOOK_CASES.items():
+        for portfolios in sizes['books']:
+            symbols = sizes['book_symbols']
+            cases.append((f'{name}[symbols={symbols},portfolios={portfolios}]',
+                          _bind(case, symbols, portfolios)))
+
+    for symbols, portfolios in sizes['parallel_books']:
+        size = f'symbols={symbols},portfolios={portfolios}'
+        cases.append((f'serial_deviations[{size}]',
+                      _bind(_deviations_case(), symbols, portfolios)))
+        for workers in sizes['workers']:
+            cases.append((f'parallel_deviations[{size},workers={workers}]',
+                          _bind(_deviations_case(workers), symbols,
+                                portfolios)))
+        cases.append((f'serial_rebalance[{size}]',
+                      _bind(_rebalance_case(), symbols, portfolios)))
+        for workers in sizes['workers']:
+            cases.append((f'parallel_rebalance[{size},workers={workers}]',
+                          _bind(_rebalance_case(workers), symbols,
+                                portfolios)))
+
+    for name, case in SPARSE_CASES.items():
+        for symbols, portfolios in sizes['sparse_books']:
+            cases.append((f'{name}[symbols={symbols},portfolios={portfolios}]',
+                          _bind(case, symbols, portfolios)))
+
+    for symbols, portfolios in sizes['sparse_books']:
+        size = f'symbols={symbols},portfolios={portfolios}'
+        cases.append((f'sparse_rebalance[{size}]',
+                      _bind(_sparse_rebalance_case(), symbols, portfolios)))
+        for workers in sizes['workers']:
+            cases.append((f'parallel_sparse_rebalance[{size},'
+                          f'workers={workers}]',
+                          _bind(_sparse_rebalance_case(workers), symbols,
+                                portfolios)))
+
+    return cases
+
+
+def _bind(case, *sizes):
+    return lambda seed: case(*sizes, seed)
+
+
+def measure(build, seed: int = 0, repeat: int = 5) -> dict[str: float]:
+    '''
+    This function builds a workload and measures it. See the module
+    docstring for the meaning of each result.
+    '''
+    tracemalloc.start()
+    try:
+        workload = build(seed)
+        if workload.before_repeat is not None:
+            workload.before_repeat()
+        for i in range(workload.count):
+            workload.operation(i)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    repeat = max(repeat, -(-workload.min_samples // workload.count))
+    operation = workload.operation
+    timer = time.perf_counter_ns
+    latencies = np.zeros(repeat * workload.count)
+    position = 0
+    for _ in range(repeat):
+        if workload.before_repeat is not None:
+            workload.before_repeat()
+        for i in range(workload.count):
+            start = timer()
+            operation(i)
+            latencies[position] = timer() - start
+            position += 1
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) / 1e3
+    items = len(latencies) * workload.items_per_op
+    return {
+        'throughput': float(items / (latencies.sum() / 1e9)),
+        'p50_us': float(p50),
+        'p95_us': float(p95),
+        'p99_us': float(p99),
+        'peak_memory': int(peak_memory),
+    }
+
+
+def run_suite(scale: str = 'default', seed: int = 0, repeat: int = 5,
+              only: str = None, report=None) -> dict:
+    '''
+    This function runs every case of a scale (only the cases whose name
+    contains only, if it is given) and returns the results with the details
+    of the environment. report(name, result) is called after each case.
+    '''
+    results = {}
+    for name, build in get_cases(scale):
+        if only is not None and only not in name:
+            continue
+
+        results[name] = measure(build, seed, repeat)
+        if report is not None:
+            report(name, results[name])
+
+    return {
+        'meta': {
+            'scale': scale,
+            'seed': seed,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': os.cpu_count(),
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.1,
+            memory_floor: int = 2**16) -> list[dict]:
+    '''
+    This function compares the results of two runs. A case regresses when
+    its throughput drops, or its p50 latency or its peak memory grows, more
+    than tolerance (a fraction) with respect to the baseline. Memory changes
+    smaller than memory_floor bytes are ignored. It returns one row per case
+    in both runs.
+    '''
+    rows = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+
+        ratios = {
+            'throughput': result['throughput'] / base['throughput'],
+            'p50_us': result['p50_us'] / max(base['p50_us'], 1e-9),
+            'peak_memory': result['peak_memory'] /
+            max(base['peak_memory'], 1),
+        }
+        regressions = []
+        if ratios['throughput'] < 1 - tolerance:
+            regressions.append('throughput')
+        if ratios['p50_us'] > 1 + tolerance:
+            regressions.append('p50_us')
+        if ratios['peak_memory'] > 1 + tolerance and \
+                result['peak_memory'] - base['peak_memory'] > memory_floor:
+            regressions.append('peak_memory')
+        rows.append({'case': name, 'ratios': ratios,
+                     'regressions': regressions})
+
+    return rows
+
+
+def format_report(rows: list[dict]) -> str:
+    '''
+    This function returns the comparison rows as a text table.
+    '''
+    lines = [f"{'case':<60} {'throughput':>10} {'p50':>8} {'memory':>8}  "
+             'status']
+    for row in rows:
+        ratios = row['ratios']
+        status = ('REGRESSION: ' + ', '.join(row['regressions'])
+                  if row['regressions'] else 'ok')
+        lines.append(f"{row['case']:<60} {ratios['throughput']:>9.2f}x "
+                     f"{ratios['p50_us']:>7.2f}x "
+                     f"{ratios['peak_memory']:>7.2f}x  {status}")
+    return '\n'.join(lines)
@@ -2,50 +2,36 @@
 Simple demo of a portfolio manager.
 '''
 
+from src.catalog import AllocationCatalog
 from src.portfolio import Portfolio
 from src.stocks import Stock
-import os
-import yaml
 
 ALLOCATION_PATH = 'data/allocations'
 STOCKS_FILE = 'data/stocks.yaml'
 
 
-def create_stocks(stocks_file):
+def create_stocks(catalog: AllocationCatalog):
     '''
     This function instantiate the stocks in the stocks.yaml file.
     '''
-    with open(stocks_file, 'r') as f:
-        stocks = yaml.safe_load(f)
-        for symbol, price in stocks.items():
-            Stock(symbol=symbol, price=price)
+    for symbol, price in catalog.get_prices().items():
+        Stock(symbol=symbol, price=price)
 
 
-def print_allocations_list(allocations_list: list[str],
-                           allocations_path) -> None:
+def print_allocations_list(allocations_names: list[str]) -> None:
     print('Available allocations:')
-    for indx, file in enumerate(allocations_list):
-        if file.endswith('.yaml'):
-            with open(os.path.join(allocations_path, file), 'r') as f:
-                data = yaml.safe_load(f)
-                print(f'    - {data['name']}: {indx}')
+    for indx, name in enumerate(allocations_names):
+        print(f'    - {name}: {indx}')
 
 
-def get_allocations_list(allocations_path: str) -> list[str]:
-    '''
-    This function returns a list of all the allocation files in the
-    allocations_path directory.
-    '''
-    allocations_list = os.listdir(allocations_path)
-    return allocations_list
-
-
-def select_allocation(allocation_path):
+def select_allocation(catalog: AllocationCatalog):
     print('Please choose an allocation from the list below:')
     print('--------------------------------------------------')
 
-    allocations = get_allocations_list(allocation_path)
-    print_allocations_list(allocations, allocation_path)
+    allocations = catalog.get_allocation_files()
+    allocations_names = catalog.get_names()
+    catalog.save()
+    print_allocations_list(allocations_names)
 
     allocation_number = input('Enter the number of the allocation file: ')
     while True:
@@ -55,31 +41,27 @@ def select_allocation(allocation_path):
                 break
             else:
                 print('Invalid number. Please try again.')
-                print_allocations_list(allocations, allocation_path)
+                print_allocations_list(allocations_names)
                 allocation_number = input(
                     'Enter the number of the allocation file: ')
         else:
             print('Invalid input. Please enter a number.')
-            print_allocations_list(allocations, allocation_path)
+            print_allocations_list(allocations_names)
             allocation_number = input(
                 'Enter the number of the allocation file: ')
 
-    allocation_file = allocations[allocation_number]
-    allocation_file_path = os.path.join(allocation_path, allocation_file)
-
-    with open(allocation_file_path, 'r') as f:
-        data = yaml.safe_load(f)
-
-    return data
+    return catalog.get_allocation(allocations[allocation_number])
 
 
 def main():
 
-    create_stocks(STOCKS_FILE)
+    catalog = AllocationCatalog(ALLOCATION_PATH, STOCKS_FILE)
+    create_stocks(catalog)
+    catalog.save()
     print('Welcome to the Portfolio Manager!')
     print('Let\'s create a new portfolio.')
 
-    allocation_data = select_allocation(ALLOCATION_PATH)
+    allocation_data = select_allocation(catalog)
     name = allocation_data['name']
     stocks_allocation = allocation_data['allocation']
 
@@ -110,7 +92,7 @@ def main():
     print('--------------------------------------------------')
     print('Want to change your risk profile?')
     print('Let\'s change the allocation of the portfolio:')
-    allocation_data = select_allocation(ALLOCATION_PATH)
+    allocation_data = select_allocation(catalog)
 
     stocks_allocation = allocation_data['allocation']
     portfolio.set_allocation_target(stocks_allocation)
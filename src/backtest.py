@@ -0,0 +1,187 @@
+'''
+This module contains a backtesting engine for rebalancing policies. It
+simulates how one or more portfolios would have evolved over a history of
+prices, without creating Stock or Portfolio objects for each day.
+
+The prices are given as a (dates x symbols) matrix and the state of all the
+simulated portfolios is a (portfolios x symbols) matrix of quantities, so each
+day is processed with a few numpy operations for every portfolio at once. The
+days are processed in order, because the drift of a portfolio depends on the
+rebalances done before.
+
+The semantics are the same as the Portfolio class:
+    - On the first day each portfolio buys its allocation target with the
+      initial value.
+    - Cash flows are applied as invest_money (positive) and retire_money
+      (negative): the quantities are scaled to keep the current allocation.
+    - A rebalance sets the quantities to the target quantities, as rebalance
+      does.
+'''
+
+from src.stocks import check_valid_prices
+from src.utils import get_valid_symbol, check_valid_allocation
+import numpy as np
+
+
+class BacktestResult:
+    '''
+    This class holds the result of a backtest:
+        - values: (dates x portfolios) value of each portfolio each day, after
+          the cash flows and the rebalance of the day.
+        - turnover: (dates x portfolios) value traded by the rebalance of
+          the day divided by the value of the portfolio.
+        - rebalanced: (dates x portfolios) True when the portfolio was
+          rebalanced that day.
+        - trades: the trade log as four arrays (date, portfolio, symbol,
+          quantity), the symbol is the column in the prices matrix. It has
+          every trade, in the order they are made: the purchase of the
+          initial allocation on the first day, the trades of the cash flows
+          and the trades of the rebalances. Adding the quantities of a
+          portfolio up to a date gives its holdings on that date.
+    '''
+    def __init__(self, symbols, values, turnover, rebalanced, trades):
+        self.symbols = symbols
+        self.values = values
+        self.turnover = turnover
+        self.rebalanced = rebalanced
+        self.trades = trades
+
+    def get_trades(self, portfolio: int) -> list[tuple[int, str, float]]:
+        '''
+        This method returns the trades of one portfolio as a list of tuples
+        (date, symbol, quantity).
+        '''
+        dates, portfolios, columns, quantities = self.trades
+        mask = portfolios == portfolio
+        return [(date, self.symbols[column], qty) for date, column, qty
+                in zip(dates[mask].tolist(), columns[mask].tolist(),
+                       quantities[mask].tolist())]
+
+
+def _log_trades(trade_log: list, date: int, portfolios: np.ndarray,
+                trades: np.ndarray) -> None:
+    '''
+    This function appends the trades of the day to the trade log. trades is
+    a (portfolios x symbols) matrix with one row for each of the portfolios.
+    '''
+    rows, columns = np.nonzero(trades)
+    trade_log.append((np.full(len(rows), date),
+                      portfolios[rows],
+                      columns,
+                      trades[rows, columns]))
+
+
+def _get_weights(allocation_targets: list[dict[str: float]],
+                 symbols: list[str]) -> np.ndarray:
+    '''
+    This function converts the allocation targets into a (portfolios x
+    symbols) matrix of weights.
+    '''
+    columns = {symbol: column for column, symbol in enumerate(symbols)}
+    weights = np.zeros((len(allocation_targets), len(symbols)))
+
+    for row, allocation in enumerate(allocation_targets):
+        check_valid_allocation(allocation)
+        for symbol, weight in allocation.items():
+            symbol = get_valid_symbol(symbol)
+            if symbol not in columns:
+                raise ValueError(f"Stock {symbol} not found in the prices.")
+            weights[row, columns[symbol]] = weight
+
+    return weights
+
+
+def run_backtest(prices: np.ndarray,
+                 symbols: list[str],
+                 allocation_targets: list[dict[str: float]],
+                 initial_value: float,
+                 rebalance_every: int = None,
+                 drift_threshold: float = None,
+                 cash_flows: np.ndarray = None) -> BacktestResult:
+    '''
+    This function simulates each allocation target over the prices matrix.
+
+    The portfolios are rebalanced every rebalance_every days (calendar
+    policy) and/or every day their allocation drift, the maximum absolute
+    difference between the current and the target allocation, is greater
+    than drift_threshold (drift policy). cash_flows is an optional array with
+    the money invested (positive) or retired (negative) each day, for all the
+    portfolios (dates) or for each one (dates x portfolios). The cash flows
+    of the first day are applied after buying the initial allocation.
+    '''
+    prices = np.asarray(prices, dtype=float)
+    if prices.ndim != 2 or prices.shape[1] != len(symbols):
+        raise ValueError("Prices must be a (dates x symbols) matrix")
+    check_valid_prices(prices)
+    if rebalance_every is not None and rebalance_every < 1:
+        raise ValueError("rebalance_every must be at least 1 day")
+
+    symbols = [get_valid_symbol(symbol) for symbol in symbols]
+    weights = _get_weights(allocation_targets, symbols)
+    dates_count = prices.shape[0]
+    portfolios_count = weights.shape[0]
+
+    if cash_flows is None:
+        cash_flows = np.zeros((dates_count, portfolios_count))
+    else:
+        cash_flows = np.asarray(cash_flows, dtype=float)
+        if cash_flows.ndim == 1:
+            cash_flows = cash_flows[:, np.newaxis]
+        cash_flows = np.broadcast_to(cash_flows,
+                                     (dates_count, portfolios_count))
+
+    values = np.zeros((dates_count, portfolios_count))
+    turnover = np.zeros((dates_count, portfolios_count))
+    rebalanced = np.zeros((dates_count, portfolios_count), dtype=bool)
+    trade_log = []
+
+    every_portfolio = np.arange(portfolios_count)
+    qty = weights * initial_value / prices[0]
+    _log_trades(trade_log, 0, every_portfolio, qty)
+    for date in range(dates_count):
+        day_prices = prices[date]
+        value = qty @ day_prices
+
+        # Cash flows keep the current allocation, so they scale the
+        # quantities of each portfolio
+        flows = cash_flows[date]
+        if np.any(flows):
+            if np.any(-flows > value):
+                raise ValueError(
+                    "Cannot retire more money than the portfolio value")
+            scale = np.divide(value + flows, value,
+                              out=np.ones_like(value), where=value > 0)
+            new_qty = qty * scale[:, np.newaxis]
+            _log_trades(trade_log, date, every_portfolio, new_qty - qty)
+            qty = new_qty
+            value = value + flows
+
+        # Decide which portfolios are rebalanced today
+        rebalance = np.zeros(portfolios_count, dtype=bool)
+        if date > 0 and rebalance_every is not None:
+            rebalance |= date % rebalance_every == 0
+        if date > 0 and drift_threshold is not None:
+            allocation = np.divide(
+                qty * day_prices, value[:, np.newaxis],
+                out=np.zeros_like(qty), where=value[:, np.newaxis] > 0)
+            drift = np.abs(allocation - weights).max(axis=1)
+            rebalance |= drift > drift_threshold
+
+        if np.any(rebalance):
+            target_qty = weights[rebalance] * \
+                value[rebalance, np.newaxis] / day_prices
+            trades = target_qty - qty[rebalance]
+            qty[rebalance] = target_qty
+
+            traded_value = np.abs(trades) @ day_prices
+            turnover[date, rebalance] = np.divide(
+                traded_value, value[rebalance],
+                out=np.zeros_like(traded_value),
+                where=value[rebalance] > 0)
+            rebalanced[date] = rebalance
+            _log_trades(trade_log, date, np.flatnonzero(rebalance), trades)
+
+        values[date] = value
+
+    trades = tuple(np.concatenate(column) for column in zip(*trade_log))
+    return BacktestResult(symbols, values, turnover, rebalanced, trades)
@@ -0,0 +1,117 @@
+'''
+This module computes rebalance trades with no-trade bands. Each stock has a
+tolerance band around its target allocation, and only the stocks outside of
+their band are traded. A trade costs a fixed fee plus some basis points of the
+traded value, so the trades are chosen to send as few orders and to trade as
+little value as possible:
+
+    1. Each stock outside of its band is traded only up to the nearest edge of
+       the band.
+    2. Those trades do not add up to zero, so the difference is covered
+       extending the orders already sent (up to the far edge of their band),
+       starting with the cheapest stocks.
+    3. Only if that is not enough, new orders are sent for stocks inside
+       their band, starting with the ones that can absorb more value, so the
+       number of fixed fees is minimal.
+
+Everything is computed in value (quantity times price), so the portfolio value
+does not change. Trading every stock to its target is always a valid solution,
+so the steps above always find one.
+'''
+
+import numpy as np
+
+# Tolerance, in value, used to consider that the trades add up to zero
+EPSILON = 1e-9
+
+
+class TransactionCosts:
+    '''
+    This class represents the cost of a trade: a fixed fee per order plus a
+    number of basis points of the traded value. The basis points can be a
+    number or an array with the basis points of each stock.
+    '''
+    def __init__(self, fixed_fee: float = 0.0, basis_points=0.0):
+        self.fixed_fee = fixed_fee
+        self.basis_points = basis_points
+
+    def get_cost(self, trade_values: np.ndarray) -> float:
+        '''
+        This method returns the total cost of the trades (in value).
+        '''
+        traded = np.abs(trade_values)
+        orders = np.count_nonzero(traded > EPSILON)
+        variable = float(np.sum(traded * self.basis_points)) / 10000
+        return orders * self.fixed_fee + variable
+
+
+def _cover(trades: np.ndarray, net: float, capacity: np.ndarray,
+           order: np.ndarray) -> float:
+    '''
+    This function adds value to the trades in the given order, until the net
+    value is covered. The net value is positive when more value must be
+    bought and negative when more value must be sold. It returns the net
+    value left.
+    '''
+    for stock in order.tolist():
+        if abs(net) <= EPSILON:
+            break
+        amount = min(capacity[stock], abs(net))
+        trades[stock] += np.sign(net) * amount
+        net -= np.sign(net) * amount
+
+    return net
+
+
+def get_band_trades(deviation_values: np.ndarray,
+                    band_values: np.ndarray,
+                    costs: TransactionCosts,
+                    current_values: np.ndarray = None
+                    ) -> tuple[np.ndarray, float]:
+    '''
+    This function returns the value to trade of each stock and the cost of
+    the trades. The deviation values are the target value minus the current
+    value of each stock, and the band values are the half width of the band
+    of each stock, in value. If the current values of the stocks are given,
+    no stock sells more value than it holds.
+    '''
+    deviation_values = np.asarray(deviation_values, dtype=float)
+    band_values = np.asarray(band_values, dtype=float)
+    direction = np.sign(deviation_values)
+    if current_values is None:
+        current_values = np.full(deviation_values.shape, np.inf)
+    else:
+        current_values = np.asarray(current_values, dtype=float)
+
+    outside = np.abs(deviation_values) > band_values + EPSILON
+    trades = np.where(
+        outside, direction * (np.abs(deviation_values) - band_values), 0.0)
+    trades = np.maximum(trades, -current_values)
+
+    # net > 0 means that the trades sell more value than they buy, so more
+    # value has to be bought
+    net = -float(trades.sum())
+    basis_points = np.broadcast_to(costs.basis_points, trades.shape)
+    cheapest = np.argsort(basis_points, kind='stable')
+
+    # The final deviation of each stock must stay in [-band, band], so a
+    # stock can buy up to deviation + band and sell up to band - deviation.
+    # A stock cannot sell more than it holds either, even if its band is
+    # wider than its value.
+    buy_capacity = np.maximum(deviation_values + band_values - trades, 0)
+    sell_capacity = np.maximum(
+        np.minimum(band_values - deviation_values, current_values) + trades,
+        0)
+    capacity = buy_capacity if net > 0 else sell_capacity
+
+    extend = cheapest[outside[cheapest]
+                      & (direction[cheapest] == np.sign(net))]
+    net = _cover(trades, net, capacity, extend)
+
+    if abs(net) > EPSILON:
+        candidates = np.flatnonzero(trades == 0)
+        largest = candidates[np.argsort(-capacity[candidates],
+                                        kind='stable')]
+        net = _cover(trades, net, capacity, largest)
+
+    return trades, costs.get_cost(trades)
@@ -0,0 +1,210 @@
+'''
+This module contains the PortfolioBook class. It is used to handle thousands of
+portfolios at once: instead of calling the methods of each Portfolio in a loop,
+the holdings and the target allocations of all the portfolios are stored as
+matrices with one row per portfolio and one column per stock, and the values,
+deviations and rebalances are computed with a single numpy operation.
+
+The column of each stock is its index in the price book of the registry of
+the book, so the prices vector can be used directly without any reordering.
+'''
+
+from src.cashflows import get_cash_flow_trades
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockRegistry
+import numpy as np
+
+
+class PortfolioBook:
+    '''
+    This class stores the holdings and the allocation targets of many
+    portfolios as (portfolios x stocks) matrices. It gives the same deviation
+    and rebalance results as the Portfolio class, but for every portfolio in
+    one vectorized pass.
+    A book is bound to a stock registry (the default registry if none is
+    given), and it only holds portfolios of that registry.
+    '''
+    def __init__(self, portfolios: list[Portfolio] = (),
+                 registry: StockRegistry = None):
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
+        self.names = []
+        columns = len(registry._book)
+        self._qty = np.zeros((0, columns))
+        self._weights = np.zeros((0, columns))
+
+        self.add_portfolios(portfolios)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def _from_arrays(cls, names: list[str], qty: np.ndarray,
+                     weights: np.ndarray,
+                     registry: StockRegistry = None) -> 'PortfolioBook':
+        '''
+        This method creates a book filling its matrices directly. The columns
+        must be the indexes of the stocks in the price book of the registry,
+        and the weights of each row must be a valid allocation.
+        '''
+        book = cls(registry=registry)
+        book.names = list(names)
+        book._qty = np.asarray(qty, dtype=float)
+        book._weights = np.asarray(weights, dtype=float)
+        book._sync_columns()
+        return book
+
+    def _sync_columns(self) -> None:
+        '''
+        This method adds the columns of the stocks registered after the
+        matrices were created.
+        '''
+        missing = len(self.registry._book) - self._qty.shape[1]
+        if missing > 0:
+            self._qty = np.pad(self._qty, ((0, 0), (0, missing)))
+            self._weights = np.pad(self._weights, ((0, 0), (0, missing)))
+
+    def add_portfolios(self, portfolios: list[Portfolio]) -> None:
+        '''
+        This method adds the holdings and the allocation target of each
+        portfolio as new rows of the book.
+        '''
+        portfolios = list(portfolios)
+        for portfolio in portfolios:
+            if portfolio.registry is not self.registry:
+                raise ValueError(
+                    f"Portfolio {portfolio.name} belongs to another registry.")
+        self._sync_columns()
+
+        qty = np.zeros((len(portfolios), self._qty.shape[1]))
+        weights = np.zeros((len(portfolios), self._qty.shape[1]))
+        for row, portfolio in enumerate(portfolios):
+            collection = portfolio.stocks_collection
+            size = collection._size
+            qty[row, collection._price_idx[:size]] = collection._qty[:size]
+            weights[row, portfolio._target_idx] = portfolio._target_weights
+            self.names.append(portfolio.name)
+
+        self._qty = np.concatenate((self._qty, qty))
+        self._weights = np.concatenate((self._weights, weights))
+
+    def add_portfolio(self, portfolio: Portfolio) -> int:
+        '''
+        This method adds one portfolio to the book and returns its row.
+        '''
+        self.add_portfolios([portfolio])
+        return len(self.names) - 1
+
+    def _get_prices(self) -> np.ndarray:
+        self._sync_columns()
+        return self.registry._book.prices
+
+    def get_values(self) -> np.ndarray:
+        '''
+        This method returns the total value of each portfolio.
+        '''
+        return self._qty @ self._get_prices()
+
+    def get_stocks_qty_target(self) -> np.ndarray:
+        '''
+        This method returns the target quantity of each stock in each
+        portfolio, calculated from its allocation target and its total value.
+        '''
+        prices = self._get_prices()
+        values = self._qty @ prices
+        return self._weights * values[:, np.newaxis] / prices
+
+    def get_qty_deviation(self) -> np.ndarray:
+        '''
+        This method returns the deviation matrix, the target quantity minus
+        the current quantity of each stock in each portfolio.
+        '''
+        return self.get_stocks_qty_target() - self._qty
+
+    def _get_traded_mask(self) -> np.ndarray:
+        '''
+        This method returns which entries are in the deviation of a portfolio:
+        the stocks in its allocation target or in its holdings.
+        '''
+        return (self._weights > 0) | (self._qty > 0)
+
+    def get_trades(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        This method returns the trade list of the whole book as three arrays:
+        the row of the portfolio, the index of the stock and the quantity to
+        buy (positive) or sell (negative).
+        '''
+        deviation = self.get_qty_deviation()
+        rows, columns = np.nonzero(self._get_traded_mask())
+        return rows, columns, deviation[rows, columns]
+
+    def get_stocks_qty_deviation(self, row: int) -> dict[Stock: float]:
+        '''
+        This method returns the deviation of one portfolio with the same format
+        as Portfolio.get_stocks_qty_deviation.
+        '''
+        prices = self._get_prices()
+        value = self._qty[row] @ prices
+        deviation = self._weights[row] * value / prices - self._qty[row]
+
+        columns = np.flatnonzero(self._get_traded_mask()[row])
+        by_index = self.registry._by_index
+        return {by_index[column]: qty for column, qty
+                in zip(columns.tolist(), deviation[columns].tolist())}
+
+    def rebalance(self) -> None:
+        '''
+        This method rebalances every portfolio of the book to meet its target
+        allocation, as Portfolio.rebalance does.
+        '''
+        self._qty = self.get_stocks_qty_target()
+
+    def apply_cash_flows(self, cash_flows: np.ndarray,
+                         rebalance: bool = True) -> None:
+        '''
+        This method invests (positive) or retires (negative) the cash flow of
+        each portfolio in one batch. With rebalance=True the cash flows move
+        the portfolios towards their targets, as invest_money and
+        retire_money of Portfolio do with rebalance=True; otherwise they keep
+        the current allocation.
+        '''
+        cash_flows = np.asarray(cash_flows, dtype=float)
+        if cash_flows.shape != (len(self),):
+            raise ValueError("There must be one cash flow for each portfolio")
+
+        prices = self._get_prices()
+        values = self._qty * prices
+        if not rebalance:
+            portfolio_values = values.sum(axis=1)
+            if np.any(-cash_flows > portfolio_values):
+                raise ValueError(
+                    "Cannot retire more money than the portfolio value")
+            scale = np.divide(portfolio_values + cash_flows,
+                              portfolio_values,
+                              out=np.ones_like(portfolio_values),
+                              where=portfolio_values > 0)
+            self._qty = self._qty * scale[:, np.newaxis]
+            return
+
+        trades = get_cash_flow_trades(values, self._weights, cash_flows)
+        sold = np.divide(trades, values, out=np.zeros_like(trades),
+                         where=(trades < 0) & (values > 0))
+        self._qty = np.where(trades < 0,
+                             self._qty * (1 + sold),
+                             self._qty + trades / prices)
+
+    def get_portfolio(self, row: int) -> Portfolio:
+        '''
+        This method returns a Portfolio with the holdings and the allocation
+        target stored in the given row.
+        '''
+        self._sync_columns()
+        target_columns = np.flatnonzero(self._weights[row])
+        held_columns = np.flatnonzero(self._qty[row])
+        return Portfolio._from_arrays(self.names[row],
+                                      target_columns,
+                                      self._weights[row, target_columns],
+                                      held_columns,
+                                      self._qty[row, held_columns],
+                                      self.registry)
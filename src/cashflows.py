@@ -0,0 +1,100 @@
+'''
+This module distributes cash flows so they also rebalance the portfolios.
+
+A deposit is invested in the underweight stocks first: the cash is poured
+into the stocks with the lowest current value relative to their target weight
+until they reach the same level, like water filling a container. A
+withdrawal does the opposite: first the stocks that are not in the allocation
+target are sold, and then the most overweight stocks are sold down to the
+same level.
+
+The computations work on (portfolios x stocks) matrices of current values and
+target weights, so the cash flows of many portfolios are processed at once.
+'''
+
+import numpy as np
+
+
+def _fill_levels(values: np.ndarray, weights: np.ndarray,
+                 cash: np.ndarray, deposit: bool) -> np.ndarray:
+    '''
+    This function returns the level of each portfolio: after a deposit each
+    target stock has at least weight * level of value, and after a withdrawal
+    at most weight * level.
+    '''
+    targeted = weights > 0
+    ratios = np.full(values.shape, np.inf if deposit else -np.inf)
+    np.divide(values, weights, out=ratios, where=targeted)
+
+    # Deposits fill the lowest ratios first, withdrawals the highest ones
+    order = np.argsort(ratios if deposit else -ratios, axis=1, kind='stable')
+    sorted_ratios = np.take_along_axis(ratios, order, axis=1)
+    sorted_values = np.take_along_axis(
+        np.where(targeted, values, 0), order, axis=1)
+    sorted_weights = np.take_along_axis(weights, order, axis=1)
+
+    cumulative_weights = np.cumsum(sorted_weights, axis=1)
+    cumulative_values = np.cumsum(sorted_values, axis=1)
+    sign = 1 if deposit else -1
+    levels = np.divide(cumulative_values + sign * cash[:, np.newaxis],
+                       cumulative_weights,
+                       out=np.zeros(values.shape),
+                       where=cumulative_weights > 0)
+
+    # The stocks reached by the level are a prefix of the sorted stocks
+    if deposit:
+        reached = levels >= sorted_ratios
+    else:
+        reached = levels <= sorted_ratios
+    last = np.maximum(reached.sum(axis=1) - 1, 0)
+
+    return levels[np.arange(len(values)), last]
+
+
+def get_cash_flow_trades(values: np.ndarray,
+                         weights: np.ndarray,
+                         cash_flows: np.ndarray) -> np.ndarray:
+    '''
+    This function returns the value to buy (positive) or sell (negative) of
+    each stock of each portfolio. values and weights are (portfolios x
+    stocks) matrices and cash_flows has the deposit (positive) or the
+    withdrawal (negative) of each portfolio.
+    '''
+    values = np.asarray(values, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    cash_flows = np.asarray(cash_flows, dtype=float)
+
+    if np.any(-cash_flows > values.sum(axis=1) * (1 + 1e-12)):
+        raise ValueError(
+            "Cannot retire more money than the portfolio value")
+
+    trades = np.zeros(values.shape)
+    deposits = cash_flows > 0
+    if np.any(deposits):
+        levels = _fill_levels(values[deposits], weights[deposits],
+                              cash_flows[deposits], True)
+        trades[deposits] = np.maximum(
+            weights[deposits] * levels[:, np.newaxis] - values[deposits], 0)
+
+    withdrawals = cash_flows < 0
+    if np.any(withdrawals):
+        cash = -cash_flows[withdrawals]
+        held = values[withdrawals]
+        untargeted = np.where(weights[withdrawals] > 0, 0, held)
+
+        # The stocks that are not in the target are sold first
+        untargeted_value = untargeted.sum(axis=1)
+        fraction = np.divide(cash, untargeted_value,
+                             out=np.ones_like(cash),
+                             where=untargeted_value > cash)
+        sells = untargeted * fraction[:, np.newaxis]
+
+        cash = np.maximum(cash - untargeted_value, 0)
+        levels = _fill_levels(held, weights[withdrawals], cash, False)
+        targeted_sells = np.maximum(
+            held - weights[withdrawals] * levels[:, np.newaxis], 0)
+        targeted_sells = np.where(cash[:, np.newaxis] > 0, targeted_sells, 0)
+        sells = np.where(weights[withdrawals] > 0, targeted_sells, sells)
+        trades[withdrawals] = -sells
+
+    return trades
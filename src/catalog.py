@@ -0,0 +1,201 @@
+'''
+This module contains the AllocationCatalog class. It is a compiled cache of
+the allocation files and the stocks file used by main.py.
+
+Parsing YAML is slow, and the demo used to parse every allocation file each
+time the list of allocations was printed. The catalog parses each file once,
+validates and normalizes its content (symbols in uppercase, allocations that
+sum 1, prices greater than zero) and stores the result in a binary cache file.
+
+Each file in the cache is keyed by its modification time and size. If they
+changed, the content hash is checked before parsing it again, so touching a
+file does not force a new parse. Only the files that changed are parsed, and
+the cache is loaded the first time it is needed.
+'''
+
+from src.utils import get_valid_symbol, check_valid_allocation
+import hashlib
+import os
+import pickle
+
+CACHE_VERSION = 1
+
+
+class AllocationCatalog:
+    '''
+    This class gives access to the allocations and the stock prices without
+    parsing the YAML files again while they do not change.
+    '''
+    def __init__(self,
+                 allocations_path: str,
+                 stocks_file: str,
+                 cache_file: str = None):
+        self.allocations_path = allocations_path
+        self.stocks_file = stocks_file
+        if cache_file is None:
+            data_path = os.path.dirname(os.path.normpath(allocations_path))
+            cache_file = os.path.join(data_path, '.catalog_cache.pkl')
+        self.cache_file = cache_file
+
+        # Cached entries by file path, None until the cache is loaded
+        self._entries = None
+        self._modified = False
+
+    def _load_cache(self) -> dict:
+        '''
+        This method loads the cache file the first time it is needed. A
+        missing, corrupted or outdated cache is ignored.
+        '''
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    version, entries = pickle.load(f)
+                if version == CACHE_VERSION and isinstance(entries, dict):
+                    self._entries = entries
+            except Exception:
+                # Unpickling a damaged file can raise almost any exception
+                # (AttributeError, ImportError, TypeError...), and any of
+                # them is only a cache miss
+                pass
+
+        return self._entries
+
+    def save(self) -> None:
+        '''
+        This method writes the cache file if some entry changed. The file is
+        written atomically, so a reader never finds a partial cache.
+        '''
+        if not self._modified:
+            return
+
+        temporary_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(temporary_file, 'wb') as f:
+            pickle.dump((CACHE_VERSION, self._entries), f)
+        os.replace(temporary_file, self.cache_file)
+        self._modified = False
+
+    def _get_entry(self, path: str, compile_data) -> dict:
+        '''
+        This method returns the compiled data of a file. The file is only
+        compiled again if its content changed.
+        '''
+        entries = self._load_cache()
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+
+        entry = entries.get(path)
+        if entry is not None and entry['key'] == key:
+            return entry
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+
+        if entry is None or entry['digest'] != digest:
+            entry = {'digest': digest}
+            try:
+                entry['data'] = compile_data(content)
+                entry['error'] = None
+            except ValueError as error:
+                entry['data'] = None
+                entry['error'] = str(error)
+
+        entry['key'] = key
+        entries[path] = entry
+        self._modified = True
+        return entry
+
+    def get_allocation_files(self) -> list[str]:
+        '''
+        This method returns the allocation files, sorted by name.
+        '''
+        return sorted(file for file in os.listdir(self.allocations_path)
+                      if file.endswith('.yaml'))
+
+    def get_names(self) -> list[str]:
+        '''
+        This method returns the name of each allocation file, in the same
+        order as get_allocation_files.
+        '''
+        names = []
+        for file in self.get_allocation_files():
+            data = self._get_allocation_entry(file)['data']
+            names.append(file if data is None else data['name'])
+
+        return names
+
+    def _get_allocation_entry(self, file: str) -> dict:
+        path = os.path.join(self.allocations_path, file)
+        return self._get_entry(path, compile_allocation)
+
+    def get_allocation(self, file: str) -> dict:
+        '''
+        This method returns the data of an allocation file: a dictionary with
+        its name and its allocation, with the symbols normalized.
+        '''
+        entry = self._get_allocation_entry(file)
+        if entry['error'] is not None:
+            raise ValueError(f"Invalid allocation {file}: {entry['error']}")
+
+        data = entry['data']
+        return {'name': data['name'], 'allocation': dict(data['allocation'])}
+
+    def get_prices(self) -> dict[str: float]:
+        '''
+        This method returns the prices of the stocks file, with the symbols
+        normalized.
+        '''
+        entry = self._get_entry(self.stocks_file, compile_prices)
+        if entry['error'] is not None:
+            raise ValueError(
+                f"Invalid stocks file {self.stocks_file}: {entry['error']}")
+
+        return dict(entry['data'])
+
+
+def load_yaml(content: bytes):
+    # yaml is only imported when a file has to be parsed
+    import yaml
+    try:
+        return yaml.safe_load(content)
+    except yaml.YAMLError as error:
+        raise ValueError(f'Invalid YAML: {error}')
+
+
+def compile_allocation(content: bytes) -> dict:
+    '''
+    This function parses and validates an allocation file.
+    '''
+    data = load_yaml(content)
+    if not isinstance(data, dict) or 'allocation' not in data:
+        raise ValueError("The file must have a name and an allocation")
+
+    if not isinstance(data['allocation'], dict):
+        raise ValueError("The allocation must map each symbol to its weight")
+
+    allocation = {}
+    for symbol, value in data['allocation'].items():
+        if not isinstance(value, (int, float)):
+            raise ValueError(f"Invalid allocation for {symbol}: {value}")
+        allocation[get_valid_symbol(symbol)] = value
+    check_valid_allocation(allocation)
+
+    return {'name': str(data.get('name', '')), 'allocation': allocation}
+
+
+def compile_prices(content: bytes) -> dict:
+    '''
+    This function parses and validates the stocks file.
+    '''
+    data = load_yaml(content)
+    if not isinstance(data, dict):
+        raise ValueError("The file must map each symbol to its price")
+
+    prices = {}
+    for symbol, price in data.items():
+        if not isinstance(price, (int, float)) or price <= 0:
+            raise ValueError(f"Invalid price for {symbol}: {price}")
+        prices[get_valid_symbol(symbol)] = float(price)
+
+    return prices
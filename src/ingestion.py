@@ -0,0 +1,159 @@
+'''
+This module ingests streams of price ticks. A tick is a tuple
+(symbol, price, timestamp).
+
+Applying every tick to the Stock registry would validate the symbol and the
+price of every intermediate tick. Instead, the ticks are coalesced: within a
+window only the latest tick of each symbol is kept, and when the window closes
+the surviving ticks are applied to the registry with a single call to
+Stock.update_prices. The symbols are normalized only for the survivors.
+'''
+
+from collections.abc import AsyncIterable, AsyncIterator, Iterable, Iterator
+from src.stocks import Stock, StockRegistry
+from src.utils import get_valid_symbol
+import math
+import numpy as np
+
+
+class TickCoalescer:
+    '''
+    This class keeps the latest tick of each symbol inside a window. The
+    window is closed when a tick arrives more than window seconds after the
+    first tick of the window, or when it holds max_ticks ticks.
+    '''
+    def __init__(self, window: float = 1.0, max_ticks: int = None):
+        if window <= 0:
+            raise ValueError("Window must be greater than zero")
+
+        self.window = window
+        self.max_ticks = max_ticks
+        self._batch = {}
+        self._window_start = None
+        self._ticks_count = 0
+
+    def add(self, symbol: str, price: float,
+            timestamp: float) -> dict[str: tuple[float, float]]:
+        '''
+        This method adds a tick to the current window. If the tick closes the
+        window, it returns the batch of the closed window, otherwise it
+        returns None.
+        '''
+        closed_batch = None
+        if self._window_start is None:
+            self._window_start = timestamp
+        elif timestamp - self._window_start >= self.window:
+            closed_batch = self.flush()
+            self._window_start = timestamp
+
+        latest = self._batch.get(symbol)
+        if latest is None or timestamp >= latest[1]:
+            self._batch[symbol] = (price, timestamp)
+        self._ticks_count += 1
+
+        full = (self.max_ticks is not None
+                and self._ticks_count >= self.max_ticks)
+        if full and closed_batch is None:
+            # The window is full, so it is closed with this tick included
+            closed_batch = self.flush()
+
+        return closed_batch
+
+    def flush(self) -> dict[str: tuple[float, float]]:
+        '''
+        This method closes the current window and returns its batch, a
+        dictionary with the symbol as the key and the latest (price, timestamp)
+        as the value.
+        '''
+        batch = self._batch
+        self._batch = {}
+        self._window_start = None
+        self._ticks_count = 0
+        return batch
+
+
+def apply_ticks_batch(batch: dict[str: tuple[float, float]],
+                      registry: StockRegistry = None) -> int:
+    '''
+    This function applies a batch of coalesced ticks to the Stock registry (the
+    default registry if none is given) and returns the number of prices
+    updated. Ticks of unknown symbols and ticks with invalid prices are
+    skipped, so one bad tick does not reject the whole batch.
+    '''
+    if registry is None:
+        registry = Stock.default_registry
+
+    latest = {}
+    for symbol, (price, timestamp) in batch.items():
+        try:
+            symbol = get_valid_symbol(symbol)
+        except ValueError:
+            continue
+
+        stock = registry._instances.get(symbol)
+        if stock is None:
+            continue
+
+        # Invalid prices are dropped here, so they neither reject the batch
+        # nor hide a valid tick of another spelling of the symbol
+        try:
+            price = float(price)
+        except (TypeError, ValueError):
+            continue
+        if not math.isfinite(price) or price <= 0:
+            continue
+
+        # Different spellings of a symbol are coalesced here
+        previous = latest.get(stock)
+        if previous is None or timestamp >= previous[1]:
+            latest[stock] = (price, timestamp)
+
+    if not latest:
+        return 0
+
+    indexes = np.fromiter((stock.index for stock in latest),
+                          dtype=np.intp, count=len(latest))
+    prices = np.fromiter((price for price, _ in latest.values()),
+                         dtype=float, count=len(latest))
+    registry.update_prices((indexes, prices))
+    return len(latest)
+
+
+def ingest_ticks(ticks: Iterable[tuple[str, float, float]],
+                 window: float = 1.0,
+                 max_ticks: int = None,
+                 registry: StockRegistry = None) -> Iterator[int]:
+    '''
+    This generator consumes an iterable of ticks and applies them to the
+    registry one window at a time. It yields the number of prices updated by
+    each window.
+    '''
+    coalescer = TickCoalescer(window, max_ticks)
+    for symbol, price, timestamp in ticks:
+        batch = coalescer.add(symbol, price, timestamp)
+        if batch:
+            yield apply_ticks_batch(batch, registry)
+
+    batch = coalescer.flush()
+    if batch:
+        yield apply_ticks_batch(batch, registry)
+
+
+async def ingest_tick_stream(ticks: AsyncIterable[tuple[str, float, float]],
+                             window: float = 1.0,
+                             max_ticks: int = None,
+                             registry: StockRegistry = None
+                             ) -> AsyncIterator[int]:
+    '''
+    This asynchronous generator does the same as ingest_ticks for an
+    asynchronous stream of ticks.
+    '''
+    coalescer = TickCoalescer(window, max_ticks)
+    async for symbol, price, timestamp in ticks:
+        batch = coalescer.add(symbol, price, timestamp)
+        if batch:
+            yield apply_ticks_batch(batch, registry)
+
+    batch = coalescer.flush()
+    if batch:
+        yield apply_ticks_batch(batch, registry)
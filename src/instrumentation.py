@@ -0,0 +1,184 @@
+'''
+This module contains the instrumentation of the hot paths of the library. For
+each instrumented method it counts the calls and accumulates their time in a
+total and in a histogram of latencies.
+
+The instrumentation is switched on and off at runtime with enable and
+disable. Enabling it replaces the instrumented methods of Stock,
+StockCollection and Portfolio with wrappers that time each call, and
+disabling it puts the original methods back, so it costs nothing while it is
+disabled. The times are inclusive: the time of a method includes the time of
+the instrumented methods it calls.
+
+The metrics are read with get_snapshot (a dictionary) or export_prometheus
+(the Prometheus text format), and cleared with reset.
+'''
+
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockCollection
+import functools
+import threading
+import time
+
+
+# Methods instrumented by enable
+INSTRUMENTED_METHODS = {
+    Stock: ['__new__', 'update_price', 'update_prices'],
+    StockCollection: ['set_stock_qty', 'get_value', 'get_allocation',
+                      'delete_stock', 'get_stocks_set', 'modify_stock_qty',
+                      'modify_stocks_qty', '_compute_value'],
+    Portfolio: ['set_allocation_target', 'update_stocks_qty_target',
+                'get_stocks_qty_deviation', '_compute_deviation_arrays',
+                '_update_deviation', 'get_allocation_drift', 'rebalance',
+                'get_lot_orders', 'rebalance_lots', 'get_band_trades',
+                'rebalance_within_bands', 'invest_money', 'retire_money'],
+}
+
+# Upper bound (in nanoseconds) of each bucket of the histograms, powers of
+# two from 256 ns to about 1 second. The last bucket has no upper bound.
+BUCKET_BOUNDS = [2 ** exponent for exponent in range(8, 31)]
+
+
+class MethodStats:
+    '''
+    This class holds the metrics of one method: the number of calls, the
+    total and maximum time, and the number of calls in each bucket of the
+    histogram.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.calls = 0
+            self.total_ns = 0
+            self.max_ns = 0
+            self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+
+    def record(self, duration_ns: int) -> None:
+        # The bucket of a duration d is the first power of two >= d
+        bucket = min(max((duration_ns - 1).bit_length() - 8, 0),
+                     len(BUCKET_BOUNDS))
+        with self._lock:
+            self.calls += 1
+            self.total_ns += duration_ns
+            if duration_ns > self.max_ns:
+                self.max_ns = duration_ns
+            self.buckets[bucket] += 1
+
+    def get_snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'total_ns': self.total_ns,
+                'mean_ns': self.total_ns / self.calls if self.calls else 0.0,
+                'max_ns': self.max_ns,
+                'buckets': list(self.buckets),
+            }
+
+
+# Metrics of each method by its name (e.g. 'Portfolio.rebalance')
+_stats = {}
+# Original attributes replaced by enable, to restore them in disable
+_originals = {}
+_lock = threading.Lock()
+
+
+def _wrap(function, stats: MethodStats):
+    timer = time.perf_counter_ns
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = timer()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.record(timer() - start)
+
+    return wrapper
+
+
+def is_enabled() -> bool:
+    return bool(_originals)
+
+
+def enable() -> None:
+    '''
+    This function replaces the instrumented methods with their timed
+    versions. Calling it when it is already enabled does nothing.
+    '''
+    with _lock:
+        if _originals:
+            return
+
+        for cls, names in INSTRUMENTED_METHODS.items():
+            for name in names:
+                key = f'{cls.__name__}.{name}'
+                stats = _stats.setdefault(key, MethodStats())
+                original = cls.__dict__[name]
+
+                # Static and class methods are wrapped inside their
+                # descriptor (__new__ is a static method)
+                if isinstance(original, (staticmethod, classmethod)):
+                    wrapped = type(original)(
+                        _wrap(original.__func__, stats))
+                else:
+                    wrapped = _wrap(original, stats)
+
+                _originals[(cls, name)] = original
+                setattr(cls, name, wrapped)
+
+
+def disable() -> None:
+    '''
+    This function restores the original methods. The metrics collected are
+    kept until reset is called.
+    '''
+    with _lock:
+        for (cls, name), original in _originals.items():
+            setattr(cls, name, original)
+        _originals.clear()
+
+
+def reset() -> None:
+    '''
+    This function clears the metrics of every method.
+    '''
+    for stats in list(_stats.values()):
+        stats.clear()
+
+
+def get_snapshot() -> dict[str: dict]:
+    '''
+    This function returns the metrics of the methods called at least once,
+    by the method name. The buckets are the number of calls of each bucket
+    of BUCKET_BOUNDS, plus the calls slower than the last bound.
+    '''
+    return {key: snapshot for key, snapshot
+            in ((key, stats.get_snapshot()) for key, stats in _stats.items())
+            if snapshot['calls'] > 0}
+
+
+def export_prometheus(prefix: str = 'portfolio') -> str:
+    '''
+    This function returns the metrics in the Prometheus text format, with a
+    histogram of latencies (in seconds) for each method.
+    '''
+    name = f'{prefix}_method_duration_seconds'
+    lines = [f'# HELP {name} Time spent in each instrumented method.',
+             f'# TYPE {name} histogram']
+    for method, snapshot in sorted(get_snapshot().items()):
+        label = f'method="{method}"'
+        cumulative = 0
+        for bound, count in zip(BUCKET_BOUNDS, snapshot['buckets']):
+            cumulative += count
+            lines.append(
+                f'{name}_bucket{{{label},le="{bound / 1e9:.9g}"}} '
+                f'{cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} '
+                     f'{snapshot["calls"]}')
+        lines.append(f'{name}_sum{{{label}}} {snapshot["total_ns"] / 1e9}')
+        lines.append(f'{name}_count{{{label}}} {snapshot["calls"]}')
+
+    return '\n'.join(lines) + '\n'
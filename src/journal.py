@@ -0,0 +1,557 @@
+'''
+This module implements the persistence of the portfolios: an append-only
+journal of every change of their holdings and allocation targets, plus
+periodic snapshots of the whole state.
+
+The directory of a journal contains:
+
+    - Segments journal-<n>.bin: the magic bytes b'PFJ1' followed by binary
+      records. A quantity change is a 17 bytes record (portfolio, stock and
+      new quantity, 0 when the stock is removed). The stocks and portfolios
+      are referenced by integer ids, defined by a record the first time they
+      appear in each segment, so every segment can be read on its own.
+    - Snapshots snapshot-<n>.npz: the holdings and allocation targets of
+      every portfolio at the start of segment n, stored as numpy arrays with
+      the rows of all the portfolios one after the other.
+
+A snapshot starts a new segment, and the files older than the snapshot are
+deleted once it is written. Recovering loads the latest snapshot with a few
+array reads and replays only the records of the segments after it, so the
+portfolios are rebuilt from arrays without a Python object per position.
+
+Records are written through a buffer: flush writes them to the operating
+system (and to the disk with sync=True). A segment cut by a crash is read up
+to its last complete record.
+'''
+
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockRegistry
+import numpy as np
+import os
+import re
+import struct
+import threading
+
+MAGIC = b'PFJ1'
+VERSION = 1
+
+# Kinds of records
+QTY_RECORD = 1
+STOCK_RECORD = 2
+PORTFOLIO_RECORD = 3
+TARGET_RECORD = 4
+REMOVE_RECORD = 5
+
+# Kind, portfolio id, stock id and new quantity
+QTY = struct.Struct('<BIId')
+# Kind, stock or portfolio id and size of its name in UTF-8
+NAME = struct.Struct('<BIH')
+# Kind, portfolio id and number of stocks, followed by the target rows
+TARGET = struct.Struct('<BII')
+TARGET_ROW = np.dtype([('stock', '<u4'), ('weight', '<f8')])
+# Kind and portfolio id
+REMOVE = struct.Struct('<BI')
+
+_FILE_NAME = re.compile(r'^(journal|snapshot)-(\d+)\.(bin|npz)$')
+
+
+def _get_path(directory: str, kind: str, segment: int) -> str:
+    extension = 'bin' if kind == 'journal' else 'npz'
+    return os.path.join(directory, f'{kind}-{segment:08d}.{extension}')
+
+
+def _list_files(directory: str) -> tuple[list[int], list[int]]:
+    '''
+    This function returns the numbers of the segments and of the snapshots
+    found in the directory, sorted.
+    '''
+    segments, snapshots = [], []
+    for name in os.listdir(directory):
+        match = _FILE_NAME.match(name)
+        if match is None:
+            continue
+        kind, number, extension = match.groups()
+        if kind == 'journal' and extension == 'bin':
+            segments.append(int(number))
+        elif kind == 'snapshot' and extension == 'npz':
+            snapshots.append(int(number))
+    return sorted(segments), sorted(snapshots)
+
+
+def _resolve(registry: StockRegistry, symbol: str) -> int:
+    index = registry._symbols.get_id(symbol)
+    if index is None:
+        raise ValueError(f'''Stock {symbol} not created. Please instanciate
+                         the stock before recovering the portfolios.''')
+    return index
+
+
+class _RecoveredState:
+    '''
+    This class holds the state read from a snapshot and the changes replayed
+    from the segments after it. The portfolios changed by the segments are
+    converted to dictionaries of {stock index: value}, the rest stay in the
+    arrays of the snapshot.
+    '''
+    def __init__(self, registry: StockRegistry):
+        self.registry = registry
+        self.names = []
+        self.rows = {}
+        self.held_offsets = np.zeros(1, dtype=np.int64)
+        self.held_idx = np.zeros(0, dtype=np.int32)
+        self.held_qty = np.zeros(0)
+        self.target_offsets = np.zeros(1, dtype=np.int64)
+        self.target_idx = np.zeros(0, dtype=np.int32)
+        self.target_weights = np.zeros(0)
+        # Portfolios changed by the segments, as [holdings, target]. A
+        # removed portfolio is kept with None.
+        self.changed = {}
+
+    def load_snapshot(self, path: str) -> None:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != VERSION:
+                raise ValueError(
+                    f"Unsupported journal snapshot version {data['version']}")
+            # The stocks of the snapshot are mapped to their index in the
+            # registry, which may differ from the index when it was written
+            stock_map = np.fromiter(
+                (_resolve(self.registry, symbol)
+                 for symbol in data['symbols'].tolist()),
+                dtype=np.int32, count=len(data['symbols']))
+            self.names = data['names'].tolist()
+            self.held_offsets = data['held_offsets']
+            self.held_idx = stock_map[data['held_stocks']]
+            self.held_qty = data['held_qty']
+            self.target_offsets = data['target_offsets']
+            self.target_idx = stock_map[data['target_stocks']]
+            self.target_weights = data['target_weights']
+        self.rows = {name: row for row, name in enumerate(self.names)}
+
+    def _get_changed(self, name: str) -> list[dict]:
+        entry = self.changed.get(name)
+        if entry is not None:
+            return entry
+
+        row = self.rows.get(name)
+        if row is None or name in self.changed:
+            entry = [{}, {}]
+        else:
+            start, end = self.held_offsets[row:row + 2].tolist()
+            holdings = dict(zip(self.held_idx[start:end].tolist(),
+                                self.held_qty[start:end].tolist()))
+            start, end = self.target_offsets[row:row + 2].tolist()
+            target = dict(zip(self.target_idx[start:end].tolist(),
+                              self.target_weights[start:end].tolist()))
+            entry = [holdings, target]
+
+        self.changed[name] = entry
+        return entry
+
+    def set_qty(self, name: str, index: int, quantity: float) -> None:
+        holdings = self._get_changed(name)[0]
+        if quantity == 0:
+            holdings.pop(index, None)
+        else:
+            holdings[index] = quantity
+
+    def set_target(self, name: str, target: dict[int: float]) -> None:
+        self._get_changed(name)[1] = target
+
+    def remove(self, name: str) -> None:
+        self.changed[name] = None
+
+    def replay(self, path: str) -> None:
+        '''
+        This method applies the records of a segment. It stops at the end of
+        the last complete record.
+        '''
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(MAGIC)] != MAGIC:
+            # A segment created just before a crash may be cut even before
+            # the end of the magic bytes
+            if MAGIC.startswith(data):
+                return
+            raise ValueError(f"{path} is not a journal segment")
+
+        stocks = {}
+        names = {}
+        offset = len(MAGIC)
+        end = len(data)
+        while offset < end:
+            kind = data[offset]
+            if kind == QTY_RECORD:
+                if offset + QTY.size > end:
+                    break
+                _, key, stock, quantity = QTY.unpack_from(data, offset)
+                offset += QTY.size
+                self.set_qty(names[key], stocks[stock], quantity)
+
+            elif kind in (STOCK_RECORD, PORTFOLIO_RECORD):
+                if offset + NAME.size > end:
+                    break
+                _, key, size = NAME.unpack_from(data, offset)
+                if offset + NAME.size + size > end:
+                    break
+                start = offset + NAME.size
+                name = data[start:start + size].decode('utf-8')
+                offset = start + size
+                if kind == STOCK_RECORD:
+                    stocks[key] = _resolve(self.registry, name)
+                else:
+                    names[key] = name
+
+            elif kind == TARGET_RECORD:
+                if offset + TARGET.size > end:
+                    break
+                _, key, count = TARGET.unpack_from(data, offset)
+                start = offset + TARGET.size
+                if start + count * TARGET_ROW.itemsize > end:
+                    break
+                rows = np.frombuffer(data, dtype=TARGET_ROW, count=count,
+                                     offset=start)
+                offset = start + count * TARGET_ROW.itemsize
+                self.set_target(names[key], {
+                    stocks[stock]: weight for stock, weight
+                    in zip(rows['stock'].tolist(), rows['weight'].tolist())})
+
+            elif kind == REMOVE_RECORD:
+                if offset + REMOVE.size > end:
+                    break
+                _, key = REMOVE.unpack_from(data, offset)
+                offset += REMOVE.size
+                self.remove(names[key])
+
+            else:
+                raise ValueError(
+                    f"Unknown record {kind} at byte {offset} of {path}")
+
+    def build(self) -> dict[str: Portfolio]:
+        '''
+        This method creates the portfolios, in the order of the snapshot
+        followed by the portfolios added after it.
+        '''
+        registry = self.registry
+        portfolios = {}
+        for row, name in enumerate(self.names):
+            if name in self.changed:
+                continue
+            held_start, held_end = self.held_offsets[row:row + 2].tolist()
+            target_start, target_end = \
+                self.target_offsets[row:row + 2].tolist()
+            portfolios[name] = Portfolio._from_arrays(
+                name,
+                self.target_idx[target_start:target_end],
+                self.target_weights[target_start:target_end],
+                self.held_idx[held_start:held_end],
+                self.held_qty[held_start:held_end],
+                registry)
+
+        for name, entry in self.changed.items():
+            if entry is None:
+                continue
+            holdings, target = entry
+            portfolios[name] = Portfolio._from_arrays(
+                name,
+                np.fromiter(target.keys(), dtype=np.int32,
+                            count=len(target)),
+                np.fromiter(target.values(), dtype=float, count=len(target)),
+                np.fromiter(holdings.keys(), dtype=np.int32,
+                            count=len(holdings)),
+                np.fromiter(holdings.values(), dtype=float,
+                            count=len(holdings)),
+                registry)
+
+        return portfolios
+
+
+def _recover(directory: str, registry: StockRegistry
+             ) -> tuple[dict[str: Portfolio], int]:
+    segments, snapshots = _list_files(directory)
+    state = _RecoveredState(registry)
+    first_segment = 0
+    if snapshots:
+        first_segment = snapshots[-1]
+        state.load_snapshot(_get_path(directory, 'snapshot', first_segment))
+
+    for segment in segments:
+        if segment >= first_segment:
+            state.replay(_get_path(directory, 'journal', segment))
+
+    last_segment = max(segments + snapshots, default=-1)
+    return state.build(), last_segment
+
+
+def recover(directory: str,
+            registry: StockRegistry = None) -> dict[str: Portfolio]:
+    '''
+    This function rebuilds the portfolios stored in a journal directory,
+    with the portfolio name as the key. The stocks must already exist in the
+    registry (the default registry if none is given). It does not modify the
+    directory nor attach the portfolios to a journal.
+    '''
+    if registry is None:
+        registry = Stock.default_registry
+    return _recover(directory, registry)[0]
+
+
+class TradeJournal:
+    '''
+    This class records the changes of the portfolios attached to it. Opening
+    a journal recovers the portfolios stored in its directory (available in
+    the portfolios attribute, already attached) and starts a new segment.
+
+    Every quantity change of the holdings of an attached portfolio
+    (set_stock_qty, modify_stock_qty, delete_stock, and the methods that use
+    them like rebalance, invest_money and retire_money) and every change of
+    its allocation target is appended to the journal. With snapshot_every a
+    snapshot is taken automatically after that number of records.
+
+    A snapshot reflects the portfolios as they are when it is taken, so it
+    should not run while another thread is modifying them.
+    '''
+    def __init__(self, directory: str,
+                 registry: StockRegistry = None,
+                 snapshot_every: int = None,
+                 sync: bool = False):
+        if registry is None:
+            registry = Stock.default_registry
+        self.directory = directory
+        self.registry = registry
+        self.snapshot_every = snapshot_every
+        self.sync = sync
+        self._lock = threading.RLock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.portfolios, last_segment = _recover(directory, registry)
+        # Id of each portfolio in the records, by name, and the reverse
+        self._keys = {}
+        self._names = {}
+        self._next_key = 0
+        for portfolio in self.portfolios.values():
+            self._hook(portfolio)
+
+        self._file = None
+        self._open_segment(last_segment + 1)
+
+    def _hook(self, portfolio: Portfolio) -> None:
+        key = self._next_key
+        self._next_key += 1
+        self._keys[portfolio.name] = key
+        self._names[key] = portfolio.name
+        portfolio._journal = (self, key)
+        portfolio.stocks_collection._journal = (self, key)
+
+    def _open_segment(self, segment: int) -> None:
+        '''
+        This method closes the current segment and starts a new one. The ids
+        are defined again in every segment.
+        '''
+        if self._file is not None:
+            self._close_file()
+        self.segment = segment
+        self._file = open(_get_path(self.directory, 'journal', segment),
+                          'wb')
+        self._file.write(MAGIC)
+        self._defined_stocks = set()
+        self._defined_portfolios = set()
+        self._records = 0
+
+    def _close_file(self) -> None:
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+
+    def _write_name(self, kind: int, key: int, name: str) -> None:
+        encoded = name.encode('utf-8')
+        self._file.write(NAME.pack(kind, key, len(encoded)) + encoded)
+
+    def _define(self, key: int, indexes) -> None:
+        '''
+        This method writes the definition of the portfolio and the stocks
+        that were not defined yet in the current segment.
+        '''
+        if key not in self._defined_portfolios:
+            self._write_name(PORTFOLIO_RECORD, key, self._names[key])
+            self._defined_portfolios.add(key)
+
+        by_index = self.registry._by_index
+        for index in indexes:
+            if index not in self._defined_stocks:
+                self._write_name(STOCK_RECORD, index, by_index[index].symbol)
+                self._defined_stocks.add(index)
+
+    def _count_record(self) -> None:
+        self._records += 1
+        if self.snapshot_every is not None and \
+                self._records >= self.snapshot_every:
+            self.snapshot()
+
+    def _record_qty(self, key: int, index: int, quantity: float) -> None:
+        with self._lock:
+            if key not in self._defined_portfolios or \
+                    index not in self._defined_stocks:
+                self._define(key, (index,))
+            self._file.write(QTY.pack(QTY_RECORD, key, index, quantity))
+            self._count_record()
+
+    def _record_target(self, key: int, indexes: np.ndarray,
+                       weights: np.ndarray) -> None:
+        with self._lock:
+            self._define(key, indexes.tolist())
+            rows = np.empty(len(indexes), dtype=TARGET_ROW)
+            rows['stock'] = indexes
+            rows['weight'] = weights
+            self._file.write(TARGET.pack(TARGET_RECORD, key, len(indexes)))
+            self._file.write(rows.tobytes())
+            self._count_record()
+
+    def attach(self, portfolio: Portfolio) -> None:
+        '''
+        This method starts recording the changes of a portfolio. Its current
+        allocation target and holdings are recorded first.
+        '''
+        if portfolio.registry is not self.registry:
+            raise ValueError(
+                f"Portfolio {portfolio.name} belongs to another registry.")
+        if portfolio._journal is not None:
+            raise ValueError(
+                f"Portfolio {portfolio.name} is already journaled.")
+
+        with self._lock:
+            if portfolio.name in self.portfolios:
+                raise ValueError(
+                    f"Portfolio {portfolio.name} already in the journal.")
+
+            self.portfolios[portfolio.name] = portfolio
+            self._hook(portfolio)
+            key = self._keys[portfolio.name]
+            self._record_target(key, portfolio._target_idx,
+                                portfolio._target_weights)
+            collection = portfolio.stocks_collection
+            size = collection._size
+            for index, quantity in zip(
+                    collection._price_idx[:size].tolist(),
+                    collection._qty[:size].tolist()):
+                self._record_qty(key, index, quantity)
+
+    def detach(self, portfolio: Portfolio) -> None:
+        '''
+        This method stops recording the changes of a portfolio and removes it
+        from the journal, so it is not recovered.
+        '''
+        with self._lock:
+            if self.portfolios.get(portfolio.name) is not portfolio:
+                raise ValueError(
+                    f"Portfolio {portfolio.name} not found in the journal.")
+
+            key = self._keys[portfolio.name]
+            self._define(key, ())
+            self._file.write(REMOVE.pack(REMOVE_RECORD, key))
+            del self._keys[portfolio.name]
+            del self._names[key]
+            del self.portfolios[portfolio.name]
+            portfolio._journal = None
+            portfolio.stocks_collection._journal = None
+
+    def snapshot(self) -> None:
+        '''
+        This method writes a snapshot of every portfolio and starts a new
+        segment. The snapshot is written to a temporary file that replaces
+        the destination when it is complete, and only then the older segments
+        and snapshots are deleted.
+        '''
+        with self._lock:
+            self._open_segment(self.segment + 1)
+            path = _get_path(self.directory, 'snapshot', self.segment)
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'wb') as f:
+                np.savez(f, **self._get_arrays())
+                f.flush()
+                if self.sync:
+                    os.fsync(f.fileno())
+            os.replace(temporary_path, path)
+
+            segments, snapshots = _list_files(self.directory)
+            for kind, numbers in (('journal', segments),
+                                  ('snapshot', snapshots)):
+                for number in numbers:
+                    if number < self.segment:
+                        os.remove(_get_path(self.directory, kind, number))
+
+    def _get_arrays(self) -> dict[str: np.ndarray]:
+        '''
+        This method returns the arrays of a snapshot. The stocks are stored
+        as positions in the symbols array, which only has the stocks used by
+        some portfolio.
+        '''
+        portfolios = list(self.portfolios.values())
+        collections = [portfolio.stocks_collection
+                       for portfolio in portfolios]
+        held_sizes = np.fromiter((collection._size
+                                  for collection in collections),
+                                 dtype=np.int64, count=len(collections))
+        target_sizes = np.fromiter((len(portfolio._target_idx)
+                                    for portfolio in portfolios),
+                                   dtype=np.int64, count=len(portfolios))
+        held_idx = np.concatenate(
+            [collection._price_idx[:collection._size]
+             for collection in collections] + [np.zeros(0, dtype=np.int32)])
+        held_qty = np.concatenate(
+            [collection._qty[:collection._size]
+             for collection in collections] + [np.zeros(0)])
+        target_idx = np.concatenate(
+            [portfolio._target_idx for portfolio in portfolios] +
+            [np.zeros(0, dtype=np.int32)])
+        target_weights = np.concatenate(
+            [portfolio._target_weights for portfolio in portfolios] +
+            [np.zeros(0)])
+
+        used = np.union1d(held_idx, target_idx)
+        by_index = self.registry._by_index
+        return {
+            'version': np.array(VERSION),
+            'segment': np.array(self.segment),
+            'names': np.array([portfolio.name for portfolio in portfolios],
+                              dtype=str),
+            'symbols': np.array([by_index[index].symbol
+                                 for index in used.tolist()], dtype=str),
+            'held_offsets': np.concatenate(([0], np.cumsum(held_sizes))),
+            'held_stocks': np.searchsorted(used, held_idx).astype(np.int32),
+            'held_qty': held_qty,
+            'target_offsets': np.concatenate(([0], np.cumsum(target_sizes))),
+            'target_stocks':
+                np.searchsorted(used, target_idx).astype(np.int32),
+            'target_weights': target_weights,
+        }
+
+    def flush(self) -> None:
+        '''
+        This method writes the buffered records to the operating system, and
+        to the disk with sync=True.
+        '''
+        with self._lock:
+            self._file.flush()
+            if self.sync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        '''
+        This method flushes the records and stops recording the changes of
+        the portfolios.
+        '''
+        with self._lock:
+            if self._file is None:
+                return
+            self._close_file()
+            for portfolio in self.portfolios.values():
+                portfolio._journal = None
+                portfolio.stocks_collection._journal = None
+
+    def __enter__(self) -> 'TradeJournal':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
@@ -0,0 +1,96 @@
+'''
+This module computes rebalance orders that can be sent to a broker: every
+order is a whole number of lots, and orders smaller than the minimum trade
+size of the stock are not sent.
+
+The orders are computed in two steps:
+    1. Each deviation is rounded down to whole lots (buys are rounded down
+       and sells are rounded up), so the rounded orders never spend more
+       money than the portfolio has. Orders below the minimum trade size are
+       dropped.
+    2. The remaining cash is allocated greedily, one lot at a time, to the
+       stock that is more underweight in value, as long as the lot can be
+       paid and it reduces the distance to the target.
+
+After the second step every position is within one lot (or one minimum trade)
+of its target and the cash left is lower than the price of any lot that would
+move a stock closer to its target.
+'''
+
+import heapq
+import numpy as np
+
+# Tolerance used to avoid rounding a whole number of lots down because of
+# floating point errors
+EPSILON = 1e-9
+
+
+def _get_step(lots: float, buy: bool, min_lots: float) -> float:
+    '''
+    This function returns how many lots must be added (buy=True) or removed
+    (buy=False) to an order of the given lots, so the order is still zero or
+    greater than the minimum trade size.
+    '''
+    if not buy:
+        lots = -lots
+    if lots >= 0:
+        return max(1.0, min_lots) if lots == 0 else 1.0
+    # The order goes in the opposite direction: remove one lot, or the
+    # whole order if what is left would be below the minimum trade size
+    return 1.0 if -lots - 1 >= min_lots or -lots - 1 == 0 else -lots
+
+
+def get_lot_orders(current_qty: np.ndarray,
+                   target_qty: np.ndarray,
+                   prices: np.ndarray,
+                   lot_sizes: np.ndarray,
+                   min_trade_sizes: np.ndarray,
+                   cash: float = 0.0) -> tuple[np.ndarray, float]:
+    '''
+    This function returns the order quantity of each stock and the cash left
+    after the orders. All the arrays are aligned by stock. The minimum trade
+    sizes are quantities of the stock.
+    '''
+    deviation = (target_qty - current_qty) / lot_sizes
+    lots = np.floor(deviation + EPSILON)
+    # Cannot sell more lots than the ones held
+    lots = np.maximum(lots, np.ceil(-current_qty / lot_sizes - EPSILON))
+
+    min_lots = np.ceil(min_trade_sizes / lot_sizes - EPSILON)
+    lots[(lots != 0) & (np.abs(lots) < min_lots)] = 0
+
+    lot_values = lot_sizes * prices
+    cash = cash - float(lots @ lot_values)
+
+    # Dropping small sells can leave the orders without enough cash, so the
+    # most overweight buys are reduced first
+    if cash < 0:
+        excess = (current_qty + lots * lot_sizes - target_qty) * prices
+        for stock in np.argsort(-excess).tolist():
+            while cash < 0 and lots[stock] > 0:
+                step = _get_step(lots[stock], False, min_lots[stock])
+                lots[stock] -= step
+                cash += step * lot_values[stock]
+
+    # Allocate the remaining cash to the most underweight stocks
+    shortfall = (target_qty - current_qty - lots * lot_sizes) * prices
+    candidates = [(-value, stock) for stock, value
+                  in enumerate(shortfall.tolist()) if value > 0]
+    heapq.heapify(candidates)
+
+    while candidates:
+        _, stock = heapq.heappop(candidates)
+        step = _get_step(lots[stock], True, min_lots[stock])
+        cost = step * lot_values[stock]
+        error = target_qty[stock] - current_qty[stock] - \
+            lots[stock] * lot_sizes[stock]
+        new_error = error - step * lot_sizes[stock]
+        if cost > cash or abs(new_error) >= abs(error):
+            continue
+
+        lots[stock] += step
+        cash -= cost
+        if new_error > 0:
+            heapq.heappush(candidates, (-new_error * prices[stock], stock))
+
+    return lots * lot_sizes, cash
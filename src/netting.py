@@ -0,0 +1,139 @@
+'''
+This module nets the orders of many portfolios. Instead of sending the trades
+of each portfolio to the broker, the trades of the same stock are added up and
+one order per stock is sent. The buys and sells of different portfolios that
+offset each other are crossed internally.
+
+The trades are stored as flat arrays (portfolio, stock index, quantity), one
+entry per portfolio and stock, so the netting and the split of the fills are
+numpy operations even for hundreds of thousands of entries.
+
+When the fill of a stock is received, the entries on the opposite side of the
+net order are completely filled (they were crossed internally), and the
+entries on the same side share the crossed quantity plus the fill, pro rata to
+their size.
+'''
+
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockRegistry
+import numpy as np
+
+
+class OrderNetting:
+    '''
+    This class nets the deviations of many portfolios into one order per
+    stock and splits the fills of those orders back to each portfolio.
+    All the portfolios must belong to the same stock registry (the default
+    registry if none is given).
+    '''
+    def __init__(self,
+                 portfolios: list[Portfolio],
+                 deviations: list[dict[Stock: float]] = None,
+                 registry: StockRegistry = None):
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
+        self.portfolios = list(portfolios)
+        for portfolio in self.portfolios:
+            if portfolio.registry is not registry:
+                raise ValueError(
+                    f"Portfolio {portfolio.name} belongs to another registry.")
+        if deviations is None:
+            deviations = [portfolio.get_stocks_qty_deviation()
+                          for portfolio in self.portfolios]
+        if len(deviations) != len(self.portfolios):
+            raise ValueError(
+                "There must be one deviation for each portfolio")
+
+        sizes = [len(deviation) for deviation in deviations]
+        self._portfolio_rows = np.repeat(
+            np.arange(len(self.portfolios)), sizes)
+        self._stock_idx = np.fromiter(
+            (stock.index for deviation in deviations for stock in deviation),
+            dtype=np.intp, count=sum(sizes))
+        self._qty = np.fromiter(
+            (qty for deviation in deviations for qty in deviation.values()),
+            dtype=float, count=sum(sizes))
+
+        size = len(registry._book)
+        self._net = np.bincount(self._stock_idx, weights=self._qty,
+                                minlength=size)
+        self._gross = np.bincount(self._stock_idx,
+                                  weights=np.abs(self._qty),
+                                  minlength=size)
+
+    def __len__(self) -> int:
+        return len(self._qty)
+
+    def get_orders(self) -> dict[Stock: float]:
+        '''
+        This method returns the net order of each stock: positive to buy and
+        negative to sell. Stocks whose trades offset completely are not
+        included.
+        '''
+        traded = np.flatnonzero(self._net)
+        by_index = self.registry._by_index
+        return {by_index[index]: qty for index, qty
+                in zip(traded.tolist(), self._net[traded].tolist())}
+
+    def get_crossed_qty(self) -> dict[Stock: float]:
+        '''
+        This method returns the quantity of each stock crossed internally,
+        that does not need to be sent to the broker.
+        '''
+        crossed = (self._gross - np.abs(self._net)) / 2
+        traded = np.flatnonzero(crossed)
+        by_index = self.registry._by_index
+        return {by_index[index]: qty for index, qty
+                in zip(traded.tolist(), crossed[traded].tolist())}
+
+    def split_fills(self, fills: dict[Stock: float] = None) -> np.ndarray:
+        '''
+        This method returns the quantity filled for each entry (portfolio and
+        stock). fills has the quantity filled of each net order; by default
+        all the orders are completely filled. A fill must have the same sign
+        as its order and cannot be larger than it.
+        '''
+        filled = self._net.copy()
+        if fills is not None:
+            filled[:] = 0
+            for stock, qty in fills.items():
+                if stock.registry is not self.registry:
+                    raise ValueError(
+                        f"Stock {stock.symbol} belongs to another registry.")
+                filled[stock.index] = qty
+
+        net = self._net
+        if np.any(filled * net < 0) or np.any(np.abs(filled) > np.abs(net)):
+            raise ValueError(
+                "Fills must have the same sign as the orders and be smaller")
+
+        # The side of each stock that goes to the broker has size
+        # (gross + |net|) / 2 and receives the crossed quantity plus the fill
+        same_side_size = (self._gross + np.abs(net)) / 2
+        crossed = same_side_size - np.abs(net)
+        ratio = np.divide(crossed + np.abs(filled), same_side_size,
+                          out=np.ones_like(net), where=same_side_size > 0)
+        ratio[filled == net] = 1.0
+
+        entry_ratio = ratio[self._stock_idx]
+        same_side = self._qty * net[self._stock_idx] > 0
+        return np.where(same_side, self._qty * entry_ratio, self._qty)
+
+    def apply_fills(self, fills: dict[Stock: float] = None) -> None:
+        '''
+        This method applies the filled quantities to the collection of each
+        portfolio with one bulk modification per portfolio.
+        '''
+        filled = self.split_fills(fills)
+        bounds = np.searchsorted(self._portfolio_rows,
+                                 np.arange(len(self.portfolios) + 1))
+
+        by_index = self.registry._by_index
+        for row, portfolio in enumerate(self.portfolios):
+            start, end = bounds[row], bounds[row + 1]
+            changes = {by_index[index]: qty for index, qty
+                       in zip(self._stock_idx[start:end].tolist(),
+                              filled[start:end].tolist())
+                       if qty != 0}
+            portfolio.stocks_collection.modify_stocks_qty(changes)
@@ -0,0 +1,402 @@
+'''
+This module rebalances large groups of portfolios using every core of the
+machine. The portfolios are split into shards of consecutive portfolios and
+each shard is processed by a worker process, which returns its results as
+the flat arrays of a CSR matrix (see the sparse module). The shards are
+stacked in the order of the input portfolios, so the output does not depend
+on the number of workers.
+
+There are two inputs:
+
+    - A SparseBook. Its holdings and allocation targets are already CSR
+      matrices, and their arrays are copied once, with the prices, into a
+      shared memory block. Each worker only receives the layout of the block
+      and the rows of its shard. rebalance_book_in_parallel writes the new
+      holdings back into the book in bulk, so the whole rebalance scales
+      with the number of workers.
+    - A list of Portfolio objects. The workers are forked, so they inherit
+      the portfolios, and each one packs the holdings and the targets of its
+      own shard. Only the results are sent back. rebalance_in_parallel then
+      replaces the rows of each collection with one array operation, which
+      is the only step done per portfolio in the parent. Where fork is not
+      available the portfolios are packed in the parent instead.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from src.portfolio import Portfolio
+from src.sparse import CSRMatrix, SparseBook
+from src.sparse import compute_qty_target, compute_qty_deviation
+from src.stocks import Stock, StockRegistry, PriceVersion
+import multiprocessing
+import numpy as np
+import os
+import threading
+
+# Portfolios and prices inherited by the forked workers, set only while a
+# parallel call runs. The lock keeps two calls from overwriting them.
+_forked_state = None
+_forked_lock = threading.Lock()
+
+
+def _check_registry(portfolios: list[Portfolio],
+                    registry: StockRegistry) -> StockRegistry:
+    if registry is None:
+        registry = Stock.default_registry
+    for portfolio in portfolios:
+        if portfolio.registry is not registry:
+            raise ValueError(
+                f"Portfolio {portfolio.name} belongs to another registry.")
+    return registry
+
+
+def _get_matrices(portfolios: list[Portfolio]
+                  ) -> tuple[CSRMatrix, CSRMatrix]:
+    '''
+    This function returns the holdings and the allocation targets of the
+    portfolios as CSR matrices, one row per portfolio.
+    '''
+    holdings = CSRMatrix.from_collections(
+        [portfolio.stocks_collection for portfolio in portfolios])
+    targets = CSRMatrix.from_rows(
+        [(portfolio._target_idx, portfolio._target_weights)
+         for portfolio in portfolios])
+    return holdings, targets
+
+
+def _compute_rows(holdings: CSRMatrix, targets: CSRMatrix,
+                  prices: np.ndarray, rebalance: bool) -> tuple:
+    '''
+    This function returns the arrays of the deviation of the rows and, when
+    rebalancing, the arrays of their target quantities (the new holdings).
+    '''
+    held_prices = prices[holdings.indices]
+    target_prices = prices[targets.indices]
+    target_qty = compute_qty_target(holdings, targets, held_prices,
+                                    target_prices)
+    deviation = compute_qty_deviation(holdings, targets, held_prices,
+                                      target_prices, target_qty)
+    result = (deviation.indptr, deviation.indices, deviation.data)
+    if rebalance:
+        result += (target_qty.indptr, target_qty.indices, target_qty.data)
+    return result
+
+
+def _share_arrays(arrays: dict[str: np.ndarray]
+                  ) -> tuple[SharedMemory, dict]:
+    '''
+    This function copies the arrays into one shared memory block. It returns
+    the block and its layout: the offset, dtype and length of each array.
+    '''
+    layout = {}
+    size = 0
+    for name, array in arrays.items():
+        layout[name] = (size, array.dtype.str, len(array))
+        # Every array starts at a multiple of 8 bytes
+        size += -(-array.nbytes // 8) * 8
+
+    block = SharedMemory(create=True, size=max(size, 1))
+    for name, array in arrays.items():
+        _get_shared_array(block, layout[name])[:] = array
+    return block, layout
+
+
+def _get_shared_array(block: SharedMemory, layout: tuple) -> np.ndarray:
+    offset, dtype, length = layout
+    return np.ndarray((length,), dtype=dtype, buffer=block.buf,
+                      offset=offset)
+
+
+def _compute_shard(block_name: str, layout: dict, rebalance: bool,
+                   start: int, end: int) -> tuple:
+    '''
+    This function is executed by the workers. It reads the prices and the
+    matrices from the shared memory block and returns the results of the
+    portfolios from start to end (excluded), see _compute_rows.
+    '''
+    block = SharedMemory(name=block_name)
+    try:
+        arrays = {name: _get_shared_array(block, array_layout)
+                  for name, array_layout in layout.items()}
+        holdings = CSRMatrix(arrays['held_indptr'], arrays['held_indices'],
+                             arrays['held_data']).get_rows(start, end)
+        targets = CSRMatrix(arrays['target_indptr'],
+                            arrays['target_indices'],
+                            arrays['target_data']).get_rows(start, end)
+        # Some of the arrays of the result are views of the block (the
+        # target quantities share the columns of the targets), so they are
+        # copied: the block is closed before they are used
+        result = tuple(array.copy() for array in _compute_rows(
+            holdings, targets, arrays['prices'], rebalance))
+        # The views of the block must be released before closing it
+        del arrays, holdings, targets
+    finally:
+        block.close()
+
+    return result
+
+
+def _compute_forked_shard(rebalance: bool, start: int, end: int) -> tuple:
+    '''
+    This function is executed by the forked workers. It packs the portfolios
+    from start to end (excluded), inherited from the parent, and returns
+    their results, see _compute_rows.
+    '''
+    portfolios, prices = _forked_state
+    holdings, targets = _get_matrices(portfolios[start:end])
+    return _compute_rows(holdings, targets, prices, rebalance)
+
+
+def _get_settings(count: int, workers: int, shards: int
+                  ) -> tuple[int, list[int]]:
+    '''
+    This function returns the number of workers and the bounds of the shards.
+    By default there is one worker per core and four shards per worker. With
+    one worker there is a single shard, computed in the current process.
+    '''
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers == 1:
+        shards = 1
+    elif shards is None:
+        shards = workers * 4
+    shards = max(1, min(shards, count))
+    bounds = np.linspace(0, count, shards + 1).astype(int).tolist()
+    return workers, bounds
+
+
+def _run_shards(function, arguments: tuple, workers: int,
+                fork: bool = False) -> list[tuple]:
+    '''
+    This function calls the function with the arguments of each shard. With
+    one worker the shard is processed in the current process.
+    '''
+    if workers == 1:
+        return list(map(function, *arguments))
+
+    context = multiprocessing.get_context('fork') if fork else None
+    with ProcessPoolExecutor(max_workers=workers,
+                             mp_context=context) as executor:
+        return list(executor.map(function, *arguments))
+
+
+def _stack_results(results: list[tuple]) -> list[CSRMatrix]:
+    '''
+    This function stacks the results of the shards. Each result has the
+    arrays of one or more matrices, three arrays per matrix.
+    '''
+    return [CSRMatrix.from_blocks([CSRMatrix(*result[first:first + 3])
+                                   for result in results])
+            for first in range(0, len(results[0]), 3)]
+
+
+def _compute_book(holdings: CSRMatrix, targets: CSRMatrix,
+                  prices: np.ndarray, rebalance: bool, workers: int,
+                  shards: int) -> list[CSRMatrix]:
+    '''
+    This function computes the results of the rows of the matrices in
+    parallel, sharing the matrices with the workers in a shared memory block.
+    '''
+    workers, bounds = _get_settings(len(holdings), workers, shards)
+    if workers == 1:
+        return _stack_results([_compute_rows(holdings, targets, prices,
+                                             rebalance)])
+
+    block, layout = _share_arrays({
+        'prices': prices,
+        'held_indptr': holdings.indptr,
+        'held_indices': holdings.indices,
+        'held_data': holdings.data,
+        'target_indptr': targets.indptr,
+        'target_indices': targets.indices,
+        'target_data': targets.data,
+    })
+    shards = len(bounds) - 1
+    try:
+        results = _run_shards(_compute_shard,
+                              ([block.name] * shards, [layout] * shards,
+                               [rebalance] * shards, bounds[:-1],
+                               bounds[1:]),
+                              workers)
+    finally:
+        block.close()
+        block.unlink()
+
+    return _stack_results(results)
+
+
+def _compute_portfolios(portfolios: list[Portfolio], rebalance: bool,
+                        workers: int, shards: int,
+                        registry: StockRegistry) -> list[CSRMatrix]:
+    '''
+    This function computes the results of the portfolios in parallel. The
+    forked workers pack their own shard of portfolios.
+    '''
+    global _forked_state
+    prices = registry._book.copy()[1]
+    fork = 'fork' in multiprocessing.get_all_start_methods()
+    if not fork:
+        holdings, targets = _get_matrices(portfolios)
+        return _compute_book(holdings, targets, prices, rebalance, workers,
+                             shards)
+
+    workers, bounds = _get_settings(len(portfolios), workers, shards)
+    shards = len(bounds) - 1
+    with _forked_lock:
+        _forked_state = (portfolios, prices)
+        try:
+            results = _run_shards(_compute_forked_shard,
+                                  ([rebalance] * shards, bounds[:-1],
+                                   bounds[1:]),
+                                  workers, fork=True)
+        finally:
+            _forked_state = None
+
+    return _stack_results(results)
+
+
+def get_deviation_matrix_in_parallel(portfolios: list[Portfolio],
+                                     workers: int = None,
+                                     shards: int = None,
+                                     registry: StockRegistry = None
+                                     ) -> CSRMatrix:
+    '''
+    This function returns the deviations of the portfolios as a CSR matrix:
+    one row per portfolio, in the same order as the input, with the indexes
+    of the stocks in the registry as the columns.
+    By default it uses one worker per core and four shards per worker. With
+    one worker the portfolios are processed in the current process.
+    All the portfolios must belong to the registry (the default registry if
+    none is given).
+    '''
+    portfolios = list(portfolios)
+    registry = _check_registry(portfolios, registry)
+    if not portfolios:
+        return CSRMatrix([0], [], [])
+    return _compute_portfolios(portfolios, False, workers, shards,
+                               registry)[0]
+
+
+def get_deviations_in_parallel(portfolios: list[Portfolio],
+                               workers: int = None,
+                               shards: int = None,
+                               registry: StockRegistry = None) -> list[dict]:
+    '''
+    This function returns the deviation of each portfolio, in the same order
+    as the input, with the same format as Portfolio.get_stocks_qty_deviation.
+    The dictionaries are built in the current process, so when the format
+    does not matter get_deviation_matrix_in_parallel is faster.
+    '''
+    portfolios = list(portfolios)
+    registry = _check_registry(portfolios, registry)
+    deviation = get_deviation_matrix_in_parallel(portfolios, workers, shards,
+                                                 registry)
+
+    by_index = registry._by_index
+    stocks = [by_index[index] for index in deviation.indices.tolist()]
+    quantities = deviation.data.tolist()
+    bounds = deviation.indptr.tolist()
+    return [dict(zip(stocks[start:end], quantities[start:end]))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def rebalance_in_parallel(portfolios: list[Portfolio],
+                          workers: int = None,
+                          shards: int = None,
+                          registry: StockRegistry = None) -> CSRMatrix:
+    '''
+    This function rebalances every portfolio, as Portfolio.rebalance does.
+    The deviations and the new holdings are computed in parallel, and the
+    rows of each collection are replaced at once. It returns the trades
+    applied as a CSR matrix, one row per portfolio (see
+    get_deviation_matrix_in_parallel).
+    '''
+    portfolios = list(portfolios)
+    registry = _check_registry(portfolios, registry)
+    if not portfolios:
+        return CSRMatrix([0], [], [])
+
+    trades, holdings = _compute_portfolios(portfolios, True, workers, shards,
+                                           registry)
+    changes = _get_changes(trades, holdings)
+    bounds = holdings.indptr.tolist()
+    for portfolio, start, end, row_changes in \
+            zip(portfolios, bounds[:-1], bounds[1:], changes):
+        portfolio.stocks_collection._replace_rows(
+            holdings.indices[start:end], holdings.data[start:end],
+            row_changes)
+
+    return trades
+
+
+def _get_changes(trades: CSRMatrix, holdings: CSRMatrix
+                 ) -> list[tuple[list, list]]:
+    '''
+    This function returns the changes of each row for
+    StockCollection._replace_rows, computed for all the rows at once. A stock
+    changes when its trade is not zero, and its new quantity is the one in
+    the new holdings (zero when the stock is not in them).
+    '''
+    changed = np.flatnonzero(trades.data != 0)
+    rows = trades.get_row_ids()[changed]
+    columns = trades.indices[changed]
+
+    # Both matrices are sorted by row and by column, so the (row, column)
+    # keys of the holdings are sorted too
+    width = int(max(trades.indices.max(initial=0),
+                    holdings.indices.max(initial=0))) + 1
+    keys = holdings.get_row_ids() * width + holdings.indices
+    changed_keys = rows * width + columns
+    found = np.minimum(np.searchsorted(keys, changed_keys),
+                       max(len(keys) - 1, 0))
+    quantities = np.zeros(len(changed))
+    if len(keys):
+        held = keys[found] == changed_keys
+        quantities[held] = holdings.data[found[held]]
+
+    bounds = np.searchsorted(rows, np.arange(len(trades) + 1)).tolist()
+    columns = columns.tolist()
+    quantities = quantities.tolist()
+    return [(columns[start:end], quantities[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def get_book_deviation_in_parallel(book: SparseBook,
+                                   workers: int = None,
+                                   shards: int = None,
+                                   snapshot: PriceVersion = None
+                                   ) -> CSRMatrix:
+    '''
+    This function returns the same matrix as SparseBook.get_qty_deviation,
+    computed in parallel.
+    '''
+    if not len(book):
+        return CSRMatrix([0], [], [])
+    return _compute_book(book.holdings, book.targets,
+                         _get_book_prices(book, snapshot), False, workers,
+                         shards)[0]
+
+
+def rebalance_book_in_parallel(book: SparseBook,
+                               workers: int = None,
+                               shards: int = None,
+                               snapshot: PriceVersion = None) -> CSRMatrix:
+    '''
+    This function rebalances every portfolio of the book, as
+    SparseBook.rebalance does, computing the new holdings in parallel. It
+    returns the trades applied, with the same format as
+    SparseBook.get_qty_deviation.
+    '''
+    if not len(book):
+        return CSRMatrix([0], [], [])
+    trades, holdings = _compute_book(book.holdings, book.targets,
+                                     _get_book_prices(book, snapshot), True,
+                                     workers, shards)
+    book.holdings = holdings
+    return trades
+
+
+def _get_book_prices(book: SparseBook, snapshot: PriceVersion) -> np.ndarray:
+    if snapshot is not None:
+        return snapshot.prices
+    return book.registry._book.copy()[1]
@@ -1,5 +1,11 @@
-from src.stocks import StockCollection, Stock
+from src.bands import TransactionCosts, get_band_trades
+from src.cashflows import get_cash_flow_trades
+from src.lots import get_lot_orders
+from src.stocks import StockCollection, Stock, StockRegistry, PriceVersion
 from src.utils import check_valid_allocation
+from bisect import bisect_left
+import numpy as np
+import math
 
 
 class Portfolio:
@@ -9,24 +15,141 @@ class Portfolio:
     percentage of the total value of the portfolio that should be allocated to
     each stock. The portfolio can be used to track the performance of the
     stocks and to rebalance the portfolio to meet the target allocation.
+
+    The target quantities and the deviation are cached. The target quantity
+    of each stock per unit of portfolio value (its weight over its price) is
+    only recomputed when the prices or the allocation target change, and it
+    is scaled by the portfolio value when the deviation is read. So a trade,
+    which changes the portfolio value, only updates the cached deviation of
+    the stocks whose quantity changed.
+
+    An indexed portfolio registers its holdings and its target stocks in the
+    Stock holders index, so only the price changes of those stocks invalidate
+    its cached targets.
+
+    A portfolio is bound to a stock registry (the default registry if none is
+    given), and its symbols and prices are resolved in that registry.
+    The calculations take an optional snapshot (a PriceVersion pinned from
+    the registry), so all of them can use the same version of the prices
+    while the live prices keep changing.
+
+    The allocation target is kept as given, and it is also stored, with the
+    cached deviation, as arrays indexed by stock, which are the ones used in
+    the calculations.
     '''
+    __slots__ = ('name', 'registry', 'stocks_collection', 'stocks_qty_target',
+                 '_target_key', '_allocation_version', '_deviation',
+                 '_target_unit', '_target_value',
+                 '_price_changes', '_target_idx', '_target_weights',
+                 '_allocation_target', '_journal', '_observers',
+                 '__weakref__')
+
     def __init__(self,
                  name: str,
                  stocks_allocation: dict[str: float],
-                 total_value: float) -> None:
+                 total_value: float,
+                 indexed: bool = False,
+                 registry: StockRegistry = None) -> None:
 
         check_valid_allocation(stocks_allocation)
         self.name = name
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
 
         self.stocks_collection = StockCollection(
             stocks_allocation=stocks_allocation,
-            total_value=total_value)
-        self.stocks_qty_target = StockCollection()
-        self.allocation_target = stocks_allocation
+            total_value=total_value,
+            indexed=indexed,
+            registry=registry)
+        self.stocks_qty_target = StockCollection(registry=registry)
+
+        # Prices version and allocation version used to compute the target
+        # quantity per unit of value of each target stock (_target_unit),
+        # and the portfolio value used to compute stocks_qty_target
+        self._target_key = None
+        self._target_unit = None
+        self._target_value = None
+        self._allocation_version = 0
+        # Cached deviation as (stock indexes, target quantity per unit of
+        # value, current quantity), sorted by stock index. It is None when
+        # it must be computed from scratch.
+        self._deviation = None
+        # Number of price changes of the target stocks (indexed portfolios)
+        self._price_changes = 0
+        self._target_idx = np.zeros(0, dtype=np.int32)
+        # (journal, key) of the trade journal that records the changes of
+        # the allocation target, None when the portfolio is not journaled
+        self._journal = None
+        # Tuple of (observer, key) notified with observer._on_change(key)
+        # after every change of the allocation target
+        self._observers = None
 
         self.set_allocation_target(stocks_allocation)
         self.update_stocks_qty_target()
 
+    @classmethod
+    def _from_arrays(cls, name: str,
+                     target_idx: np.ndarray,
+                     target_weights: np.ndarray,
+                     held_idx: np.ndarray,
+                     held_qty: np.ndarray,
+                     registry: StockRegistry = None) -> 'Portfolio':
+        '''
+        This method creates a portfolio filling its arrays directly, with the
+        indexes of the stocks in the registry. The allocation target and the
+        quantities must be already validated. The target quantities are
+        computed the first time they are needed.
+        '''
+        if registry is None:
+            registry = Stock.default_registry
+
+        portfolio = cls.__new__(cls)
+        portfolio.name = name
+        portfolio.registry = registry
+        portfolio.stocks_collection = StockCollection._from_arrays(
+            held_idx, held_qty, registry)
+        portfolio.stocks_qty_target = StockCollection._from_arrays(
+            [], [], registry)
+        portfolio._target_key = None
+        portfolio._target_unit = None
+        portfolio._target_value = None
+        portfolio._allocation_version = 1
+        portfolio._deviation = None
+        portfolio._price_changes = 0
+        portfolio._journal = None
+        portfolio._observers = None
+
+        target_idx = np.asarray(target_idx, dtype=np.int32)
+        order = np.argsort(target_idx)
+        portfolio._target_idx = target_idx[order]
+        portfolio._target_weights = np.asarray(target_weights,
+                                               dtype=float)[order]
+        # Built from the arrays the first time it is read
+        portfolio._allocation_target = None
+        return portfolio
+
+    @property
+    def allocation_target(self) -> dict[str: float]:
+        '''
+        This property returns the allocation target as it was set, with the
+        stock symbol (or the Stock) as the key and the allocation as the
+        value. The portfolios created from arrays (by a book or a journal)
+        return it with the Stock as the key.
+        Assigning it is the same as calling set_allocation_target.
+        '''
+        if self._allocation_target is None:
+            by_index = self.registry._by_index
+            self._allocation_target = {
+                by_index[index]: weight for index, weight
+                in zip(self._target_idx.tolist(),
+                       self._target_weights.tolist())}
+        return self._allocation_target
+
+    @allocation_target.setter
+    def allocation_target(self, allocation_target: dict[str: float]) -> None:
+        self.set_allocation_target(allocation_target)
+
     def set_allocation_target(self,
                               allocation_target: dict[str: float]) -> None:
         '''
@@ -37,91 +160,411 @@ class Portfolio:
         target must sum to 1.
         '''
         check_valid_allocation(allocation_target)
-        self.allocation_target = allocation_target
 
-    def update_stocks_qty_target(self) -> None:
+        # The stocks and weights are resolved once here, so the targets can
+        # be recomputed later with array operations
+        targets = {}
+        for stock, allocation in allocation_target.items():
+            if not isinstance(stock, Stock):
+                stock = Stock(stock, registry=self.registry)
+            elif stock.registry is not self.registry:
+                raise ValueError(
+                    f"Stock {stock.symbol} belongs to another registry.")
+            targets[stock] = allocation
+
+        self._allocation_target = allocation_target
+        if self.stocks_collection._indexed:
+            holders = self.registry._holders
+            for index in self._target_idx.tolist():
+                holders.discard(index, self)
+            for stock in targets:
+                holders.add(stock.index, self)
+
+        target_idx = np.fromiter((stock.index for stock in targets),
+                                 dtype=np.int32, count=len(targets))
+        target_weights = np.fromiter(targets.values(), dtype=float,
+                                     count=len(targets))
+        order = np.argsort(target_idx)
+        self._target_idx = target_idx[order]
+        self._target_weights = target_weights[order]
+        self._allocation_version += 1
+        if self._journal is not None:
+            journal, key = self._journal
+            journal._record_target(key, self._target_idx,
+                                   self._target_weights)
+        if self._observers is not None:
+            for observer, key in self._observers:
+                observer._on_change(key)
+
+    def _on_price_change(self, index: int, delta_price: float) -> None:
+        '''
+        This method is called by the holders index when the price of a target
+        stock of an indexed portfolio changes.
+        '''
+        self._price_changes += 1
+
+    def _get_prices_version(self):
+        '''
+        This method returns a value that changes every time a price that
+        affects the portfolio changes. Portfolios that are not indexed depend
+        on the version of the whole price book.
+        '''
+        if self.stocks_collection._indexed:
+            return (self._price_changes,
+                    self.stocks_collection.price_changes)
+        return self.registry._book.version
+
+    def _get_prices(self, stocks, snapshot: PriceVersion = None
+                    ) -> np.ndarray:
+        '''
+        This method returns the prices of the given stocks, from the snapshot
+        if it is given or else from the live prices.
+        '''
+        indexes = np.fromiter((stock.index for stock in stocks),
+                              dtype=np.intp, count=len(stocks))
+        return self.registry._gather(indexes, snapshot)
+
+    def update_stocks_qty_target(self, snapshot: PriceVersion = None) -> None:
         '''
         This method sets the target quantity of stocks in the portfolio. The
         target quantity is calculated based on the target allocation and the
         total value of the portfolio.
+        The target per unit of value is only recomputed (and the cached
+        deviation discarded) if the prices or the allocation target changed
+        since the last time, and the target quantities only if the portfolio
+        value changed too.
         '''
-        portfolio_value = self.stocks_collection.get_value()
-        self.stocks_qty_target = StockCollection(
-            stocks_allocation=self.allocation_target,
-            total_value=portfolio_value)
+        portfolio_value = self.stocks_collection.get_value(snapshot)
+        if snapshot is None:
+            prices_version = self._get_prices_version()
+        else:
+            # Same key as the live prices of that version of the price book
+            prices_version = snapshot.version
+        target_key = (prices_version, self._allocation_version)
+        if target_key != self._target_key:
+            prices = self.registry._gather(self._target_idx, snapshot)
+            self._target_unit = self._target_weights / prices
+            self._target_key = target_key
+            self._target_value = None
+            self._deviation = None
+
+        if portfolio_value != self._target_value:
+            self.stocks_qty_target = StockCollection._from_arrays(
+                self._target_idx, self._target_unit * portfolio_value,
+                self.registry)
+            self._target_value = portfolio_value
 
-    def get_stocks_qty_deviation(self) -> dict[Stock: float]:
+    def get_stocks_qty_deviation(self, snapshot: PriceVersion = None
+                                 ) -> dict[Stock: float]:
         '''
         this method returns the deviation of the current stocks in the portfolio
         from the target stocks. The deviation is a dictionary with the stock
         symbol as the key and the deviation as the value.
         '''
 
-        self.update_stocks_qty_target()
-        deviation = {}
+        self.update_stocks_qty_target(snapshot)
+        changed_stocks = self.stocks_collection._pop_changes()
+
+        if self._deviation is None:
+            self._deviation = self._compute_deviation_arrays()
+        else:
+            self._update_deviation(changed_stocks)
+
+        return self._get_deviation_dict()
+
+    def _get_deviation_dict(self) -> dict[Stock: float]:
+        '''
+        This method scales the cached targets per unit of value by the
+        portfolio value and returns the deviation of each stock.
+        '''
+        by_index = self.registry._by_index
+        indexes, unit, current_qty = self._deviation
+        deviation = unit * self._target_value - current_qty
+        return {by_index[index]: qty for index, qty
+                in zip(indexes.tolist(), deviation.tolist())}
+
+    def _compute_deviation_arrays(self) -> tuple[np.ndarray, np.ndarray,
+                                                 np.ndarray]:
+        '''
+        This method computes the cached deviation of every stock from
+        scratch: the indexes of the stocks (sorted), their target quantity
+        per unit of value and their current quantity. The stocks that are not
+        in the target have no target quantity.
+        '''
+        current = self.stocks_collection
+        current_idx = current._price_idx[:current._size]
+        target_idx = self._target_idx
 
-        target_stocks = self.stocks_qty_target.get_stocks_set()
-        current_stocks = self.stocks_collection.get_stocks_set()
+        indexes = np.union1d(current_idx, target_idx)
+        unit = np.zeros(len(indexes))
+        unit[np.searchsorted(indexes, target_idx)] = self._target_unit
+        current_qty = np.zeros(len(indexes))
+        current_qty[np.searchsorted(indexes, current_idx)] = \
+            current._qty[:current._size]
+        return indexes, unit, current_qty
 
-        modified_stocks = target_stocks.intersection(current_stocks)
-        new_stocks = target_stocks - current_stocks
-        removed_stocks = current_stocks - target_stocks
+    def _update_deviation(self, changed_stocks: set[int]) -> None:
+        '''
+        This method updates the cached deviation only for the stocks (given
+        by their index) whose quantity changed. The targets per unit of value
+        did not change, so the rest of the entries are still valid.
+        '''
+        current = self.stocks_collection
+        target_idx = self._target_idx
+        indexes, unit, current_qty = self._deviation
+        for index in changed_stocks:
+            row = current._find(index)
+            position = bisect_left(indexes, index)
+            cached = position < len(indexes) and indexes[position] == index
+            qty = 0.0 if row is None else float(current._qty[row])
+            if cached:
+                current_qty[position] = qty
+                if row is None and unit[position] == 0:
+                    # Neither held nor in the target
+                    indexes = np.delete(indexes, position)
+                    unit = np.delete(unit, position)
+                    current_qty = np.delete(current_qty, position)
+            elif row is not None:
+                # A stock that was not held nor in the target is bought
+                target_position = bisect_left(target_idx, index)
+                in_target = target_position < len(target_idx) and \
+                    target_idx[target_position] == index
+                indexes = np.insert(indexes, position, index)
+                unit = np.insert(unit, position,
+                                 self._target_unit[target_position]
+                                 if in_target else 0.0)
+                current_qty = np.insert(current_qty, position, qty)
 
-        for stock in modified_stocks:
-            target_qty = self.stocks_qty_target.stocks[stock]
-            current_qty = self.stocks_collection.stocks[stock]
-            deviation[stock] = target_qty - current_qty
+        self._deviation = (indexes, unit, current_qty)
 
-        for stock in new_stocks:
-            target_qty = self.stocks_qty_target.stocks[stock]
-            deviation[stock] = target_qty
+    def get_allocation_drift(self, snapshot: PriceVersion = None) -> float:
+        '''
+        This method returns the maximum absolute difference between the
+        current allocation of a stock and its allocation target. A stock that
+        is not in the target has a target of 0, and a stock that is not held
+        has a current allocation of 0.
+        '''
+        collection = self.stocks_collection
+        size = collection._size
+        held_idx = collection._price_idx[:size]
+        columns = np.union1d(held_idx, self._target_idx)
 
-        for stock in removed_stocks:
-            current_qty = self.stocks_collection.stocks[stock]
-            deviation[stock] = -current_qty
+        drift = np.zeros(len(columns))
+        drift[np.searchsorted(columns, self._target_idx)] = \
+            self._target_weights
+        portfolio_value = collection.get_value(snapshot)
+        if portfolio_value > 0:
+            current_values = collection._get_values(snapshot)
+            drift[np.searchsorted(columns, held_idx)] -= \
+                current_values / portfolio_value
 
-        return deviation
+        return float(np.abs(drift).max(initial=0.0))
 
-    def rebalance(self) -> None:
+    def rebalance(self, snapshot: PriceVersion = None) -> None:
         '''
         This method rebalances the portfolio to meet the target allocation.
         It sells stocks that are overallocated and buys stocks that are
         underallocated.
         '''
-        deviation = self.get_stocks_qty_deviation()
+        deviation = self.get_stocks_qty_deviation(snapshot)
 
         for stock, qty in deviation.items():
             self.stocks_collection.modify_stock_qty(stock, qty)
 
-    def invest_money(self, value: float) -> None:
+    def get_lot_orders(self,
+                       lot_sizes: dict[str: float] = {},
+                       min_trade_sizes: dict[str: float] = {},
+                       snapshot: PriceVersion = None
+                       ) -> tuple[dict[Stock: float], float]:
+        '''
+        This method returns the orders to rebalance the portfolio in whole
+        lots, and the cash that is left without investing. The lot size of the
+        stocks not in lot_sizes is 1 (whole shares) and their minimum trade
+        size is one lot. See the lots module for the details.
+        '''
+        deviation = self.get_stocks_qty_deviation(snapshot)
+        stocks = list(deviation.keys())
+        current = self.stocks_collection.stocks
+        target = self.stocks_qty_target.stocks
+
+        lots = {Stock(symbol, registry=self.registry): size
+                for symbol, size in lot_sizes.items()}
+        min_trades = {Stock(symbol, registry=self.registry): size
+                      for symbol, size in min_trade_sizes.items()}
+
+        orders, cash = get_lot_orders(
+            current_qty=np.array([current.get(stock, 0.0)
+                                  for stock in stocks]),
+            target_qty=np.array([target.get(stock, 0.0)
+                                 for stock in stocks]),
+            prices=self._get_prices(stocks, snapshot),
+            lot_sizes=np.array([lots.get(stock, 1.0) for stock in stocks]),
+            min_trade_sizes=np.array([min_trades.get(stock, 0.0)
+                                      for stock in stocks]))
+
+        return dict(zip(stocks, orders.tolist())), cash
+
+    def rebalance_lots(self,
+                       lot_sizes: dict[str: float] = {},
+                       min_trade_sizes: dict[str: float] = {},
+                       snapshot: PriceVersion = None) -> float:
+        '''
+        This method rebalances the portfolio trading whole lots, as close as
+        possible to the target allocation. It returns the cash left after the
+        trades, which is not part of the portfolio.
+        '''
+        orders, cash = self.get_lot_orders(lot_sizes, min_trade_sizes,
+                                           snapshot)
+
+        for stock, qty in orders.items():
+            if qty != 0:
+                self.stocks_collection.modify_stock_qty(stock, qty)
+
+        return cash
+
+    def get_band_trades(self,
+                        bands: dict[str: float] = {},
+                        default_band: float = 0.0,
+                        costs: TransactionCosts = None,
+                        snapshot: PriceVersion = None
+                        ) -> tuple[dict[Stock: float], float]:
+        '''
+        This method returns the trades that bring every stock back inside its
+        no-trade band, with the minimum number of orders and traded value, and
+        the cost of those trades. The bands are the tolerance around the
+        allocation target of each stock (e.g. 0.02 means +-2% of the
+        portfolio value). See the bands module for the details.
+        '''
+        if costs is None:
+            costs = TransactionCosts()
+
+        deviation = self.get_stocks_qty_deviation(snapshot)
+        stocks = list(deviation.keys())
+        prices = self._get_prices(stocks, snapshot)
+
+        bands = {Stock(symbol, registry=self.registry): band
+                 for symbol, band in bands.items()}
+        band_values = np.array(
+            [bands.get(stock, default_band) for stock in stocks]) * \
+            self.stocks_collection.get_value(snapshot)
+
+        holdings = self.stocks_collection.stocks
+        current_qty = np.array([holdings.get(stock, 0.0) for stock in stocks])
+        trade_values, cost = get_band_trades(
+            np.array(list(deviation.values())) * prices, band_values, costs,
+            current_qty * prices)
+
+        trades = {stock: qty for stock, qty
+                  in zip(stocks, (trade_values / prices).tolist())
+                  if qty != 0}
+        return trades, cost
+
+    def rebalance_within_bands(self,
+                               bands: dict[str: float] = {},
+                               default_band: float = 0.0,
+                               costs: TransactionCosts = None,
+                               snapshot: PriceVersion = None) -> float:
+        '''
+        This method applies the trades of get_band_trades and returns their
+        cost.
+        '''
+        trades, cost = self.get_band_trades(bands, default_band, costs,
+                                            snapshot)
+        current = self.stocks_collection.stocks
+
+        for stock, qty in trades.items():
+            # Avoid leaving tiny residuals when a stock is sold completely
+            if math.isclose(-qty, current.get(stock, 0.0)):
+                qty = -current[stock]
+            self.stocks_collection.modify_stock_qty(stock, qty)
+
+        return cost
+
+    def _apply_cash_flow(self, value: float,
+                         snapshot: PriceVersion = None) -> None:
+        '''
+        This method invests (positive value) or retires (negative value) money
+        moving the portfolio towards its allocation target: deposits buy the
+        underweight stocks first and withdrawals sell the overweight stocks
+        first. See the cashflows module for the details.
+        '''
+        collection = self.stocks_collection
+        size = collection._size
+        held_idx = collection._price_idx[:size]
+        columns = np.union1d(held_idx, self._target_idx)
+        held_columns = np.searchsorted(columns, held_idx)
+
+        values = np.zeros(len(columns))
+        values[held_columns] = collection._get_values(snapshot)
+        weights = np.zeros(len(columns))
+        weights[np.searchsorted(columns, self._target_idx)] = \
+            self._target_weights
+
+        trades = get_cash_flow_trades(values[np.newaxis],
+                                      weights[np.newaxis],
+                                      np.array([value]))[0]
+
+        # Sells are converted to quantity as a fraction of the holding, so
+        # a stock sold completely ends with exactly zero quantity
+        qty = np.zeros(len(columns))
+        qty[held_columns] = collection._qty[:size]
+        prices = self.registry._gather(columns, snapshot)
+        changes = np.where(
+            trades < 0,
+            qty * np.divide(trades, values, out=np.zeros_like(trades),
+                            where=values > 0),
+            trades / prices)
+
+        traded = np.flatnonzero(changes)
+        collection.modify_stocks_qty(
+            {self.registry.get_by_index(column): change for column, change
+             in zip(columns[traded].tolist(), changes[traded].tolist())})
+
+    def invest_money(self, value: float, rebalance: bool = False,
+                     snapshot: PriceVersion = None) -> None:
         '''
         This method inverts the money in the portfolio. It buys stocks to
         augment the portfolio value while keeping the previous allocation.
+        With rebalance=True the money buys the underweight stocks first, so
+        the portfolio gets closer to its allocation target.
         '''
-        current_allocation = self.stocks_collection.get_allocation()
+        if rebalance:
+            self._apply_cash_flow(value, snapshot)
+            return
 
-        for stock in current_allocation.keys():
+        current_allocation = self.stocks_collection.get_allocation(snapshot)
+        prices = self._get_prices(current_allocation.keys(), snapshot)
+
+        for stock, price in zip(current_allocation.keys(), prices.tolist()):
             stock_new_investment = current_allocation[stock] * value
-            adding_stock_qty = stock_new_investment / stock.price
+            adding_stock_qty = stock_new_investment / price
 
             self.stocks_collection.modify_stock_qty(
                 stock, adding_stock_qty)
 
-    def retire_money(self, value: float) -> None:
+    def retire_money(self, value: float, rebalance: bool = False,
+                     snapshot: PriceVersion = None) -> None:
         '''
         This method retires money from the portfolio. It sells stocks to
         reduce the portfolio value while keeping the previous allocation.
+        With rebalance=True the stocks that are not in the allocation target
+        and the overweight stocks are sold first.
         '''
-        current_value = self.stocks_collection.get_value()
+        current_value = self.stocks_collection.get_value(snapshot)
         if value > current_value:
             raise ValueError(
                 f'''Cannot retire more money than the portfolio value:
                 {current_value}''')
 
-        current_allocation = self.stocks_collection.get_allocation()
-        for stock in current_allocation.keys():
+        if rebalance:
+            self._apply_cash_flow(-value, snapshot)
+            return
+
+        current_allocation = self.stocks_collection.get_allocation(snapshot)
+        prices = self._get_prices(current_allocation.keys(), snapshot)
+        for stock, price in zip(current_allocation.keys(), prices.tolist()):
             stock_new_investment = current_allocation[stock] * value
-            removing_stock_qty = stock_new_investment / stock.price
+            removing_stock_qty = stock_new_investment / price
 
             self.stocks_collection.modify_stock_qty(
                 stock, -removing_stock_qty)
@@ -0,0 +1,262 @@
+'''
+This module contains the RebalanceScheduler class. It tells which portfolios
+need to be rebalanced without computing the deviation of every portfolio.
+
+The scheduler keeps the portfolios in an indexed max-heap ordered by their
+allocation drift (see Portfolio.get_allocation_drift). Each portfolio knows
+its position in the heap, so when its drift changes it is moved up or down in
+O(log n).
+
+The scheduler does not poll the portfolios. It is registered in the holders
+index of the registry for the stocks held or targeted by its portfolios, and
+it observes their collections and allocation targets. Every notification
+marks the affected portfolios, and refresh only recomputes the drift of the
+marked ones. The queries call refresh first, so they never return stale
+drifts. The drift of a portfolio only depends on the prices of its own
+stocks, so the price changes of the other stocks are not even delivered to
+the scheduler.
+Replacing the stocks_collection of a scheduled portfolio is not observed:
+remove the portfolio and add it again.
+'''
+
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockRegistry
+import heapq
+
+
+class RebalanceScheduler:
+    '''
+    This class indexes portfolios by their allocation drift. It answers which
+    portfolios are over a drift threshold and which are the most drifted ones
+    without visiting the portfolios that are below them.
+    All the portfolios must belong to the registry (the default registry if
+    none is given).
+    '''
+    def __init__(self, portfolios: list[Portfolio] = (),
+                 registry: StockRegistry = None):
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
+
+        # Heap of [drift, portfolio], the largest drift is at the root
+        self._heap = []
+        # Position of each portfolio in the heap
+        self._positions = {}
+        # Versions used to compute the drift of each portfolio
+        self._versions = {}
+        # Portfolios notified of a change since their drift was computed
+        self._changed = set()
+        # Indexes of the stocks watched for each portfolio, and the
+        # portfolios watching each stock
+        self._stocks = {}
+        self._watchers = {}
+
+        for portfolio in portfolios:
+            self.add(portfolio)
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def __contains__(self, portfolio: Portfolio) -> bool:
+        return portfolio in self._positions
+
+    def _get_versions(self, portfolio: Portfolio) -> tuple:
+        return (portfolio._get_prices_version(),
+                portfolio.stocks_collection.version,
+                portfolio._allocation_version)
+
+    def add(self, portfolio: Portfolio) -> None:
+        '''
+        This method adds a portfolio to the scheduler.
+        '''
+        if portfolio in self._positions:
+            raise ValueError(
+                f"Portfolio {portfolio.name} is already scheduled.")
+        if portfolio.registry is not self.registry:
+            raise ValueError(
+                f"Portfolio {portfolio.name} belongs to another registry.")
+
+        self._observe(portfolio)
+        self._observe(portfolio.stocks_collection, portfolio)
+        self._watch_stocks(portfolio)
+
+        self._heap.append([portfolio.get_allocation_drift(), portfolio])
+        self._positions[portfolio] = len(self._heap) - 1
+        self._versions[portfolio] = self._get_versions(portfolio)
+        self._sift_up(len(self._heap) - 1)
+
+    def remove(self, portfolio: Portfolio) -> None:
+        '''
+        This method removes a portfolio from the scheduler.
+        '''
+        if portfolio not in self._positions:
+            raise ValueError(f"Portfolio {portfolio.name} is not scheduled.")
+
+        position = self._positions.pop(portfolio)
+        del self._versions[portfolio]
+        self._changed.discard(portfolio)
+        self._forget(portfolio)
+        self._forget(portfolio.stocks_collection)
+        self._watch_stocks(portfolio, set())
+        del self._stocks[portfolio]
+        last = self._heap.pop()
+        if position < len(self._heap):
+            self._heap[position] = last
+            self._positions[last[1]] = position
+            self._sift_up(position)
+            self._sift_down(self._positions[last[1]])
+
+    def update(self, portfolio: Portfolio) -> None:
+        '''
+        This method recomputes the drift of a portfolio if its holdings, its
+        allocation target or the prices changed, and moves it in the heap.
+        '''
+        self._changed.discard(portfolio)
+        versions = self._get_versions(portfolio)
+        if versions == self._versions[portfolio]:
+            return
+
+        # The portfolio may hold or target other stocks now
+        self._watch_stocks(portfolio)
+        position = self._positions[portfolio]
+        self._heap[position][0] = portfolio.get_allocation_drift()
+        self._versions[portfolio] = versions
+        self._sift_up(position)
+        self._sift_down(self._positions[portfolio])
+
+    def refresh(self) -> None:
+        '''
+        This method updates the drift of the portfolios notified of a change
+        since the last refresh. The rest of the portfolios are not visited.
+        '''
+        changed = self._changed
+        self._changed = set()
+        for portfolio in changed:
+            if portfolio in self._positions:
+                self.update(portfolio)
+
+    def _on_change(self, portfolio: Portfolio) -> None:
+        '''
+        This method is called after a change of the holdings or the
+        allocation target of a portfolio.
+        '''
+        self._changed.add(portfolio)
+
+    def _on_price_change(self, index: int, delta_price: float) -> None:
+        '''
+        This method is called by the holders index when the price of a stock
+        held or targeted by some portfolio changes.
+        '''
+        self._changed.update(self._watchers.get(index, ()))
+
+    def _observe(self, holder, key=None) -> None:
+        # The observers are replaced, not modified, so a notification that
+        # is being delivered meanwhile is not affected
+        key = holder if key is None else key
+        holder._observers = (holder._observers or ()) + ((self, key),)
+
+    def _forget(self, holder) -> None:
+        observers = tuple(observer for observer in holder._observers
+                          if observer[0] is not self)
+        holder._observers = observers or None
+
+    def _watch_stocks(self, portfolio: Portfolio,
+                      indexes: set[int] = None) -> None:
+        '''
+        This method registers the scheduler in the holders index for the
+        stocks that the portfolio holds or targets now (or for the given
+        indexes), and unregisters it from the stocks that no scheduled
+        portfolio uses anymore.
+        '''
+        if indexes is None:
+            collection = portfolio.stocks_collection
+            indexes = set(collection._price_idx[:collection._size].tolist())
+            indexes.update(portfolio._target_idx.tolist())
+        previous = self._stocks.get(portfolio, set())
+
+        holders = self.registry._holders
+        for index in indexes - previous:
+            watchers = self._watchers.setdefault(index, set())
+            if not watchers:
+                holders.add(index, self)
+            watchers.add(portfolio)
+        for index in previous - indexes:
+            watchers = self._watchers[index]
+            watchers.discard(portfolio)
+            if not watchers:
+                del self._watchers[index]
+                holders.discard(index, self)
+
+        self._stocks[portfolio] = indexes
+
+    def get_drift(self, portfolio: Portfolio) -> float:
+        self.refresh()
+        return self._heap[self._positions[portfolio]][0]
+
+    def get_over_threshold(self, threshold: float) -> list[Portfolio]:
+        '''
+        This method returns the portfolios whose drift is greater than the
+        threshold (e.g. 0.05 for 5%). Only the part of the heap above the
+        threshold is visited, after refreshing the changed portfolios.
+        '''
+        self.refresh()
+        portfolios = []
+        pending = [0] if self._heap else []
+        while pending:
+            position = pending.pop()
+            drift, portfolio = self._heap[position]
+            if drift <= threshold:
+                continue
+
+            portfolios.append(portfolio)
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self._heap):
+                    pending.append(child)
+
+        return portfolios
+
+    def get_top(self, n: int) -> list[tuple[Portfolio, float]]:
+        '''
+        This method returns the n most drifted portfolios with their drift,
+        from the largest drift to the smallest one, after refreshing the
+        changed portfolios.
+        '''
+        self.refresh()
+        top = []
+        candidates = [(-self._heap[0][0], 0)] if self._heap else []
+        while candidates and len(top) < n:
+            negative_drift, position = heapq.heappop(candidates)
+            top.append((self._heap[position][1], -negative_drift))
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(self._heap):
+                    heapq.heappush(candidates,
+                                   (-self._heap[child][0], child))
+
+        return top
+
+    def _swap(self, i: int, j: int) -> None:
+        heap = self._heap
+        heap[i], heap[j] = heap[j], heap[i]
+        self._positions[heap[i][1]] = i
+        self._positions[heap[j][1]] = j
+
+    def _sift_up(self, position: int) -> None:
+        while position > 0:
+            parent = (position - 1) // 2
+            if self._heap[parent][0] >= self._heap[position][0]:
+                break
+            self._swap(parent, position)
+            position = parent
+
+    def _sift_down(self, position: int) -> None:
+        size = len(self._heap)
+        while True:
+            largest = position
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < size and \
+                        self._heap[child][0] > self._heap[largest][0]:
+                    largest = child
+            if largest == position:
+                break
+            self._swap(position, largest)
+            position = largest
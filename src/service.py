@@ -0,0 +1,213 @@
+'''
+This module contains the asyncio layer of the library: PriceFeed, a consumer
+of a network price feed that updates a Stock registry, and PortfolioService,
+which answers valuation, deviation and rebalance queries from coroutines.
+
+The feed is a stream of lines "SYMBOL PRICE TIMESTAMP". The ticks are
+coalesced as in the ingestion module, and a window is also closed when the
+feed is quiet for window seconds, so the last prices of a burst are not held
+back until the next tick arrives.
+
+Every call of the service is answered without blocking the event loop for
+long: queries on one portfolio are a few vectorized operations, and queries
+on many portfolios yield to the event loop every chunk_size portfolios. A
+query on many portfolios pins one version of the prices at the start, so all
+its results use the same prices even if ticks are applied while it yields.
+'''
+
+from src.ingestion import TickCoalescer, apply_ticks_batch
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockRegistry
+import asyncio
+
+
+def parse_tick(line: bytes) -> tuple[str, float, float]:
+    '''
+    This function parses a line of the feed into a tick. It returns None if
+    the line is not a valid tick.
+    '''
+    fields = line.split()
+    if len(fields) != 3:
+        return None
+
+    try:
+        return fields[0].decode(), float(fields[1]), float(fields[2])
+    except (UnicodeDecodeError, ValueError):
+        return None
+
+
+class PriceFeed:
+    '''
+    This class consumes a price feed and applies the coalesced ticks to a
+    registry (the default registry if none is given).
+    '''
+    def __init__(self,
+                 registry: StockRegistry = None,
+                 window: float = 0.1,
+                 max_ticks: int = None,
+                 read_size: int = 65536):
+        if registry is None:
+            registry = Stock.default_registry
+
+        self.registry = registry
+        self.window = window
+        self.read_size = read_size
+        self._coalescer = TickCoalescer(window, max_ticks)
+        # Number of ticks read, ticks skipped and prices updated
+        self.ticks = 0
+        self.skipped = 0
+        self.updates = 0
+
+    def _apply(self, batch: dict[str: tuple[float, float]]) -> None:
+        if batch:
+            self.updates += apply_ticks_batch(batch, self.registry)
+
+    def _add_lines(self, lines: list[bytes]) -> None:
+        for line in lines:
+            tick = parse_tick(line)
+            if tick is None:
+                if line.strip():
+                    self.skipped += 1
+                continue
+
+            self.ticks += 1
+            self._apply(self._coalescer.add(*tick))
+
+    async def consume(self, reader: asyncio.StreamReader) -> int:
+        '''
+        This method reads the feed until it is closed and returns the number
+        of prices updated. The feed is read in blocks, so many ticks are
+        parsed for every wake up of the coroutine.
+        '''
+        pending = b''
+        while True:
+            try:
+                data = await asyncio.wait_for(
+                    reader.read(self.read_size), timeout=self.window)
+            except asyncio.TimeoutError:
+                # The feed is quiet, so the current window is closed
+                self._apply(self._coalescer.flush())
+                continue
+
+            if not data:
+                break
+
+            lines = (pending + data).split(b'\n')
+            # The last line is incomplete until its newline arrives
+            pending = lines.pop()
+            self._add_lines(lines)
+
+        self._add_lines([pending])
+        self._apply(self._coalescer.flush())
+        return self.updates
+
+    async def connect(self, host: str, port: int) -> int:
+        '''
+        This method connects to a feed server and consumes it until the
+        server closes the connection.
+        '''
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            return await self.consume(reader)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+
+class PortfolioService:
+    '''
+    This class holds portfolios by name and answers queries about them from
+    coroutines. All the portfolios must belong to the registry of the service.
+    '''
+    def __init__(self,
+                 registry: StockRegistry = None,
+                 chunk_size: int = 100):
+        if registry is None:
+            registry = Stock.default_registry
+
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be greater than zero")
+
+        self.registry = registry
+        self.chunk_size = chunk_size
+        self.portfolios = {}
+
+    def add_portfolio(self, portfolio: Portfolio) -> None:
+        '''
+        This method adds a portfolio to the service. A portfolio with the same
+        name is replaced.
+        '''
+        if portfolio.registry is not self.registry:
+            raise ValueError(
+                f"Portfolio {portfolio.name} belongs to another registry.")
+
+        self.portfolios[portfolio.name] = portfolio
+
+    def _get_portfolio(self, name: str) -> Portfolio:
+        if name not in self.portfolios:
+            raise ValueError(f"Portfolio {name} not found.")
+        return self.portfolios[name]
+
+    async def get_value(self, name: str) -> float:
+        '''
+        This method returns the value of a portfolio.
+        '''
+        return self._get_portfolio(name).stocks_collection.get_value()
+
+    async def get_deviation(self, name: str) -> dict[Stock: float]:
+        '''
+        This method returns the stocks qty deviation of a portfolio.
+        '''
+        return self._get_portfolio(name).get_stocks_qty_deviation()
+
+    async def rebalance(self, name: str) -> None:
+        '''
+        This method rebalances a portfolio.
+        '''
+        self._get_portfolio(name).rebalance()
+
+    async def _map(self, function, names: list[str] = None) -> dict:
+        '''
+        This method calls function(portfolio, snapshot) for the given
+        portfolios (all of them by default) with one pinned version of the
+        prices, yielding to the event loop every chunk_size portfolios.
+        '''
+        if names is None:
+            names = list(self.portfolios.keys())
+        portfolios = [self._get_portfolio(name) for name in names]
+
+        snapshot = self.registry.pin()
+        results = {}
+        for start in range(0, len(portfolios), self.chunk_size):
+            for portfolio in portfolios[start:start + self.chunk_size]:
+                results[portfolio.name] = function(portfolio, snapshot)
+            await asyncio.sleep(0)
+
+        return results
+
+    async def get_values(self, names: list[str] = None) -> dict[str: float]:
+        '''
+        This method returns the value of many portfolios.
+        '''
+        return await self._map(
+            lambda portfolio, snapshot:
+                portfolio.stocks_collection.get_value(snapshot),
+            names)
+
+    async def get_deviations(self, names: list[str] = None
+                             ) -> dict[str: dict[Stock: float]]:
+        '''
+        This method returns the stocks qty deviation of many portfolios.
+        '''
+        return await self._map(
+            lambda portfolio, snapshot:
+                portfolio.get_stocks_qty_deviation(snapshot),
+            names)
+
+    async def rebalance_all(self, names: list[str] = None) -> None:
+        '''
+        This method rebalances many portfolios.
+        '''
+        await self._map(
+            lambda portfolio, snapshot: portfolio.rebalance(snapshot),
+            names)
@@ -0,0 +1,187 @@
+'''
+This module implements a compact binary snapshot of the price universe. The
+file has four parts:
+
+    - A 32 bytes header: the magic bytes b'SPPS', the format version, the
+      number of stocks and the size of the symbols data.
+    - The prices, one float64 per stock.
+    - The offsets of each symbol in the symbols data, count + 1 uint64.
+    - The symbols, encoded in UTF-8 one after the other.
+
+The prices are right after the header, so they are aligned and can be read
+from a memory mapped file without copying them. Many processes can open the
+same snapshot and share the same pages of memory.
+
+Snapshots are written to a temporary file that replaces the destination when
+it is complete, so a reader never sees a partial snapshot.
+'''
+
+from src.catalog import compile_prices
+from src.stocks import Stock, StockRegistry, check_valid_prices
+import mmap
+import numpy as np
+import os
+import struct
+
+MAGIC = b'SPPS'
+VERSION = 1
+HEADER = struct.Struct('<4sIQQQ')
+
+
+class PriceSnapshot:
+    '''
+    This class is a read-only view of a snapshot file. The prices are a numpy
+    array backed by the memory mapped file, and the symbols are decoded only
+    when they are needed.
+    '''
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < HEADER.size:
+            raise ValueError(f"{path} is not a price snapshot")
+        magic, version, count, symbols_size, _ = HEADER.unpack_from(
+            self._mmap)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a price snapshot")
+        if version != VERSION:
+            raise ValueError(
+                f"Unsupported price snapshot version {version}")
+
+        offsets_start = HEADER.size + 8 * count
+        symbols_start = offsets_start + 8 * (count + 1)
+        if len(self._mmap) != symbols_start + symbols_size:
+            raise ValueError(f"{path} is a truncated price snapshot")
+
+        self.prices = np.frombuffer(self._mmap, dtype='<f8', count=count,
+                                    offset=HEADER.size)
+        self._offsets = np.frombuffer(self._mmap, dtype='<u8',
+                                      count=count + 1,
+                                      offset=offsets_start)
+        self._symbols_start = symbols_start
+        self._symbols = None
+
+        # The stocks are created one at a time by load_into_registry, so the
+        # prices are checked here to never leave a partial load
+        try:
+            check_valid_prices(self.prices)
+        except ValueError:
+            self.close()
+            raise
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    @property
+    def symbols(self) -> list[str]:
+        '''
+        This property returns the symbols of the snapshot, in the same order
+        as the prices.
+        '''
+        if self._symbols is None:
+            start = self._symbols_start
+            data = self._mmap[start:start + int(self._offsets[-1])]
+            bounds = self._offsets.tolist()
+            self._symbols = [data[begin:end].decode('utf-8')
+                             for begin, end in zip(bounds[:-1], bounds[1:])]
+
+        return self._symbols
+
+    def to_dict(self) -> dict[str: float]:
+        return dict(zip(self.symbols, self.prices.tolist()))
+
+    def load_into_registry(self, registry: StockRegistry = None) -> None:
+        '''
+        This method creates the stocks of the snapshot that do not exist in
+        the registry (the default registry if none is given) and updates the
+        prices of the others with one bulk update.
+        '''
+        if registry is None:
+            registry = Stock.default_registry
+
+        existing_symbols = []
+        existing_prices = []
+        for symbol, price in zip(self.symbols, self.prices.tolist()):
+            if registry.exists_instance(symbol):
+                existing_symbols.append(symbol)
+                existing_prices.append(price)
+            else:
+                Stock(symbol, price, registry=registry)
+
+        if existing_symbols:
+            registry.update_prices((existing_symbols, existing_prices))
+
+    def close(self) -> None:
+        '''
+        This method releases the memory map. The snapshot cannot be used
+        after closing it.
+        A memory map cannot be closed while a numpy view of it is alive, so
+        if the caller still holds the prices array the map is only released
+        by the snapshot, and it is unmapped when the last view is deleted.
+        The views held by the caller stay valid until then.
+        '''
+        if self._mmap is None:
+            return
+
+        self.prices = None
+        self._offsets = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+        self._mmap = None
+
+
+def write_snapshot(path: str, symbols: list[str], prices) -> None:
+    '''
+    This function writes a snapshot file atomically.
+    '''
+    prices = np.ascontiguousarray(prices, dtype='<f8')
+    if len(symbols) != len(prices):
+        raise ValueError("Symbols and prices must have the same length")
+    check_valid_prices(prices)
+
+    encoded = [symbol.encode('utf-8') for symbol in symbols]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    np.cumsum([len(symbol) for symbol in encoded], out=offsets[1:])
+    symbols_data = b''.join(encoded)
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(prices),
+                                len(symbols_data), 0))
+            f.write(prices.tobytes())
+            f.write(offsets.tobytes())
+            f.write(symbols_data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def write_registry_snapshot(path: str, registry: StockRegistry = None
+                            ) -> None:
+    '''
+    This function writes a snapshot with the prices of every stock in the
+    registry (the default registry if none is given).
+    '''
+    if registry is None:
+        registry = Stock.default_registry
+    with registry._lock:
+        symbols = [stock.symbol for stock in registry._by_index]
+        prices = registry._book.copy()[1]
+    write_snapshot(path, symbols, prices)
+
+
+def convert_yaml(stocks_file: str, path: str) -> None:
+    '''
+    This function converts a stocks YAML file (like data/stocks.yaml) into a
+    snapshot file.
+    '''
+    with open(stocks_file, 'rb') as f:
+        prices = compile_prices(f.read())
+
+    write_snapshot(path, list(prices.keys()), list(prices.values()))
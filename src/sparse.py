@@ -0,0 +1,376 @@
+'''
+This module contains the SparseBook class, a version of PortfolioBook for
+large universes of stocks. When there are tens of thousands of symbols and
+each portfolio holds a few dozens, the (portfolios x stocks) matrices of
+PortfolioBook are almost all zeros, so the holdings and the allocation
+targets are stored in compressed sparse rows (CSR) instead: for each
+portfolio only the indexes of its stocks and their values are kept, and the
+memory grows with the number of positions instead of the number of symbols.
+
+The columns are the indexes of the stocks in the registry, as in
+PortfolioBook, and the valuation, the exposures and the deviations are
+computed over all the positions of the book at once.
+'''
+
+from src.portfolio import Portfolio
+from src.stocks import Stock, StockCollection, StockRegistry, PriceVersion
+import numpy as np
+
+
+class CSRMatrix:
+    '''
+    This class is a minimal sparse matrix in compressed sparse rows format.
+    The columns of row i are indices[indptr[i]:indptr[i + 1]], sorted, and
+    their values are in the same positions of data.
+    '''
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray,
+                 data: np.ndarray):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.data = np.asarray(data, dtype=float)
+        self._row_ids = None
+
+    def __len__(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def nnz(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def from_rows(cls, rows: list[tuple[np.ndarray, np.ndarray]]
+                  ) -> 'CSRMatrix':
+        '''
+        This method creates a matrix from the (columns, values) arrays of
+        each row. The columns of each row must be sorted.
+        '''
+        sizes = np.fromiter((len(columns) for columns, _ in rows),
+                            dtype=np.int64, count=len(rows))
+        indptr = np.concatenate(([0], np.cumsum(sizes)))
+        indices = np.concatenate([columns for columns, _ in rows] +
+                                 [np.zeros(0, dtype=np.int32)])
+        data = np.concatenate([values for _, values in rows] +
+                              [np.zeros(0)])
+        return cls(indptr, indices, data)
+
+    @classmethod
+    def from_coo(cls, rows: np.ndarray, columns: np.ndarray,
+                 values: np.ndarray, n_rows: int) -> 'CSRMatrix':
+        '''
+        This method creates a matrix from (row, column, value) triplets in
+        any order. The values of repeated entries are added.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = np.asarray(columns, dtype=np.int64)
+        # The entries are sorted by a single key. The stable sort (timsort)
+        # merges runs that are already sorted in linear time, so stacking
+        # the entries of two CSR matrices is cheap.
+        n_columns = int(columns.max()) + 1 if len(columns) else 0
+        keys = rows * n_columns + columns
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        values = np.asarray(values, dtype=float)[order]
+
+        # The first entry of every (row, column) pair
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        starts = np.flatnonzero(first)
+        data = np.add.reduceat(values, starts) if len(starts) else values
+        keys = keys[starts]
+
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // max(n_columns, 1), minlength=n_rows),
+                  out=indptr[1:])
+        return cls(indptr, keys % max(n_columns, 1), data)
+
+    @classmethod
+    def from_collections(cls, collections: list[StockCollection]
+                         ) -> 'CSRMatrix':
+        '''
+        This method creates a matrix with the quantities of each collection
+        as a row. The columns of the collections are already sorted.
+        '''
+        return cls.from_rows([(collection._price_idx[:collection._size],
+                               collection._qty[:collection._size])
+                              for collection in collections])
+
+    def get_row(self, row: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        This method returns the columns and the values of a row, as views.
+        '''
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def get_rows(self, start: int, end: int) -> 'CSRMatrix':
+        '''
+        This method returns the rows from start to end (excluded) as a new
+        matrix. The columns and the values are views of this matrix.
+        '''
+        first, last = self.indptr[start], self.indptr[end]
+        return CSRMatrix(self.indptr[start:end + 1] - first,
+                         self.indices[first:last], self.data[first:last])
+
+    def get_collection(self, row: int,
+                       registry: StockRegistry = None) -> StockCollection:
+        '''
+        This method returns a row as a StockCollection, with the columns as
+        the indexes of the stocks in the registry.
+        '''
+        return StockCollection._from_arrays(*self.get_row(row), registry)
+
+    def get_row_ids(self) -> np.ndarray:
+        '''
+        This method returns the row of every stored entry.
+        '''
+        if self._row_ids is None:
+            self._row_ids = np.repeat(np.arange(len(self), dtype=np.int64),
+                                      np.diff(self.indptr))
+        return self._row_ids
+
+    def sum_rows(self, values: np.ndarray) -> np.ndarray:
+        '''
+        This method adds, for each row, the given values of its entries.
+        '''
+        return np.bincount(self.get_row_ids(), weights=values,
+                           minlength=len(self))
+
+    def dot(self, vector: np.ndarray) -> np.ndarray:
+        '''
+        This method returns the product of the matrix by a dense vector with
+        one value per column.
+        '''
+        return self.sum_rows(self.data * vector[self.indices])
+
+    def vstack(self, other: 'CSRMatrix') -> 'CSRMatrix':
+        '''
+        This method returns a matrix with the rows of other after the rows of
+        this matrix.
+        '''
+        return CSRMatrix.from_blocks([self, other])
+
+    @classmethod
+    def from_blocks(cls, blocks: list['CSRMatrix']) -> 'CSRMatrix':
+        '''
+        This method creates a matrix with the rows of each block after the
+        rows of the previous ones.
+        '''
+        offsets = np.cumsum([0] + [block.nnz for block in blocks])
+        return cls(
+            np.concatenate([[0]] + [block.indptr[1:] + offset for block, offset
+                                    in zip(blocks, offsets.tolist())]),
+            np.concatenate([block.indices for block in blocks] +
+                           [np.zeros(0, dtype=np.int32)]),
+            np.concatenate([block.data for block in blocks] + [np.zeros(0)]))
+
+    def to_dense(self, columns: int) -> np.ndarray:
+        dense = np.zeros((len(self), columns))
+        dense[self.get_row_ids(), self.indices] = self.data
+        return dense
+
+
+def compute_qty_target(holdings: CSRMatrix, targets: CSRMatrix,
+                       held_prices: np.ndarray,
+                       target_prices: np.ndarray) -> CSRMatrix:
+    '''
+    This function returns the target quantity of each stock of every
+    portfolio, given the quantities of the holdings, the weights of the
+    allocation targets and the price of each of their entries.
+    '''
+    values = holdings.sum_rows(holdings.data * held_prices)
+    return CSRMatrix(targets.indptr, targets.indices,
+                     targets.data * values[targets.get_row_ids()] /
+                     target_prices)
+
+
+def compute_qty_deviation(holdings: CSRMatrix, targets: CSRMatrix,
+                          held_prices: np.ndarray,
+                          target_prices: np.ndarray,
+                          target_qty: CSRMatrix = None) -> CSRMatrix:
+    '''
+    This function returns the target quantity minus the current quantity of
+    every portfolio, with the same arguments as compute_qty_target (or the
+    target quantities if they are already computed). Each row has the stocks
+    in the allocation target or in the holdings of the portfolio, as
+    Portfolio.get_stocks_qty_deviation.
+    '''
+    if target_qty is None:
+        target_qty = compute_qty_target(holdings, targets, held_prices,
+                                        target_prices)
+    return CSRMatrix.from_coo(
+        np.concatenate((targets.get_row_ids(), holdings.get_row_ids())),
+        np.concatenate((targets.indices, holdings.indices)),
+        np.concatenate((target_qty.data, -holdings.data)),
+        len(holdings))
+
+
+class SparseBook:
+    '''
+    This class stores the holdings and the allocation targets of many
+    portfolios as sparse rows. It gives the same values, deviations and
+    rebalances as the Portfolio class and PortfolioBook, using memory only
+    for the positions of each portfolio.
+    '''
+    def __init__(self, portfolios: list[Portfolio] = (),
+                 registry: StockRegistry = None):
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
+        self.names = []
+        self.holdings = CSRMatrix.from_rows([])
+        self.targets = CSRMatrix.from_rows([])
+
+        self.add_portfolios(portfolios)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @classmethod
+    def _from_arrays(cls, names: list[str], holdings: CSRMatrix,
+                     targets: CSRMatrix,
+                     registry: StockRegistry = None) -> 'SparseBook':
+        '''
+        This method creates a book from its sparse matrices. The columns must
+        be the indexes of the stocks in the registry, and the targets of each
+        row must be a valid allocation.
+        '''
+        book = cls(registry=registry)
+        book.names = list(names)
+        book.holdings = holdings
+        book.targets = targets
+        return book
+
+    def add_portfolios(self, portfolios: list[Portfolio]) -> None:
+        '''
+        This method adds the holdings and the allocation target of each
+        portfolio as new rows of the book.
+        '''
+        portfolios = list(portfolios)
+        for portfolio in portfolios:
+            if portfolio.registry is not self.registry:
+                raise ValueError(
+                    f"Portfolio {portfolio.name} belongs to another registry.")
+
+        self.holdings = self.holdings.vstack(CSRMatrix.from_collections(
+            [portfolio.stocks_collection for portfolio in portfolios]))
+        self.targets = self.targets.vstack(CSRMatrix.from_rows(
+            [(portfolio._target_idx, portfolio._target_weights)
+             for portfolio in portfolios]))
+        self.names.extend(portfolio.name for portfolio in portfolios)
+
+    def add_portfolio(self, portfolio: Portfolio) -> int:
+        '''
+        This method adds one portfolio to the book and returns its row.
+        '''
+        self.add_portfolios([portfolio])
+        return len(self.names) - 1
+
+    def get_values(self, snapshot: PriceVersion = None) -> np.ndarray:
+        '''
+        This method returns the total value of each portfolio.
+        '''
+        holdings = self.holdings
+        prices = self.registry._gather(holdings.indices, snapshot)
+        return holdings.sum_rows(holdings.data * prices)
+
+    def get_exposures(self, snapshot: PriceVersion = None,
+                      target: bool = False) -> dict[Stock: float]:
+        '''
+        This method returns the value held of each stock across the whole
+        book. With target=True it returns the value each stock would have if
+        every portfolio met its allocation target.
+        '''
+        if target:
+            targets = self.targets
+            columns = targets.indices
+            values = targets.data * self.get_values(snapshot)[
+                targets.get_row_ids()]
+        else:
+            columns = self.holdings.indices
+            values = self.holdings.data * \
+                self.registry._gather(columns, snapshot)
+
+        exposures = np.bincount(columns, weights=values,
+                                minlength=len(self.registry))
+        held = np.flatnonzero(exposures)
+        by_index = self.registry._by_index
+        return {by_index[index]: value for index, value
+                in zip(held.tolist(), exposures[held].tolist())}
+
+    def get_stocks_qty_target(self, snapshot: PriceVersion = None
+                              ) -> CSRMatrix:
+        '''
+        This method returns the target quantity of each stock in each
+        portfolio, calculated from its allocation target and its total value.
+        '''
+        holdings = self.holdings
+        targets = self.targets
+        return compute_qty_target(
+            holdings, targets,
+            self.registry._gather(holdings.indices, snapshot),
+            self.registry._gather(targets.indices, snapshot))
+
+    def get_qty_deviation(self, snapshot: PriceVersion = None) -> CSRMatrix:
+        '''
+        This method returns the target quantity minus the current quantity.
+        Each row has the stocks in the allocation target or in the holdings
+        of the portfolio, as Portfolio.get_stocks_qty_deviation.
+        '''
+        holdings = self.holdings
+        targets = self.targets
+        return compute_qty_deviation(
+            holdings, targets,
+            self.registry._gather(holdings.indices, snapshot),
+            self.registry._gather(targets.indices, snapshot))
+
+    def get_trades(self, snapshot: PriceVersion = None
+                   ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        '''
+        This method returns the trade list of the whole book as three arrays:
+        the row of the portfolio, the index of the stock and the quantity to
+        buy (positive) or sell (negative).
+        '''
+        deviation = self.get_qty_deviation(snapshot)
+        return deviation.get_row_ids(), deviation.indices, deviation.data
+
+    def get_stocks_qty_deviation(self, row: int,
+                                 snapshot: PriceVersion = None
+                                 ) -> dict[Stock: float]:
+        '''
+        This method returns the deviation of one portfolio with the same format
+        as Portfolio.get_stocks_qty_deviation.
+        '''
+        held_idx, held_qty = self.holdings.get_row(row)
+        target_idx, target_weights = self.targets.get_row(row)
+        value = float(held_qty @ self.registry._gather(held_idx, snapshot))
+
+        columns = np.union1d(held_idx, target_idx)
+        deviation = np.zeros(len(columns))
+        deviation[np.searchsorted(columns, target_idx)] = \
+            target_weights * value / self.registry._gather(target_idx,
+                                                           snapshot)
+        deviation[np.searchsorted(columns, held_idx)] -= held_qty
+
+        by_index = self.registry._by_index
+        return {by_index[column]: qty for column, qty
+                in zip(columns.tolist(), deviation.tolist())}
+
+    def rebalance(self, snapshot: PriceVersion = None) -> None:
+        '''
+        This method rebalances every portfolio of the book to meet its target
+        allocation, as Portfolio.rebalance does: the stocks that are not in
+        the target are sold.
+        '''
+        self.holdings = self.get_stocks_qty_target(snapshot)
+
+    def get_portfolio(self, row: int) -> Portfolio:
+        '''
+        This method returns a Portfolio with the holdings and the allocation
+        target stored in the given row.
+        '''
+        return Portfolio._from_arrays(self.names[row],
+                                      *self.targets.get_row(row),
+                                      *self.holdings.get_row(row),
+                                      self.registry)
+
+    def get_portfolios(self) -> list[Portfolio]:
+        return [self.get_portfolio(row) for row in range(len(self))]
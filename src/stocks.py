@@ -6,6 +6,36 @@ The Stock class has a class variable where are listed all instances of stocks
 to ensure that only one instance of each stock exists. This is useful for
 managing stock prices and ensuring that the same stock is not duplicated in the
 portfolio and also avoid having one stock with different prices.
+The prices themselves are stored in a PriceBook, one contiguous array shared by
+all the stocks, so many prices can be updated at once with
+Stock.update_prices.
+
+Collections and portfolios can also be registered in a reverse index from each
+stock to its holders (see HoldersIndex). When a price changes only the
+registered holders of that stock are notified and revalued.
+
+Each stock has a dense integer index: its position in the price book, which is
+also its id in the Stock symbol table. Symbols are normalized only when they
+enter the system (Stock, exists_instance, set_stock_qty); everything else,
+including the rows of the collections, works with the indexes.
+
+The instances, the price book, the symbol table and the holders index live in
+a StockRegistry. There is a default registry used when none is given, and
+separate registries can be created to keep independent price universes (e.g.
+live and simulated prices) in the same process. Stocks, collections and
+portfolios are bound to the registry they were created with.
+A registry can be shared between threads: creating stocks and updating prices
+is serialized by the registry lock, while reading prices takes no lock. The
+price book is a sequence lock, so a reader that overlaps with a price update
+retries its read instead of seeing half of a batch. Collections and portfolios
+themselves must be modified by one thread at a time.
+
+For longer calculations a reader can pin a PriceVersion (StockRegistry.pin),
+an immutable copy of all the prices at one version of the price book. The
+valuation methods of collections and portfolios take it as an optional
+snapshot argument, so every price of the calculation comes from the same
+version. The registry only keeps the latest version, the older ones are
+released as soon as no reader uses them.
 
 The StockCollection class is used to manage a collection of stocks. It allows
 to create a collection of stocks from a dictionary of stock symbols and
@@ -13,41 +43,428 @@ quantities or from a dictionary of stock symbols, allocations and total value.
 I decided to implement this class to make it easier to manage a collection of
 stocks and to provide a way to calculate the total value of the collection
 and the allocation of each stock in the collection.
+
+Collections are stored in columns: a dense array with the quantities and a
+dense array with the index of each stock in the price book. That way
+the value and the allocation of a collection are computed with a single numpy
+operation instead of looping over the stocks. The Holdings class exposes those
+columns with the same interface as the dictionary used before.
+The rows are sorted by the index of the stock, so a stock is found with a
+binary search and a position costs 12 bytes (a 32 bit index and a float
+quantity) without any Python object per position. Stock, StockCollection and
+Portfolio use __slots__, as millions of them can be kept in memory.
 '''
 
+from bisect import bisect_left
+from collections.abc import Mapping, MutableMapping
+from src.symbols import SymbolTable
 from src.utils import get_valid_symbol, check_valid_allocation
+import numpy as np
 import math
+import threading
+import time
+import weakref
+
+
+class PriceBook:
+    '''
+    This class stores the prices of all the registered stocks in one
+    contiguous numpy array. Each stock owns the position given by its index,
+    so prices can be read and updated in bulk with array operations.
+    '''
+    def __init__(self, capacity: int = 16):
+        self._prices = np.zeros(capacity)
+        self._size = 0
+        # The version increases every time a price changes, so the
+        # collections know when their cached value is outdated.
+        self.version = 0
+        # The sequence is odd while a write is in progress. Readers use it to
+        # detect that they overlapped with a write (see gather).
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def prices(self) -> np.ndarray:
+        '''
+        This property returns a view of the prices of the registered stocks.
+        '''
+        return self._prices[:self._size]
+
+    def add(self, price: float) -> int:
+        '''
+        This method stores the price of a new stock and returns its index.
+        '''
+        if self._size == len(self._prices):
+            # Double the capacity of the array when it is full
+            self._prices = np.concatenate(
+                (self._prices, np.zeros(len(self._prices))))
+
+        index = self._size
+        self._prices[index] = price
+        self._size += 1
+        return index
+
+    def get(self, index: int) -> float:
+        return float(self._prices[index])
+
+    def gather(self, indexes: np.ndarray) -> np.ndarray:
+        '''
+        This method returns a copy of the prices in the given indexes without
+        taking any lock. If a write happened while copying, the copy is
+        discarded and taken again, so the result never mixes prices from
+        before and after a batch update.
+        '''
+        while True:
+            sequence = self._sequence
+            if sequence % 2 == 0:
+                prices = self._prices[indexes]
+                if sequence == self._sequence:
+                    return prices
+            # Let the writer finish before trying again
+            time.sleep(0)
+
+    def copy(self) -> tuple[int, np.ndarray]:
+        '''
+        This method returns the version of the book and a copy of all its
+        prices, read consistently as in gather.
+        '''
+        while True:
+            sequence = self._sequence
+            if sequence % 2 == 0:
+                version = self.version
+                prices = self._prices[:self._size].copy()
+                if sequence == self._sequence:
+                    return version, prices
+            time.sleep(0)
+
+    def set(self, index: int, price: float) -> None:
+        self._sequence += 1
+        self._prices[index] = price
+        self.version += 1
+        self._sequence += 1
+
+    def set_many(self, indexes: np.ndarray, prices: np.ndarray) -> None:
+        '''
+        This method updates the prices in the given indexes. The prices must
+        be validated before calling it.
+        '''
+        self._sequence += 1
+        self._prices[indexes] = prices
+        self.version += 1
+        self._sequence += 1
+
+
+class HoldersIndex:
+    '''
+    This class is a reverse index from each stock (by its index in the price
+    book) to the objects that hold it. The holders are stored as weak
+    references, so the index never keeps a dead collection or portfolio
+    alive. Each holder must implement _on_price_change(index, delta_price).
+    The holders can be added and removed from any thread.
+    '''
+    def __init__(self):
+        self._holders = {}
+        # Reentrant, because a weak reference callback can run while the
+        # same thread holds the lock
+        self._lock = threading.RLock()
+
+    def add(self, index: int, holder) -> None:
+        key = id(holder)
+        with self._lock:
+            holders = self._holders.setdefault(index, {})
+            if key not in holders:
+                holders[key] = weakref.ref(
+                    holder, lambda ref: self._forget(index, key))
+
+    def discard(self, index: int, holder) -> None:
+        self._forget(index, id(holder))
+
+    def _forget(self, index: int, key: int) -> None:
+        with self._lock:
+            holders = self._holders.get(index)
+            if holders is not None:
+                holders.pop(key, None)
+                if not holders:
+                    del self._holders[index]
+
+    def get_holders(self, index: int) -> list:
+        '''
+        This method returns the alive holders of the stock in the given index.
+        '''
+        with self._lock:
+            refs = list(self._holders.get(index, {}).values())
+        return [holder for holder in (ref() for ref in refs)
+                if holder is not None]
+
+    def notify(self, indexes, delta_prices) -> None:
+        '''
+        This method notifies the holders of each stock about the change of
+        its price. Stocks without holders are skipped.
+        '''
+        for index, delta_price in zip(indexes, delta_prices):
+            if index in self._holders:
+                for holder in self.get_holders(index):
+                    holder._on_price_change(index, delta_price)
+
+
+def check_valid_prices(prices: np.ndarray) -> None:
+    '''
+    This function checks that all the prices of a batch are valid, so the
+    batch is applied completely or not at all.
+    '''
+    if not np.all(np.isfinite(prices)):
+        raise ValueError("Prices must be finite numbers")
+
+    if not np.all(prices > 0):
+        raise ValueError("Price must be greater than zero")
+
+
+class PriceVersion:
+    '''
+    This class is an immutable copy of the prices of a registry at one
+    version of its price book. It is created by StockRegistry.pin and can be
+    shared between threads, as it never changes.
+    '''
+    def __init__(self, registry: 'StockRegistry', version: int,
+                 prices: np.ndarray):
+        prices.flags.writeable = False
+        self.registry = registry
+        self.version = version
+        self.prices = prices
+
+    def __len__(self) -> int:
+        return len(self.prices)
+
+    def get(self, stock) -> float:
+        '''
+        This method returns the price of a stock (or its symbol) in this
+        version.
+        '''
+        index = self.registry._get_index(stock)
+        if index >= len(self.prices):
+            raise ValueError(f"Stock {stock} was created after the snapshot.")
+        return float(self.prices[index])
+
+    def gather(self, indexes: np.ndarray) -> np.ndarray:
+        '''
+        This method returns the prices in the given indexes.
+        '''
+        if len(indexes) and indexes.max() >= len(self.prices):
+            raise ValueError("Some stocks were created after the snapshot.")
+        return self.prices[indexes]
+
+
+class StockRegistry:
+    '''
+    This class holds a universe of stocks: their instances, the price book,
+    the symbol table and the holders index. Each registry is independent, so
+    the same symbol can have a different price in two registries.
+    Creating stocks and updating prices is serialized by the registry lock.
+    Reading prices does not take the lock (see PriceBook.gather).
+    '''
+    def __init__(self):
+        # Instances of the stocks by their symbol and by their index
+        self._instances = {}
+        self._by_index = []
+        # Interned symbols, the id of each symbol is the index of its stock
+        self._symbols = SymbolTable()
+        # Prices of all the stocks, each stock reads the position given by
+        # its index
+        self._book = PriceBook()
+        # Reverse index from each stock to the collections and portfolios
+        # that hold it
+        self._holders = HoldersIndex()
+        # Reentrant, because creating a stock that already exists updates
+        # its price while holding the lock
+        self._lock = threading.RLock()
+        # Last PriceVersion pinned, shared by the readers of that version
+        self._latest = None
+
+    def __len__(self) -> int:
+        return len(self._by_index)
+
+    def exists_instance(self, symbol: str) -> bool:
+        '''
+        This method checks if a stock with the given symbol exists in the
+        registry.
+        '''
+        return self._symbols.get_id(symbol) is not None
+
+    def get_by_index(self, index: int) -> 'Stock':
+        '''
+        This method returns the stock stored in the given index of the price
+        book.
+        '''
+        return self._by_index[index]
+
+    def pin(self) -> PriceVersion:
+        '''
+        This method returns an immutable copy of the current prices. The copy
+        is made only once per version, and the writers never wait for it.
+        '''
+        latest = self._latest
+        if latest is not None and latest.version == self._book.version and \
+                len(latest) == len(self._book):
+            return latest
+
+        version, prices = self._book.copy()
+        latest = PriceVersion(self, version, prices)
+        self._latest = latest
+        return latest
+
+    def _gather(self, indexes: np.ndarray,
+                snapshot: PriceVersion = None) -> np.ndarray:
+        '''
+        This method returns the prices in the given indexes, from the snapshot
+        if it is given or else from the live price book.
+        '''
+        if snapshot is None:
+            return self._book.gather(indexes)
+
+        if snapshot.registry is not self:
+            raise ValueError("The snapshot belongs to another registry.")
+        return snapshot.gather(indexes)
+
+    def _get_index(self, stock) -> int:
+        '''
+        This method returns the index of a stock given the instance or its
+        symbol.
+        '''
+        if isinstance(stock, Stock):
+            if stock.registry is not self:
+                raise ValueError(
+                    f"Stock {stock.symbol} belongs to another registry.")
+            return stock.index
+
+        index = self._symbols.get_id(stock)
+        if index is None:
+            raise ValueError(f"Stock {stock} not found.")
+        return index
+
+    def _add(self, stock: 'Stock') -> None:
+        '''
+        This method registers a new stock. It must be called with the lock
+        held. The symbol is interned last, so readers that find the symbol
+        also find the stock.
+        '''
+        self._instances[stock.symbol] = stock
+        self._by_index.append(stock)
+        self._symbols.intern(stock.symbol)
+
+    def update_prices(self, prices) -> None:
+        '''
+        This method updates the prices of many stocks at once. It receives a
+        dictionary with the stock (or its symbol) as the key and the price as
+        the value, or a tuple (stocks, prices) of two sequences. The stocks
+        sequence can also be an array with the stock indexes.
+        The whole batch is validated before updating any price.
+        '''
+        if isinstance(prices, Mapping):
+            keys = list(prices.keys())
+            values = list(prices.values())
+        else:
+            keys, values = prices
+
+        values = np.asarray(values, dtype=float)
+        if isinstance(keys, np.ndarray) and keys.dtype.kind in 'iu':
+            indexes = keys
+            if np.any((indexes < 0) | (indexes >= len(self._book))):
+                raise ValueError("Stock index out of range")
+        else:
+            indexes = np.fromiter(
+                (self._get_index(key) for key in keys),
+                dtype=np.intp, count=len(keys))
+
+        if len(indexes) != len(values):
+            raise ValueError("Stocks and prices must have the same length")
+
+        check_valid_prices(values)
+
+        # If a stock is repeated in the batch only its last price is kept
+        unique_indexes, last = np.unique(indexes[::-1], return_index=True)
+        if len(unique_indexes) < len(indexes):
+            indexes = unique_indexes
+            values = values[::-1][last]
+
+        with self._lock:
+            delta_prices = values - self._book.prices[indexes]
+            self._book.set_many(indexes, values)
+            self._holders.notify(indexes.tolist(), delta_prices.tolist())
+
+    def update_price(self, index: int, price: float) -> None:
+        '''
+        This method updates the price of the stock in the given index.
+        '''
+        with self._lock:
+            delta_price = price - self._book.get(index)
+            self._book.set(index, price)
+            self._holders.notify((index,), (delta_price,))
 
 
 class Stock:
     '''
     This class represents a stock with a symbol and price.It is implemented as
-    a Singleton to ensure only one instance of each stock exists.
+    a Singleton to ensure only one instance of each stock exists in each
+    registry.
     '''
+    __slots__ = ('registry', 'index', 'symbol')
+
+    # Registry used when no registry is given
+    default_registry = StockRegistry()
 
-    # This class variable holds the instances of the stocks
-    _instances = {}
+    # The contents of the default registry, kept as class variables for the
+    # code that works with the default registry directly
+    _instances = default_registry._instances
+    _by_index = default_registry._by_index
+    _symbols = default_registry._symbols
+    _book = default_registry._book
+    _holders = default_registry._holders
 
     @classmethod
-    def exists_instance(cls, symbol: str) -> bool:
+    def exists_instance(cls, symbol: str,
+                        registry: StockRegistry = None) -> bool:
         '''
         This method checks if an instance of the stock with the given symbol
         already exists.
         '''
-        symbol = get_valid_symbol(symbol)
-        return symbol in cls._instances
+        if registry is None:
+            registry = cls.default_registry
+        return registry.exists_instance(symbol)
+
+    @classmethod
+    def update_prices(cls, prices, registry: StockRegistry = None) -> None:
+        '''
+        This method updates the prices of many stocks at once. See
+        StockRegistry.update_prices.
+        '''
+        if registry is None:
+            registry = cls.default_registry
+        registry.update_prices(prices)
+
+    @classmethod
+    def _get_index(cls, stock) -> int:
+        '''
+        This method returns the index of a stock of the default registry given
+        the instance or its symbol.
+        '''
+        return cls.default_registry._get_index(stock)
 
-    def __new__(cls, symbol: str, price: float = None):
+    def __new__(cls, symbol: str, price: float = None,
+                registry: StockRegistry = None):
         '''
         This method is called every time a new instance of the class is created.
         It checks if an instance with the same symbol already exists.
         If it does, it returns the existing instance.
         '''
-        symbol = get_valid_symbol(symbol)
+        if registry is None:
+            registry = cls.default_registry
+        index = registry._symbols.get_id(symbol)
 
         # If the stock already exists, return the existing instance
-        if cls.exists_instance(symbol):
-            stock = cls._instances[symbol]
+        if index is not None:
+            stock = registry._by_index[index]
 
             # If the price is provided update the existing instance.
             if price is not None:
@@ -60,25 +477,53 @@ class Stock:
                 f'''Stock {symbol} not found. Price must be provided to create
                 a new instance.''')
 
-        # If the stock does not exist, create a new instance and store it in
-        # the class variable
-        stock = super(Stock, cls).__new__(cls)
-        stock._initialize(symbol, price)
-        cls._instances[symbol] = stock
+        with registry._lock:
+            # Another thread could have created the stock while this one was
+            # waiting for the lock
+            if registry.exists_instance(symbol):
+                return cls(symbol, price, registry)
+
+            # If the stock does not exist, create a new instance and store it
+            # in the registry
+            stock = super(Stock, cls).__new__(cls)
+            stock._initialize(symbol, price, registry)
+            registry._add(stock)
         return stock
 
-    def _initialize(self, symbol: str, price: float):
+    @classmethod
+    def get_by_index(cls, index: int,
+                     registry: StockRegistry = None) -> 'Stock':
+        '''
+        This method returns the stock stored in the given index of the price
+        book.
+        '''
+        if registry is None:
+            registry = cls.default_registry
+        return registry._by_index[index]
+
+    def _initialize(self, symbol: str, price: float,
+                    registry: StockRegistry):
         '''
         This method initializes the instance with the symbol and price.
         It is called only once when the instance is created.
         '''
+        symbol = get_valid_symbol(symbol)
+
         # If the price is not valid, raise an error
         if price <= 0:
             raise ValueError("Price must be greater than zero")
 
-        self.price = price
+        self.registry = registry
+        self.index = registry._book.add(price)
         self.symbol = symbol
 
+    @property
+    def price(self) -> float:
+        '''
+        This property returns the price of the stock stored in the price book.
+        '''
+        return self.registry._book.get(self.index)
+
     def update_price(self, price: float):
         '''
         This method updates the price of the stock.
@@ -87,7 +532,47 @@ class Stock:
         if price <= 0:
             raise ValueError("Price must be greater than zero")
 
-        self.price = price
+        self.registry.update_price(self.index, price)
+
+
+class Holdings(MutableMapping):
+    '''
+    This class is a dictionary-like view of the quantities stored in a
+    StockCollection. It maps each Stock to its quantity, so the code that used
+    the collection as a dictionary keeps working on top of the columns.
+    '''
+    __slots__ = ('_collection',)
+
+    def __init__(self, collection: 'StockCollection'):
+        self._collection = collection
+
+    def __getitem__(self, stock: Stock) -> float:
+        collection = self._collection
+        row = collection._find(stock.index) if collection._owns(stock) \
+            else None
+        if row is None:
+            raise KeyError(stock)
+        return float(collection._qty[row])
+
+    def __setitem__(self, stock: Stock, quantity: float) -> None:
+        self._collection._set_qty(stock, quantity)
+
+    def __delitem__(self, stock: Stock) -> None:
+        self._collection._remove(stock)
+
+    def __contains__(self, stock) -> bool:
+        collection = self._collection
+        return collection._owns(stock) and \
+            collection._find(stock.index) is not None
+
+    def __iter__(self):
+        return iter(self._collection._get_stocks())
+
+    def __len__(self) -> int:
+        return self._collection._size
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
 
 
 class StockCollection:
@@ -99,17 +584,69 @@ class StockCollection:
     The class also provides methods modify the collection of stocks and
     calculate its main properties, such as the total value and the allocation
     of each stock in the collection.
+    The quantities are stored in dense arrays (one row per stock, sorted by
+    the index of the stock), and the stocks attribute gives a dictionary-like
+    access to them.
+    The total value is kept as a running total: quantity changes update it by
+    their delta and price changes mark it as outdated, so it is recomputed
+    only when it is read after a price update.
+    An indexed collection is registered as a holder of its stocks, so only
+    the price changes of its own stocks mark its running total as outdated.
+    The running total is only changed while holding the lock of the
+    registry, so it never mixes prices of two batches and a quantity change
+    is never lost because of a concurrent price update.
+    A collection only holds stocks of the registry it was created with.
     '''
+    __slots__ = ('registry', '_qty', '_price_idx', '_size', '_total_value',
+                 '_prices_version', '_changed', 'version', '_indexed',
+                 'price_changes', '_journal', '_observers', '__weakref__')
+
+    # When it is True, every read of the running total is checked against a
+    # full recomputation of the value.
+    debug = False
+
     def __init__(
             self, *,   # the * is used to force the use of keyword arguments
             stocks_qty: dict[str: float] = {},
             stocks_allocation: dict[str: float] = None,
-            total_value: float = None):
+            total_value: float = None,
+            indexed: bool = False,
+            registry: StockRegistry = None):
         '''
         This method initializes the collection with the stocks and their
         quantities.
         '''
-        self.stocks = {}
+        if registry is None:
+            registry = Stock.default_registry
+        self.registry = registry
+
+        # Quantity of the stock and index of its price in each row. Only the
+        # first _size rows are used, the rest is capacity for new stocks.
+        self._qty = np.zeros(0)
+        self._price_idx = np.zeros(0, dtype=np.int32)
+        self._size = 0
+
+        # Running total value and the prices version it was computed with
+        self._total_value = 0.0
+        self._prices_version = registry._book.version
+        # Indexes of the stocks whose quantity changed since the last call to
+        # _pop_changes. It is created with the first change.
+        self._changed = None
+        # The version increases every time a quantity changes
+        self.version = 0
+
+        # Indexed collections are notified of the price changes of their
+        # stocks. The counter increases with every notification.
+        self._indexed = indexed
+        self.price_changes = 0
+        if indexed:
+            self._prices_version = 0
+        # (journal, key) of the trade journal that records the quantity
+        # changes, None when the collection is not journaled
+        self._journal = None
+        # Tuple of (observer, key) notified with observer._on_change(key)
+        # after every quantity change, None when nobody observes it
+        self._observers = None
 
         if stocks_allocation is not None and total_value is not None:
             self._create_from_allocation(stocks_allocation, total_value)
@@ -117,6 +654,20 @@ class StockCollection:
         else:
             self._create_from_qty(stocks_qty)
 
+        # Collections are usually kept long after they are created, so the
+        # spare capacity is released
+        self._qty = self._qty[:self._size].copy()
+        self._price_idx = self._price_idx[:self._size].copy()
+
+    @property
+    def stocks(self) -> Holdings:
+        '''
+        This property returns a dictionary-like view of the quantities of the
+        collection. The view is created on demand, so the collection has no
+        reference cycle and is released as soon as it is not used.
+        '''
+        return Holdings(self)
+
     def __eq__(self, other):
         '''
         This method is used to compare two stock collections. It returns True
@@ -140,6 +691,239 @@ class StockCollection:
 
         return is_equal
 
+    def _owns(self, stock) -> bool:
+        '''
+        This method checks if the stock belongs to the registry of the
+        collection.
+        '''
+        return isinstance(stock, Stock) and stock.registry is self.registry
+
+    def _find(self, index: int) -> int:
+        '''
+        This method returns the row of the stock with the given index, or None
+        if the stock is not in the collection.
+        '''
+        row = bisect_left(self._price_idx, index, 0, self._size)
+        if row < self._size and self._price_idx[row] == index:
+            return row
+        return None
+
+    def _get_stocks(self) -> list[Stock]:
+        '''
+        This method returns the stock of each row.
+        '''
+        by_index = self.registry._by_index
+        return [by_index[index]
+                for index in self._price_idx[:self._size].tolist()]
+
+    def _mark_changed(self, index: int) -> None:
+        if self._changed is None:
+            self._changed = set()
+        self._changed.add(index)
+        self.version += 1
+
+    def _set_qty(self, stock: Stock, quantity: float) -> None:
+        '''
+        This method stores the quantity of a stock in its row, inserting a new
+        row in its sorted position if the stock is not in the collection.
+        '''
+        if stock.registry is not self.registry:
+            raise ValueError(
+                f"Stock {stock.symbol} belongs to another registry.")
+
+        index = stock.index
+        size = self._size
+        row = bisect_left(self._price_idx, index, 0, size)
+        if row < size and self._price_idx[row] == index:
+            previous_qty = float(self._qty[row])
+        else:
+            previous_qty = 0.0
+            if size == len(self._qty):
+                # Double the capacity of the arrays when they are full
+                capacity = max(4, 2 * size)
+                self._qty = np.concatenate(
+                    (self._qty, np.zeros(capacity - size)))
+                self._price_idx = np.concatenate(
+                    (self._price_idx,
+                     np.zeros(capacity - size, dtype=np.int32)))
+
+            # Move the next rows one position to keep the rows sorted
+            self._qty[row + 1:size + 1] = self._qty[row:size]
+            self._price_idx[row + 1:size + 1] = self._price_idx[row:size]
+            self._price_idx[row] = index
+            self._size = size + 1
+            if self._indexed:
+                self.registry._holders.add(index, self)
+
+        with self.registry._lock:
+            self._qty[row] = quantity
+            self._total_value += (quantity - previous_qty) * \
+                self.registry._book.get(index)
+        self._mark_changed(index)
+        if self._journal is not None:
+            journal, key = self._journal
+            journal._record_qty(key, index, quantity)
+        if self._observers is not None:
+            for observer, key in self._observers:
+                observer._on_change(key)
+
+    def _remove(self, stock: Stock) -> None:
+        '''
+        This method removes the row of a stock. The next rows are moved one
+        position to keep the arrays dense and sorted.
+        '''
+        row = self._find(stock.index) if self._owns(stock) else None
+        if row is None:
+            raise KeyError(stock)
+
+        size = self._size
+        self._mark_changed(stock.index)
+        if self._indexed:
+            self.registry._holders.discard(stock.index, self)
+
+        with self.registry._lock:
+            if size == 1:
+                self._total_value = 0.0
+            else:
+                self._total_value -= float(self._qty[row]) * stock.price
+
+            self._qty[row:size - 1] = self._qty[row + 1:size]
+            self._price_idx[row:size - 1] = self._price_idx[row + 1:size]
+            self._size = size - 1
+        if self._journal is not None:
+            journal, key = self._journal
+            journal._record_qty(key, stock.index, 0.0)
+        if self._observers is not None:
+            for observer, key in self._observers:
+                observer._on_change(key)
+
+    @classmethod
+    def _from_arrays(cls, indexes: np.ndarray,
+                     quantities: np.ndarray,
+                     registry: StockRegistry = None) -> 'StockCollection':
+        '''
+        This method creates a collection filling its columns directly, with
+        the indexes of the stocks in the registry. The stocks must be unique
+        and the quantities already validated.
+        '''
+        if registry is None:
+            registry = Stock.default_registry
+        indexes = np.asarray(indexes, dtype=np.int32)
+        quantities = np.asarray(quantities, dtype=float)
+        if len(indexes) > 1 and np.any(indexes[1:] <= indexes[:-1]):
+            order = np.argsort(indexes)
+            indexes = indexes[order]
+            quantities = quantities[order]
+
+        # The attributes are set directly, as in __init__, because many
+        # collections are created this way (targets, recovered portfolios)
+        collection = cls.__new__(cls)
+        collection.registry = registry
+        collection._price_idx = indexes.copy()
+        collection._qty = quantities.copy()
+        collection._size = len(indexes)
+        collection._prices_version = registry._book.version
+        collection._changed = None
+        collection.version = 0
+        collection._indexed = False
+        collection.price_changes = 0
+        collection._journal = None
+        collection._observers = None
+        collection._total_value = collection._compute_value()
+        return collection
+
+    def _replace_rows(self, indexes: np.ndarray, quantities: np.ndarray,
+                      changes: tuple[list, list] = None) -> None:
+        '''
+        This method replaces all the rows of the collection at once, with the
+        indexes of the stocks (sorted and unique) and their quantities. The
+        stocks with a quantity of zero are left out. The changed stocks are
+        tracked, journaled and notified as if each one was set with
+        set_stock_qty.
+        The indexes and the new quantities of the changed stocks are computed
+        from the rows, unless they are given as changes (two lists).
+        '''
+        indexes = np.asarray(indexes, dtype=np.int32)
+        quantities = np.asarray(quantities, dtype=float)
+        held = quantities != 0
+        indexes, quantities = indexes[held], quantities[held]
+        old_idx = self._price_idx[:self._size]
+        if changes is None:
+            changes = self._get_changes(indexes, quantities)
+        changed_idx, changed_qty = changes
+        if not changed_idx:
+            return
+
+        if self._indexed:
+            holders = self.registry._holders
+            for index in np.setdiff1d(indexes, old_idx).tolist():
+                holders.add(index, self)
+            for index in np.setdiff1d(old_idx, indexes).tolist():
+                holders.discard(index, self)
+
+        with self.registry._lock:
+            self._price_idx = indexes.copy()
+            self._qty = quantities.copy()
+            self._size = len(indexes)
+            self._prices_version = self._get_prices_version()
+            self._total_value = self._compute_value()
+
+        if self._changed is None:
+            self._changed = set()
+        self._changed.update(changed_idx)
+        self.version += len(changed_idx)
+        if self._journal is not None:
+            journal, key = self._journal
+            for index, quantity in zip(changed_idx, changed_qty):
+                journal._record_qty(key, index, quantity)
+        if self._observers is not None:
+            for observer, key in self._observers:
+                observer._on_change(key)
+
+    def _get_changes(self, indexes: np.ndarray,
+                     quantities: np.ndarray) -> tuple[list, list]:
+        '''
+        This method returns the indexes of the stocks whose quantity differs
+        from the given rows, and their quantities in the rows (zero when the
+        stock is not in them).
+        '''
+        size = self._size
+        old_idx = self._price_idx[:size]
+        columns = np.union1d(old_idx, indexes)
+        old_qty = np.zeros(len(columns))
+        old_qty[np.searchsorted(columns, old_idx)] = self._qty[:size]
+        new_qty = np.zeros(len(columns))
+        new_qty[np.searchsorted(columns, indexes)] = quantities
+        changed = np.flatnonzero(old_qty != new_qty)
+        return columns[changed].tolist(), new_qty[changed].tolist()
+
+    def _on_price_change(self, index: int, delta_price: float) -> None:
+        '''
+        This method is called by the holders index when the price of one of
+        the stocks of an indexed collection changes. The running total is
+        only marked as outdated: updating it here by the delta, one stock at
+        a time, would let the readers see half of a batch.
+        '''
+        self.price_changes += 1
+
+    def _get_prices_version(self) -> int:
+        '''
+        This method returns a value that changes every time a price that
+        affects the running total changes.
+        '''
+        if self._indexed:
+            return self.price_changes
+        return self.registry._book.version
+
+    def _pop_changes(self) -> set[int]:
+        '''
+        This method returns the indexes of the stocks whose quantity changed
+        since the last call and starts tracking the changes again.
+        '''
+        changed = self._changed
+        self._changed = None
+        return set() if changed is None else changed
+
     def set_stock_qty(self, symbol: str, quantity: float) -> None:
         '''
         This method sets the quantity of a stock in the collection.
@@ -148,15 +932,15 @@ class StockCollection:
         if not isinstance(quantity, (int, float)):
             raise ValueError("Quantity must be a number")
 
-        if not Stock.exists_instance(symbol):
+        index = self.registry._symbols.get_id(symbol)
+        if index is None:
             raise ValueError('''Stock {symbol} not created. Please instanciate
                              the stock first.''')
 
         if quantity <= 0:
             raise ValueError("Quantity must be a number greater than zero")
 
-        stock = Stock(symbol)
-        self.stocks[stock] = quantity
+        self._set_qty(self.registry._by_index[index], quantity)
 
     def _create_from_qty(self, stocks_qty: dict[str: float]):
         '''
@@ -181,33 +965,74 @@ class StockCollection:
 
         for stock, allocation in stocks_allocation.items():
             if not isinstance(stock, Stock):
-                stock = Stock(stock)
+                stock = Stock(stock, registry=self.registry)
 
             stock_value = allocation * total_value
             stock_qty = stock_value / stock.price
-            self.stocks[stock] = stock_qty
+            self._set_qty(stock, stock_qty)
 
-    def get_value(self) -> float:
+        # The collection is new, so there are no changes to report
+        self._changed = None
+
+    def _get_values(self, snapshot: PriceVersion = None) -> np.ndarray:
+        '''
+        This method returns an array with the value of each row of the
+        collection.
+        '''
+        size = self._size
+        prices = self.registry._gather(self._price_idx[:size], snapshot)
+        return self._qty[:size] * prices
+
+    def _compute_value(self, snapshot: PriceVersion = None) -> float:
+        '''
+        This method computes the total value of the collection from scratch.
+        '''
+        size = self._size
+        prices = self.registry._gather(self._price_idx[:size], snapshot)
+        return float(np.dot(self._qty[:size], prices))
+
+    def get_value(self, snapshot: PriceVersion = None) -> float:
         '''
         This method returns the total value of the stocks in the collection.
+        The running total is recomputed only if a price changed since the last
+        time it was computed.
+        With a snapshot the value is computed with the prices of the snapshot.
         '''
-        total_value = sum(
-            stock.price * qty for stock, qty in self.stocks.items())
+        if snapshot is not None:
+            return self._compute_value(snapshot)
+
+        if self._prices_version != self._get_prices_version():
+            # The lock keeps out the price updates and the quantity changes
+            # while the total is recomputed
+            with self.registry._lock:
+                prices_version = self._get_prices_version()
+                self._total_value = self._compute_value()
+                self._prices_version = prices_version
+
+        elif StockCollection.debug:
+            expected_value = self._compute_value()
+            if not math.isclose(self._total_value, expected_value,
+                                rel_tol=1e-9, abs_tol=1e-9):
+                raise RuntimeError(
+                    f'''Running total value {self._total_value} does not
+                    match the collection value {expected_value}''')
 
-        return total_value
+        return self._total_value
 
-    def get_allocation(self) -> dict[Stock: float]:
+    def get_allocation(self,
+                       snapshot: PriceVersion = None) -> dict[Stock: float]:
         '''
         This method returns the allocation of the stocks in the collection.
         The allocation is the percentage of each stock in the total value of
         the collection.
         '''
-        allocation = {}
-        total_value = self.get_value()
-        for stock, qty in self.stocks.items():
-            allocation[stock] = qty*stock.price / total_value
+        values = self._get_values(snapshot)
+        if snapshot is None:
+            allocation = values / self.get_value()
+        else:
+            allocation = values / values.sum()
 
-        return allocation
+        return dict(zip(self._get_stocks(), allocation.tolist()))
 
     def delete_stock(self, stock: Stock) -> None:
         '''
@@ -217,17 +1042,17 @@ class StockCollection:
             raise ValueError(
                 f"Stock {stock} is not a valid stock instance.")
 
-        if stock not in self.stocks:
+        if not self._owns(stock) or self._find(stock.index) is None:
             raise ValueError(
                 f"Stock {stock} not found in the collection.")
 
-        del self.stocks[stock]
+        self._remove(stock)
 
     def get_stocks_set(self) -> set[Stock]:
         '''
         This method returns a set of stocks in the collection.
         '''
-        return set(self.stocks.keys())
+        return set(self._get_stocks())
 
     def modify_stock_qty(self, stock: Stock, qty: float) -> None:
         '''
@@ -237,10 +1062,15 @@ class StockCollection:
             raise ValueError(
                 f"Stock {stock} is not a valid stock instance.")
 
-        if stock not in self.stocks:
+        if stock.registry is not self.registry:
+            raise ValueError(
+                f"Stock {stock.symbol} belongs to another registry.")
+
+        row = self._find(stock.index)
+        if row is None:
             current_qty = 0
         else:
-            current_qty = self.stocks[stock]
+            current_qty = float(self._qty[row])
         target_qty = current_qty + qty
         if target_qty < 0:
             raise ValueError(f'''Not enough quantity of stock {stock} to modify.
@@ -250,4 +1080,37 @@ class StockCollection:
             self.delete_stock(stock)
 
         else:
-            self.stocks[stock] = target_qty
+            self._set_qty(stock, target_qty)
+
+    def modify_stocks_qty(self, changes: dict[Stock: float]) -> None:
+        '''
+        This method modifies the quantity of many stocks of the collection.
+        All the changes are validated before modifying any quantity, so
+        they are applied completely or not at all.
+        '''
+        stocks = list(changes.keys())
+        for stock in stocks:
+            if not isinstance(stock, Stock):
+                raise ValueError(
+                    f"Stock {stock} is not a valid stock instance.")
+            if stock.registry is not self.registry:
+                raise ValueError(
+                    f"Stock {stock.symbol} belongs to another registry.")
+
+        rows = [self._find(stock.index) for stock in stocks]
+        current_qty = np.array([0.0 if row is None else float(self._qty[row])
+                                for row in rows])
+        target_qty = current_qty + np.fromiter(
+            changes.values(), dtype=float, count=len(stocks))
+
+        if np.any(target_qty < 0):
+            stock = stocks[int(np.argmin(target_qty))]
+            raise ValueError(
+                f"Not enough quantity of stock {stock.symbol} to modify.")
+
+        for stock, qty in zip(stocks, target_qty.tolist()):
+            if qty == 0:
+                if self._find(stock.index) is not None:
+                    self._remove(stock)
+            else:
+                self._set_qty(stock, qty)
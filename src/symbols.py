@@ -0,0 +1,59 @@
+'''
+This module contains the SymbolTable class. It interns the stock symbols and
+gives each one a dense integer id (0, 1, 2, ...).
+
+Normalizing a symbol (checking it is a string and converting it to
+uppercase) is done only the first time a spelling is seen. The table keeps
+every spelling it has seen, so later lookups of the same spelling are a single
+dictionary access, and the rest of the code works with the integer ids.
+'''
+
+from src.utils import get_valid_symbol
+
+
+class SymbolTable:
+    '''
+    This class maps each normalized symbol to a dense integer id and back.
+    '''
+    def __init__(self):
+        # Normalized symbol of each id
+        self.symbols = []
+        # Id of each spelling of a symbol seen so far (e.g. 'aapl', 'AAPL')
+        self._ids = {}
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def get_id(self, symbol: str) -> int:
+        '''
+        This method returns the id of a symbol, or None if the symbol is not
+        in the table.
+        '''
+        if isinstance(symbol, str):
+            symbol_id = self._ids.get(symbol)
+            if symbol_id is not None:
+                return symbol_id
+
+        # Raises a ValueError if the symbol is not a string
+        symbol_id = self._ids.get(get_valid_symbol(symbol))
+        if symbol_id is not None:
+            # Remember this spelling to skip the normalization next time
+            self._ids[symbol] = symbol_id
+        return symbol_id
+
+    def intern(self, symbol: str) -> int:
+        '''
+        This method returns the id of a symbol, adding it to the table if it
+        is not there.
+        '''
+        symbol_id = self.get_id(symbol)
+        if symbol_id is None:
+            normalized = get_valid_symbol(symbol)
+            symbol_id = len(self.symbols)
+            self.symbols.append(normalized)
+            self._ids[normalized] = symbol_id
+            self._ids[symbol] = symbol_id
+        return symbol_id
+
+    def get_symbol(self, symbol_id: int) -> str:
+        return self.symbols[symbol_id]
@@ -0,0 +1,103 @@
+'''
+This test file is for testing the backtesting engine. The results are compared
+with a simulation done day by day with the Portfolio class.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock
+from src.portfolio import Portfolio
+from src.backtest import run_backtest
+
+
+SYMBOLS = ['BT1', 'BT2', 'BT3']
+TARGETS = [{'BT1': 0.5, 'BT2': 0.5},
+           {'BT1': 0.2, 'BT2': 0.3, 'BT3': 0.5}]
+
+
+@pytest.fixture
+def prices():
+    generator = np.random.default_rng(0)
+    returns = generator.normal(0, 0.02, size=(60, len(SYMBOLS)))
+    return 100 * np.exp(np.cumsum(returns, axis=0))
+
+
+def simulate(prices, allocation, rebalance_every, cash_flows):
+    '''
+    This function simulates the backtest with the Portfolio class.
+    '''
+    Stock.update_prices(dict(zip(SYMBOLS, prices[0])))
+    portfolio = Portfolio('Backtest', allocation, 1000)
+
+    values = []
+    for date in range(len(prices)):
+        Stock.update_prices(dict(zip(SYMBOLS, prices[date])))
+        if cash_flows[date] > 0:
+            portfolio.invest_money(cash_flows[date])
+        elif cash_flows[date] < 0:
+            portfolio.retire_money(-cash_flows[date])
+        if date > 0 and date % rebalance_every == 0:
+            portfolio.rebalance()
+        values.append(portfolio.stocks_collection.get_value())
+
+    return values, portfolio
+
+
+def test_calendar_backtest(prices):
+    for symbol, price in zip(SYMBOLS, prices[0]):
+        Stock(symbol, price)
+    cash_flows = np.zeros(len(prices))
+    cash_flows[0] = 200
+    cash_flows[10] = 500
+    cash_flows[25] = -300
+
+    result = run_backtest(prices, SYMBOLS, TARGETS, 1000,
+                          rebalance_every=7, cash_flows=cash_flows)
+
+    for row, allocation in enumerate(TARGETS):
+        values, portfolio = simulate(prices, allocation, 7, cash_flows)
+        assert np.allclose(result.values[:, row], values)
+
+    assert np.allclose(result.values[0], 1200)
+    assert result.rebalanced[7].all()
+    assert not result.rebalanced[8].any()
+    assert result.turnover[7, 0] > 0
+
+    # Replaying the trade log gives the value of each portfolio every day
+    dates, portfolios, columns, quantities = result.trades
+    assert np.all(np.diff(dates) >= 0)
+    qty = np.zeros((len(TARGETS), len(SYMBOLS)))
+    for date in range(len(prices)):
+        day = dates == date
+        np.add.at(qty, (portfolios[day], columns[day]), quantities[day])
+        assert np.allclose(qty @ prices[date], result.values[date])
+
+
+def test_drift_backtest(prices):
+    result = run_backtest(prices, SYMBOLS, TARGETS, 1000,
+                          drift_threshold=0.02)
+
+    rebalanced = result.rebalanced.any(axis=1)
+    assert rebalanced.any()
+    assert not rebalanced.all()
+
+    # The initial allocation is bought on the first day
+    dates, portfolios, _, _ = result.trades
+    assert set(dates.tolist()) == \
+        {0} | set(np.flatnonzero(rebalanced).tolist())
+    for date, symbol, qty in result.get_trades(0):
+        assert symbol in ('BT1', 'BT2')
+        assert not math.isclose(qty, 0)
+
+
+def test_backtest_invalid_inputs(prices):
+    with pytest.raises(ValueError):
+        run_backtest(-prices, SYMBOLS, TARGETS, 1000)
+    with pytest.raises(ValueError):
+        run_backtest(prices, SYMBOLS, [{'OTHER': 1}], 1000)
+    with pytest.raises(ValueError):
+        run_backtest(prices, SYMBOLS, TARGETS, 1000,
+                     cash_flows=np.full(len(prices), -2000.))
+    with pytest.raises(ValueError):
+        run_backtest(prices, SYMBOLS, TARGETS, 1000, rebalance_every=0)
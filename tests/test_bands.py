@@ -0,0 +1,101 @@
+'''
+This test file is for testing the rebalance with no-trade bands and
+transaction costs.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.bands import TransactionCosts, get_band_trades
+
+
+@pytest.fixture
+def stocks():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+    return Stock
+
+
+def test_band_trades_inside_bands():
+    trades, cost = get_band_trades(np.array([10., -5., -5.]),
+                                   np.array([20., 20., 20.]),
+                                   TransactionCosts(fixed_fee=1))
+    assert np.all(trades == 0)
+    assert cost == 0
+
+
+def test_band_trades_to_band_edges():
+    deviation = np.array([100., -100., 0.])
+    trades, cost = get_band_trades(deviation,
+                                   np.array([20., 20., 20.]),
+                                   TransactionCosts(fixed_fee=1,
+                                                    basis_points=10))
+    assert np.allclose(trades, [80., -80., 0.])
+    assert math.isclose(cost, 2 + 160 * 10 / 10000)
+
+
+def test_band_trades_add_up_to_zero():
+    deviation = np.array([100., -60., -40., 0.])
+    trades, cost = get_band_trades(deviation,
+                                   np.array([20., 20., 20., 20.]),
+                                   TransactionCosts(fixed_fee=1))
+
+    assert math.isclose(trades.sum(), 0, abs_tol=1e-9)
+    final_deviation = deviation - trades
+    assert np.all(np.abs(final_deviation) <= 20 + 1e-9)
+    # No new order is needed for the stock already at its target
+    assert trades[3] == 0
+    assert cost == 3
+
+
+def test_portfolio_rebalance_within_bands(stocks):
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation={'S100': 0.31, 'S200': 0.35, 'S300': 0.34},
+        total_value=1000)
+    portfolio.set_allocation_target({'S100': 0.3, 'S200': 0.3, 'S300': 0.4})
+
+    trades, cost = portfolio.get_band_trades(
+        default_band=0.02, costs=TransactionCosts(fixed_fee=1))
+
+    # S100 is inside its band, only S200 and S300 are traded
+    assert set(trades.keys()) == {Stock('S200'), Stock('S300')}
+    assert cost == 2
+
+    portfolio.rebalance_within_bands(default_band=0.02)
+    assert math.isclose(portfolio.stocks_collection.get_value(), 1000)
+    assert portfolio.get_allocation_drift() <= 0.02 + 1e-9
+
+
+def test_band_trades_never_sell_more_than_held():
+    registry = StockRegistry()
+    for symbol in 'ABCD':
+        Stock(symbol, 1, registry=registry)
+    portfolio = Portfolio('x', {'A': .3, 'B': .3, 'C': .4}, 1000,
+                          registry=registry)
+    portfolio.set_allocation_target({'A': .25, 'C': .35, 'D': .40})
+
+    # The band of B is wider than the 300 of B held
+    bands = {'A': .05, 'B': .31, 'C': .05, 'D': .05}
+    trades, _ = portfolio.get_band_trades(bands=bands)
+    assert trades[Stock('B', registry=registry)] >= -300
+    assert math.isclose(sum(trades.values()), 0, abs_tol=1e-9)
+
+    portfolio.rebalance_within_bands(bands=bands)
+    quantities = portfolio.stocks_collection.stocks
+    assert all(qty >= 0 for qty in quantities.values())
+    assert math.isclose(portfolio.stocks_collection.get_value(), 1000)
+
+    # The same with the values of the function
+    generator = np.random.default_rng(0)
+    for _ in range(200):
+        current = generator.uniform(0, 100, 5)
+        target = generator.dirichlet(np.ones(5)) * current.sum()
+        trades, _ = get_band_trades(target - current,
+                                    generator.uniform(0, 50, 5),
+                                    TransactionCosts(), current)
+        assert np.all(current + trades >= -1e-9)
+        assert math.isclose(trades.sum(), 0, abs_tol=1e-6)
@@ -0,0 +1,88 @@
+'''
+This test file checks the generators and the harness of the benchmark suite
+with tiny sizes. It does not check any timing.
+'''
+
+import pytest
+import json
+import math
+import numpy as np
+from benchmarks.generators import make_universe, make_allocation
+from benchmarks.generators import make_portfolios, make_sparse_book
+from benchmarks.memory import measure_memory
+from benchmarks.suite import Workload, measure, run_suite, compare
+from benchmarks.__main__ import main, get_baseline_path
+from src.stocks import StockRegistry
+
+
+def test_generators_are_reproducible():
+    registry = StockRegistry()
+    stocks = make_universe(50, seed=1, registry=registry)
+    assert len(registry) == 50
+
+    allocation = make_allocation(stocks, np.random.default_rng(1))
+    assert 8 <= len(allocation) <= 20
+    assert math.isclose(sum(allocation.values()), 1)
+    assert allocation == make_allocation(stocks, np.random.default_rng(1))
+
+    portfolios = make_portfolios(stocks, 3, seed=1, registry=registry)
+    values = [p.stocks_collection.get_value() for p in portfolios]
+    assert all(1e3 <= value <= 1e6 for value in values)
+
+    book = make_sparse_book(stocks, 3, seed=1, registry=registry)
+    assert np.allclose(book.targets.sum_rows(book.targets.data), 1)
+    assert len(book) == 3 and book.holdings.nnz <= 40 * 3
+
+
+def test_measure():
+    calls = []
+    result = measure(lambda seed: Workload(calls.append, 10), repeat=2)
+    # One warm-up pass plus enough repeats for 100 samples
+    assert len(calls) == 110
+    assert result['throughput'] > 0
+    assert result['p50_us'] <= result['p95_us'] <= result['p99_us']
+
+
+def test_run_suite_and_compare():
+    current = run_suite('smoke', repeat=1, only='get_value[')
+    assert len(current['results']) == 2
+    assert current['meta']['scale'] == 'smoke'
+
+    rows = compare(current, current)
+    assert all(row['regressions'] == [] for row in rows)
+
+    slower = {'results': {
+        name: dict(result, throughput=result['throughput'] / 2,
+                   p50_us=result['p50_us'] * 2)
+        for name, result in current['results'].items()}}
+    rows = compare(current, slower)
+    assert all(row['regressions'] == ['throughput', 'p50_us']
+               for row in rows)
+
+
+def test_compare_baselines(tmp_path, capsys):
+    # The stored baseline has a note on the machine it was recorded on
+    with open(get_baseline_path('main')) as f:
+        baseline = json.load(f)
+    assert baseline['meta']['scale'] == 'default'
+    assert baseline['meta']['note']
+
+    missing = str(tmp_path / 'missing.json')
+    with pytest.raises(SystemExit) as error:
+        main(['--compare', missing])
+    assert error.value.code == 2
+    assert f'baseline {missing} does not exist' in capsys.readouterr().err
+
+    path = str(tmp_path / 'smoke.json')
+    assert main(['--scale', 'smoke', '--repeat', '1', '--only', 'get_value[',
+                 '--save', path, '--note', 'test machine']) == 0
+    with open(path) as f:
+        assert json.load(f)['meta']['note'] == 'test machine'
+    assert main(['--scale', 'smoke', '--repeat', '1', '--only', 'get_value[',
+                 '--compare', path, '--tolerance', '100']) == 0
+
+
+def test_measure_memory():
+    result = measure_memory(symbols=50, portfolios=10)
+    assert 8 <= result['positions_per_portfolio'] <= 20
+    assert result['bytes_per_position'] > 0
@@ -0,0 +1,88 @@
+'''
+This test file is for testing the PortfolioBook class. The results of the book
+are compared with the results of the Portfolio class for each portfolio.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock
+from src.portfolio import Portfolio
+from src.book import PortfolioBook
+
+
+@pytest.fixture
+def portfolios():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+
+    portfolio_1 = Portfolio(
+        name='Portfolio 1',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1000)
+    portfolio_1.set_allocation_target({'S200': 0.25, 'S300': 0.75})
+
+    portfolio_2 = Portfolio(
+        name='Portfolio 2',
+        stocks_allocation={'S100': 0.2, 'S200': 0.3, 'S300': 0.5},
+        total_value=3000)
+    portfolio_2.set_allocation_target({'S100': 1})
+
+    return [portfolio_1, portfolio_2]
+
+
+def test_book_values(portfolios):
+    book = PortfolioBook(portfolios)
+
+    assert len(book) == 2
+    assert np.allclose(book.get_values(), [1000, 3000])
+
+
+def test_book_deviation(portfolios):
+    book = PortfolioBook(portfolios)
+
+    for row, portfolio in enumerate(portfolios):
+        deviation = portfolio.get_stocks_qty_deviation()
+        book_deviation = book.get_stocks_qty_deviation(row)
+
+        assert deviation.keys() == book_deviation.keys()
+        for stock, qty in deviation.items():
+            assert math.isclose(book_deviation[stock], qty)
+
+
+def test_book_trades(portfolios):
+    book = PortfolioBook(portfolios)
+    rows, columns, quantities = book.get_trades()
+
+    for row, column, qty in zip(rows, columns, quantities):
+        deviation = portfolios[row].get_stocks_qty_deviation()
+        assert math.isclose(deviation[Stock.get_by_index(column)], qty)
+
+    assert len(rows) == sum(
+        len(portfolio.get_stocks_qty_deviation()) for portfolio in portfolios)
+
+
+def test_book_rebalance(portfolios):
+    book = PortfolioBook(portfolios)
+    book.rebalance()
+
+    for row, portfolio in enumerate(portfolios):
+        portfolio.rebalance()
+        book_portfolio = book.get_portfolio(row)
+
+        assert book_portfolio.name == portfolio.name
+        assert book_portfolio.stocks_collection == portfolio.stocks_collection
+        assert book_portfolio.allocation_target.keys() == \
+            {Stock.get_by_index(index)
+             for index in portfolio._target_idx.tolist()}
+
+
+def test_book_get_portfolio(portfolios):
+    book = PortfolioBook(portfolios)
+
+    for row, portfolio in enumerate(portfolios):
+        book_portfolio = book.get_portfolio(row)
+        assert book_portfolio.registry is portfolio.registry
+        assert book_portfolio.get_stocks_qty_deviation() == \
+            pytest.approx(portfolio.get_stocks_qty_deviation())
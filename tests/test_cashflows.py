@@ -0,0 +1,83 @@
+'''
+This test file is for testing the cash flows that rebalance the portfolios,
+for one portfolio and for a batch of portfolios in a PortfolioBook.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock
+from src.portfolio import Portfolio
+from src.book import PortfolioBook
+from src.cashflows import get_cash_flow_trades
+
+
+@pytest.fixture
+def portfolio():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation={'S100': 0.5, 'S200': 0.3, 'S300': 0.2},
+        total_value=1000)
+    portfolio.set_allocation_target({'S100': 0.4, 'S200': 0.6})
+    return portfolio
+
+
+def test_cash_flow_trades():
+    values = np.array([[50., 30., 20.]])
+    weights = np.array([[0.4, 0.4, 0.2]])
+
+    trades = get_cash_flow_trades(values, weights, np.array([20.]))
+    assert np.allclose(trades, [[0, 50 / 3, 10 / 3]])
+
+    trades = get_cash_flow_trades(values, weights, np.array([-10.]))
+    assert np.allclose(trades, [[-10, 0, 0]])
+
+    with pytest.raises(ValueError):
+        get_cash_flow_trades(values, weights, np.array([-200.]))
+
+
+def test_invest_money_rebalance(portfolio):
+    portfolio.invest_money(500, rebalance=True)
+
+    assert math.isclose(portfolio.stocks_collection.get_value(), 1500)
+    allocation = portfolio.stocks_collection.get_allocation()
+    # S200 is filled first, until S100 and S200 are at the same level
+    assert math.isclose(allocation[Stock('S200')], 780 / 1500)
+    assert math.isclose(allocation[Stock('S100')], 520 / 1500)
+    assert math.isclose(allocation[Stock('S300')], 200 / 1500)
+
+
+def test_retire_money_rebalance(portfolio):
+    portfolio.retire_money(300, rebalance=True)
+
+    # S300 is not in the target, so it is sold first
+    assert math.isclose(portfolio.stocks_collection.get_value(), 700)
+    assert Stock('S300') not in portfolio.stocks_collection.stocks
+    assert math.isclose(
+        portfolio.stocks_collection.stocks[Stock('S100')], 4)
+
+    with pytest.raises(ValueError):
+        portfolio.retire_money(1000, rebalance=True)
+
+
+def test_book_cash_flows(portfolio):
+    other = Portfolio(
+        name='Other Portfolio',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1000)
+    book = PortfolioBook([portfolio, other])
+
+    book.apply_cash_flows(np.array([500., -300.]))
+    portfolio.invest_money(500, rebalance=True)
+    other.retire_money(300, rebalance=True)
+
+    assert book.get_portfolio(0).stocks_collection == \
+        portfolio.stocks_collection
+    assert book.get_portfolio(1).stocks_collection == other.stocks_collection
+
+    book.apply_cash_flows(np.array([100., 0.]), rebalance=False)
+    assert np.allclose(book.get_values(), [1600, 700])
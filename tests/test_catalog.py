@@ -0,0 +1,118 @@
+'''
+This test file is for testing the AllocationCatalog class, the compiled cache
+of the allocation and stocks files.
+'''
+
+import pytest
+import os
+import pickle
+import yaml
+from src.catalog import AllocationCatalog
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    allocations_path = tmp_path / 'allocations'
+    allocations_path.mkdir()
+    (allocations_path / 'a.yaml').write_text(
+        'name: First\nallocation:\n  aaa: 0.5\n  BBB: 0.5\n')
+    (allocations_path / 'b.yaml').write_text(
+        'name: Second\nallocation:\n  AAA: 1\n')
+    (allocations_path / 'invalid.yaml').write_text(
+        'name: Invalid\nallocation:\n  AAA: 0.5\n')
+    (allocations_path / 'notes.txt').write_text('not an allocation')
+    (tmp_path / 'stocks.yaml').write_text('aaa: 10\nBBB: 20.5\n')
+    return tmp_path
+
+
+def create_catalog(data_path):
+    return AllocationCatalog(str(data_path / 'allocations'),
+                             str(data_path / 'stocks.yaml'))
+
+
+def count_yaml_loads(monkeypatch):
+    calls = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(content):
+        calls.append(content)
+        return safe_load(content)
+
+    monkeypatch.setattr(yaml, 'safe_load', counting_safe_load)
+    return calls
+
+
+def test_catalog_content(data_path):
+    catalog = create_catalog(data_path)
+
+    assert catalog.get_allocation_files() == ['a.yaml', 'b.yaml',
+                                              'invalid.yaml']
+    assert catalog.get_names() == ['First', 'Second', 'invalid.yaml']
+    assert catalog.get_allocation('a.yaml') == {
+        'name': 'First', 'allocation': {'AAA': 0.5, 'BBB': 0.5}}
+    assert catalog.get_prices() == {'AAA': 10, 'BBB': 20.5}
+
+    with pytest.raises(ValueError):
+        catalog.get_allocation('invalid.yaml')
+
+
+def test_catalog_cache(data_path, monkeypatch):
+    catalog = create_catalog(data_path)
+    catalog.get_names()
+    catalog.get_prices()
+    catalog.save()
+
+    calls = count_yaml_loads(monkeypatch)
+    catalog = create_catalog(data_path)
+    catalog.get_names()
+    catalog.get_allocation('b.yaml')
+    catalog.get_prices()
+    assert calls == []
+
+    # Only the modified file is parsed again
+    path = data_path / 'allocations' / 'b.yaml'
+    path.write_text('name: Changed\nallocation:\n  BBB: 1\n')
+    assert catalog.get_names() == ['First', 'Changed', 'invalid.yaml']
+    assert len(calls) == 1
+
+    # Touching a file without changing it does not parse it again
+    stat = os.stat(data_path / 'stocks.yaml')
+    os.utime(data_path / 'stocks.yaml',
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    catalog.get_prices()
+    assert len(calls) == 1
+
+
+def test_catalog_invalid_allocations(data_path):
+    allocations_path = data_path / 'allocations'
+    (allocations_path / 'list.yaml').write_text(
+        'name: List\nallocation:\n  - AAA\n  - BBB\n')
+    (allocations_path / 'scalar.yaml').write_text(
+        'name: Scalar\nallocation: 1\n')
+    (allocations_path / 'text.yaml').write_text(
+        'name: Text\nallocation:\n  AAA: half\n  BBB: half\n')
+    catalog = create_catalog(data_path)
+
+    assert catalog.get_names() == ['First', 'Second', 'invalid.yaml',
+                                   'list.yaml', 'scalar.yaml', 'text.yaml']
+    for file in ['list.yaml', 'scalar.yaml', 'text.yaml']:
+        with pytest.raises(ValueError):
+            catalog.get_allocation(file)
+
+
+@pytest.mark.parametrize('content', [
+    b'',
+    b'not a pickle',
+    pickle.dumps(None),
+    pickle.dumps((1, ['not', 'a', 'dict'])),
+    # A pickle of a class that does not exist
+    b'csrc.catalog\nMissing\n.',
+])
+def test_catalog_damaged_cache(data_path, content):
+    catalog = create_catalog(data_path)
+    with open(catalog.cache_file, 'wb') as f:
+        f.write(content)
+
+    assert catalog.get_names() == ['First', 'Second', 'invalid.yaml']
+    catalog.save()
+    assert create_catalog(data_path).get_prices() == {'AAA': 10, 'BBB': 20.5}
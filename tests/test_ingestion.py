@@ -0,0 +1,89 @@
+'''
+This test file is for testing the ingestion of price ticks.
+'''
+
+import asyncio
+import pytest
+from src.stocks import Stock
+from src.ingestion import TickCoalescer, apply_ticks_batch
+from src.ingestion import ingest_ticks, ingest_tick_stream
+
+
+@pytest.fixture
+def stocks():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    return Stock
+
+
+def test_coalescer_keeps_latest_tick():
+    coalescer = TickCoalescer(window=10)
+    assert coalescer.add('S100', 101, 0) is None
+    assert coalescer.add('S100', 103, 2) is None
+    assert coalescer.add('S100', 102, 1) is None
+    assert coalescer.add('S200', 201, 3) is None
+
+    batch = coalescer.add('S100', 104, 10)
+    assert batch == {'S100': (103, 2), 'S200': (201, 3)}
+    assert coalescer.flush() == {'S100': (104, 10)}
+
+
+def test_coalescer_max_ticks():
+    coalescer = TickCoalescer(window=10, max_ticks=2)
+    assert coalescer.add('S100', 101, 0) is None
+    assert coalescer.add('S200', 201, 1) == {'S100': (101, 0),
+                                             'S200': (201, 1)}
+    assert coalescer.flush() == {}
+
+
+def test_apply_ticks_batch(stocks):
+    updated = apply_ticks_batch({'s100': (110, 1),
+                                 'S100': (120, 2),
+                                 'S200': (-1, 2),
+                                 'UNKNOWN': (10, 2)})
+    assert updated == 1
+    assert Stock('S100').price == 120
+    assert Stock('S200').price == 200
+
+
+def test_apply_ticks_batch_malformed_prices(stocks):
+    # The malformed ticks are dropped and the valid ones are applied
+    updated = apply_ticks_batch({'S100': ('bad', 3),
+                                 's100': (130, 2),
+                                 'S200': (None, 2)})
+    assert updated == 1
+    assert Stock('S100').price == 130
+    assert Stock('S200').price == 200
+
+    ticks = [('S100', 101, 0), ('S200', 'n/a', 1), ('S200', 210, 2),
+             ('S100', [102], 3), ('S200', float('nan'), 4)]
+    # The latest tick of each symbol is malformed
+    assert list(ingest_ticks(ticks, window=10)) == [0]
+    assert Stock('S100').price == 130
+    assert Stock('S200').price == 200
+    assert list(ingest_ticks(ticks[:3], window=10)) == [2]
+    assert Stock('S100').price == 101
+    assert Stock('S200').price == 210
+
+
+def test_ingest_ticks(stocks):
+    ticks = [('S100', 100 + indx, indx * 0.1) for indx in range(100)]
+    ticks.append(('S200', 250, 9.95))
+
+    updates = list(ingest_ticks(ticks, window=5))
+    assert updates == [1, 2]
+    assert Stock('S100').price == 199
+    assert Stock('S200').price == 250
+
+
+def test_ingest_tick_stream(stocks):
+    async def stream():
+        for indx in range(10):
+            yield ('S200', 200 + indx, indx)
+
+    async def consume():
+        return [updated async for updated
+                in ingest_tick_stream(stream(), window=4)]
+
+    assert asyncio.run(consume()) == [1, 1, 1]
+    assert Stock('S200').price == 209
@@ -0,0 +1,72 @@
+'''
+This test file is for testing the instrumentation of the hot paths.
+'''
+
+import pytest
+from src import instrumentation
+from src.stocks import Stock, StockCollection
+from src.portfolio import Portfolio
+
+
+@pytest.fixture
+def stocks():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    return Stock
+
+
+@pytest.fixture
+def enabled():
+    instrumentation.reset()
+    instrumentation.enable()
+    yield instrumentation
+    instrumentation.disable()
+    instrumentation.reset()
+
+
+def test_disabled_by_default(stocks):
+    assert not instrumentation.is_enabled()
+    original = StockCollection.get_value
+    instrumentation.enable()
+    assert StockCollection.get_value is not original
+    instrumentation.disable()
+    assert StockCollection.get_value is original
+    assert isinstance(Stock.__dict__['__new__'], staticmethod)
+
+
+def test_counts_calls(stocks, enabled):
+    portfolio = Portfolio(name='Test',
+                          stocks_allocation={'S100': 0.5, 'S200': 0.5},
+                          total_value=1000)
+    Stock('S100').update_price(110)
+    portfolio.rebalance()
+    Stock.update_prices({'S200': 190})
+
+    snapshot = enabled.get_snapshot()
+    assert snapshot['Portfolio.rebalance']['calls'] == 1
+    assert snapshot['Stock.update_price']['calls'] == 1
+    assert snapshot['Stock.update_prices']['calls'] == 1
+    assert snapshot['Stock.__new__']['calls'] >= 3
+    assert snapshot['Portfolio.update_stocks_qty_target']['calls'] >= 2
+    assert snapshot['Portfolio._compute_deviation_arrays']['calls'] >= 1
+
+    rebalance = snapshot['Portfolio.rebalance']
+    assert sum(rebalance['buckets']) == 1
+    assert rebalance['max_ns'] == rebalance['total_ns'] > 0
+    assert Stock('S100').price == 110
+
+    enabled.reset()
+    assert enabled.get_snapshot() == {}
+
+
+def test_export_prometheus(stocks, enabled):
+    collection = StockCollection(stocks_qty={'S100': 1})
+    collection.get_value()
+    collection.get_value()
+
+    text = enabled.export_prometheus()
+    assert '# TYPE portfolio_method_duration_seconds histogram' in text
+    assert ('portfolio_method_duration_seconds_count'
+            '{method="StockCollection.get_value"} 2') in text
+    assert ('portfolio_method_duration_seconds_bucket'
+            '{method="StockCollection.get_value",le="+Inf"} 2') in text
@@ -0,0 +1,154 @@
+'''
+This test file is for testing the trade journal: recording the changes of the
+portfolios, snapshots and recovery.
+'''
+
+import pytest
+import os
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.journal import TradeJournal, recover
+
+
+@pytest.fixture
+def registry():
+    registry = StockRegistry()
+    Stock('S100', 100, registry=registry)
+    Stock('S200', 200, registry=registry)
+    Stock('S50', 50, registry=registry)
+    return registry
+
+
+def make_portfolio(name, registry):
+    return Portfolio(name=name,
+                     stocks_allocation={'S100': 0.5, 'S200': 0.5},
+                     total_value=1000,
+                     registry=registry)
+
+
+def get_target_weights(portfolio):
+    # The recovered portfolios have Stock keys in their allocation target,
+    # so the weights are compared by the index of the stocks
+    return dict(zip(portfolio._target_idx.tolist(),
+                    portfolio._target_weights.tolist()))
+
+
+def assert_same_state(recovered, portfolio):
+    assert recovered.stocks_collection == portfolio.stocks_collection
+    assert get_target_weights(recovered) == get_target_weights(portfolio)
+
+
+def test_journal_records_changes(tmp_path, registry):
+    with TradeJournal(str(tmp_path), registry=registry) as journal:
+        portfolio = make_portfolio('P1', registry)
+        journal.attach(portfolio)
+        portfolio.stocks_collection.modify_stock_qty(
+            Stock('S50', registry=registry), 4)
+        portfolio.rebalance()
+        portfolio.invest_money(500)
+        portfolio.retire_money(300)
+        portfolio.set_allocation_target({'S100': 0.2, 'S50': 0.8})
+        portfolio.rebalance()
+
+    recovered = recover(str(tmp_path), registry)
+    assert list(recovered) == ['P1']
+    assert_same_state(recovered['P1'], portfolio)
+    # The running total value of the portfolio may differ in the last bits
+    assert recovered['P1'].get_stocks_qty_deviation() == \
+        pytest.approx(portfolio.get_stocks_qty_deviation())
+
+    # Closing the journal stops recording
+    portfolio.invest_money(100)
+    assert recover(str(tmp_path), registry)['P1'].stocks_collection != \
+        portfolio.stocks_collection
+
+
+def test_journal_snapshot_and_tail(tmp_path, registry):
+    journal = TradeJournal(str(tmp_path), registry=registry)
+    portfolios = [make_portfolio(f'P{i}', registry) for i in range(3)]
+    for portfolio in portfolios:
+        journal.attach(portfolio)
+    portfolios[0].invest_money(100)
+
+    journal.snapshot()
+    assert sorted(os.listdir(tmp_path)) == ['journal-00000001.bin',
+                                            'snapshot-00000001.npz']
+
+    # The tail after the snapshot
+    portfolios[1].stocks_collection.delete_stock(
+        Stock('S100', registry=registry))
+    journal.detach(portfolios[2])
+    journal.attach(make_portfolio('P3', registry))
+    journal.flush()
+
+    recovered = recover(str(tmp_path), registry)
+    assert list(recovered) == ['P0', 'P1', 'P3']
+    assert_same_state(recovered['P0'], portfolios[0])
+    assert_same_state(recovered['P1'], portfolios[1])
+    journal.close()
+
+
+def test_journal_reopen_continues(tmp_path, registry):
+    with TradeJournal(str(tmp_path), registry=registry) as journal:
+        journal.attach(make_portfolio('P1', registry))
+        journal.snapshot()
+
+    with TradeJournal(str(tmp_path), registry=registry) as journal:
+        portfolio = journal.portfolios['P1']
+        portfolio.invest_money(1000)
+        with pytest.raises(ValueError):
+            journal.attach(make_portfolio('P1', registry))
+
+    # The stocks get other indexes in a new registry
+    other = StockRegistry()
+    Stock('S50', 50, registry=other)
+    Stock('S200', 200, registry=other)
+    Stock('S100', 100, registry=other)
+    recovered = recover(str(tmp_path), other)['P1']
+    assert recovered.stocks_collection.get_value() == \
+        pytest.approx(portfolio.stocks_collection.get_value())
+    assert {stock.symbol: weight for stock, weight
+            in recovered.allocation_target.items()} == \
+        {'S100': 0.5, 'S200': 0.5}
+
+    with pytest.raises(ValueError):
+        recover(str(tmp_path), StockRegistry())
+
+
+def test_journal_automatic_snapshot(tmp_path, registry):
+    with TradeJournal(str(tmp_path), registry=registry,
+                      snapshot_every=5) as journal:
+        portfolio = make_portfolio('P1', registry)
+        journal.attach(portfolio)
+        for _ in range(10):
+            portfolio.invest_money(10)
+        segment = journal.segment
+
+    assert segment > 1
+    assert_same_state(recover(str(tmp_path), registry)['P1'], portfolio)
+
+
+def test_journal_cut_segment(tmp_path, registry):
+    with TradeJournal(str(tmp_path), registry=registry) as journal:
+        portfolio = make_portfolio('P1', registry)
+        journal.attach(portfolio)
+        expected = dict(portfolio.stocks_collection.stocks)
+        portfolio.invest_money(100)
+        path = os.path.join(str(tmp_path),
+                            f'journal-{journal.segment:08d}.bin')
+
+    # A crash in the middle of the two records of invest_money: both are
+    # lost, the second one is incomplete
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 20)
+    recovered = recover(str(tmp_path), registry)['P1']
+    assert dict(recovered.stocks_collection.stocks) == expected
+
+    with open(path, 'wb') as f:
+        f.write(b'PF')
+    assert recover(str(tmp_path), registry) == {}
+
+    with open(path, 'wb') as f:
+        f.write(b'not a journal')
+    with pytest.raises(ValueError):
+        recover(str(tmp_path), registry)
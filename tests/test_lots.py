@@ -0,0 +1,96 @@
+'''
+This test file is for testing the rebalance in whole lots.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock
+from src.portfolio import Portfolio
+from src.lots import get_lot_orders
+
+
+@pytest.fixture
+def stocks():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+    return Stock
+
+
+def test_lot_orders_whole_shares():
+    orders, cash = get_lot_orders(
+        current_qty=np.array([10., 0., 0.]),
+        target_qty=np.array([2.5, 2.5, 2.5]),
+        prices=np.array([100., 100., 100.]),
+        lot_sizes=np.ones(3),
+        min_trade_sizes=np.zeros(3))
+
+    assert np.allclose(orders, np.round(orders))
+    assert cash >= 0
+    final_qty = np.array([10., 0., 0.]) + orders
+    assert math.isclose(final_qty.sum() * 100 + cash, 1000)
+    assert np.all(np.abs(final_qty - 2.5) <= 1)
+
+
+def test_lot_orders_lots_and_min_trades():
+    current_qty = np.array([0., 40., 7.])
+    target_qty = np.array([55., 20., 7.5])
+    prices = np.array([10., 10., 100.])
+    orders, cash = get_lot_orders(
+        current_qty=current_qty,
+        target_qty=target_qty,
+        prices=prices,
+        lot_sizes=np.array([10., 5., 1.]),
+        min_trade_sizes=np.array([0., 0., 2.]))
+
+    assert np.allclose(orders % np.array([10., 5., 1.]), 0)
+    # The order of the last stock is below its minimum trade size
+    assert orders[2] == 0
+    assert cash >= 0
+    assert math.isclose((current_qty + orders) @ prices + cash,
+                        current_qty @ prices)
+
+
+def test_portfolio_rebalance_lots(stocks):
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1200)
+    portfolio.set_allocation_target({'S100': 0.3, 'S300': 0.7})
+
+    orders, cash = portfolio.get_lot_orders()
+    assert orders[Stock('S200')] == -3
+    assert math.isclose(cash, 0, abs_tol=1e-9)
+
+    # The cash left after rounding down is used to buy one more S300
+    cash = portfolio.rebalance_lots()
+    quantities = portfolio.stocks_collection.stocks
+
+    assert quantities[Stock('S100')] == 3
+    assert quantities[Stock('S300')] == 3
+    assert Stock('S200') not in quantities
+    assert math.isclose(portfolio.stocks_collection.get_value() + cash, 1200)
+
+
+def test_portfolio_rebalance_min_trade(stocks):
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1200)
+    portfolio.set_allocation_target({'S100': 0.3, 'S200': 0.7})
+
+    # Without a minimum trade 3 S100 are sold, 1 S200 is bought and one
+    # S100 is bought back with the cash left
+    orders, cash = portfolio.get_lot_orders()
+    assert orders[Stock('S100')] == -2
+    assert orders[Stock('S200')] == 1
+    assert math.isclose(cash, 0, abs_tol=1e-9)
+
+    # Buying 1 S200 is below its minimum trade, and the 300 of the sold S100
+    # do not pay 2 S200, so no S200 is bought. One S100 is bought back and
+    # the rest is left in cash.
+    orders, cash = portfolio.get_lot_orders(min_trade_sizes={'S200': 2})
+    assert orders[Stock('S100')] == -2
+    assert orders[Stock('S200')] == 0
+    assert math.isclose(cash, 200)
@@ -0,0 +1,71 @@
+'''
+This test file is for testing the netting of the orders of many portfolios.
+'''
+
+import pytest
+import math
+from src.stocks import Stock
+from src.portfolio import Portfolio
+from src.netting import OrderNetting
+
+
+@pytest.fixture
+def portfolios():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+
+    portfolio_1 = Portfolio(
+        name='Portfolio 1',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1000)
+    portfolio_1.set_allocation_target({'S100': 1})
+
+    portfolio_2 = Portfolio(
+        name='Portfolio 2',
+        stocks_allocation={'S100': 1},
+        total_value=400)
+    portfolio_2.set_allocation_target({'S100': 0.5, 'S200': 0.5})
+
+    return [portfolio_1, portfolio_2]
+
+
+def test_net_orders(portfolios):
+    netting = OrderNetting(portfolios)
+
+    # Portfolio 1 buys 5 S100 and portfolio 2 sells 2 S100
+    orders = netting.get_orders()
+    assert math.isclose(orders[Stock('S100')], 3)
+    assert math.isclose(orders[Stock('S200')], -1.5)
+
+    crossed = netting.get_crossed_qty()
+    assert math.isclose(crossed[Stock('S100')], 2)
+    assert math.isclose(crossed[Stock('S200')], 1)
+
+
+def test_apply_complete_fills(portfolios):
+    netting = OrderNetting(portfolios)
+    netting.apply_fills()
+
+    for portfolio, value in zip(portfolios, [1000, 400]):
+        assert math.isclose(portfolio.stocks_collection.get_value(), value)
+        assert math.isclose(portfolio.get_allocation_drift(), 0,
+                            abs_tol=1e-9)
+
+
+def test_apply_partial_fills(portfolios):
+    netting = OrderNetting(portfolios)
+    filled = netting.split_fills({Stock('S100'): 1})
+
+    # The seller of S100 is crossed completely, the buyer gets the crossed
+    # quantity plus the fill
+    assert math.isclose(sum(filled[netting._stock_idx == Stock('S100').index]),
+                        1)
+    netting.apply_fills({Stock('S100'): 1})
+    assert math.isclose(
+        portfolios[0].stocks_collection.stocks[Stock('S100')], 8)
+    assert Stock('S100') in portfolios[1].stocks_collection.stocks
+
+    with pytest.raises(ValueError):
+        netting.split_fills({Stock('S100'): -1})
+    with pytest.raises(ValueError):
+        netting.split_fills({Stock('S100'): 10})
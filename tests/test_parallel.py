@@ -0,0 +1,147 @@
+'''
+This test file is for testing the parallel rebalance. The results must be the
+same as the ones given by the Portfolio class, for any number of workers.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.sparse import SparseBook
+from src.journal import TradeJournal, recover
+from src.parallel import get_deviations_in_parallel, rebalance_in_parallel
+from src.parallel import get_deviation_matrix_in_parallel
+from src.parallel import get_book_deviation_in_parallel
+from src.parallel import rebalance_book_in_parallel
+
+
+def create_portfolios():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+
+    portfolios = []
+    for indx in range(10):
+        portfolio = Portfolio(
+            name=f'Portfolio {indx}',
+            stocks_allocation={'S100': 0.5, 'S200': 0.5},
+            total_value=1000 * (indx + 1))
+        portfolio.set_allocation_target({'S200': 0.2, 'S300': 0.8})
+        portfolios.append(portfolio)
+
+    return portfolios
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_deviations_in_parallel(workers):
+    portfolios = create_portfolios()
+    deviations = get_deviations_in_parallel(portfolios,
+                                            workers=workers,
+                                            shards=3)
+
+    assert len(deviations) == len(portfolios)
+    for portfolio, deviation in zip(portfolios, deviations):
+        expected = portfolio.get_stocks_qty_deviation()
+        assert deviation.keys() == expected.keys()
+        for stock, qty in expected.items():
+            assert math.isclose(deviation[stock], qty)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_rebalance_in_parallel(workers):
+    portfolios = create_portfolios()
+    expected = create_portfolios()
+    deviations = [portfolio.get_stocks_qty_deviation()
+                  for portfolio in expected]
+    for portfolio in expected:
+        portfolio.rebalance()
+
+    versions = [portfolio.stocks_collection.version
+                for portfolio in portfolios]
+    trades = rebalance_in_parallel(portfolios, workers=workers, shards=3)
+
+    for row, (portfolio, expected_portfolio, deviation, version) in \
+            enumerate(zip(portfolios, expected, deviations, versions)):
+        assert portfolio.stocks_collection == \
+            expected_portfolio.stocks_collection
+        # S100 is sold, S200 is reduced and S300 is bought
+        assert portfolio.stocks_collection.version == version + 3
+        columns, quantities = trades.get_row(row)
+        assert [Stock.get_by_index(column) for column in columns] == \
+            list(deviation)
+        assert quantities == pytest.approx(list(deviation.values()))
+
+    # Rebalancing again changes nothing
+    versions = [portfolio.stocks_collection.version
+                for portfolio in portfolios]
+    trades = rebalance_in_parallel(portfolios, workers=workers)
+    assert np.allclose(trades.data, 0)
+    assert [portfolio.stocks_collection.version
+            for portfolio in portfolios] == versions
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_rebalance_in_parallel_is_recorded(tmp_path, indexed):
+    registry = StockRegistry()
+    Stock('S100', 100, registry=registry)
+    Stock('S200', 200, registry=registry)
+    Stock('S300', 300, registry=registry)
+    portfolio = Portfolio(name='P1',
+                          stocks_allocation={'S100': 0.5, 'S200': 0.5},
+                          total_value=1000, indexed=indexed,
+                          registry=registry)
+    portfolio.set_allocation_target({'S200': 0.2, 'S300': 0.8})
+
+    with TradeJournal(str(tmp_path), registry=registry) as journal:
+        journal.attach(portfolio)
+        rebalance_in_parallel([portfolio], workers=1, registry=registry)
+
+    recovered = recover(str(tmp_path), registry)
+    assert recovered['P1'].stocks_collection == portfolio.stocks_collection
+    assert Stock('S100', registry=registry) not in \
+        portfolio.stocks_collection.stocks
+
+    # The running total follows the prices of the new holdings only
+    Stock.update_prices({'S100': 1, 'S300': 600}, registry=registry)
+    assert portfolio.stocks_collection.get_value() == pytest.approx(1800)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_book_in_parallel(workers):
+    portfolios = create_portfolios()
+    book = SparseBook(portfolios)
+    expected = SparseBook(portfolios)
+
+    deviation = get_book_deviation_in_parallel(book, workers=workers,
+                                               shards=4)
+    expected_deviation = expected.get_qty_deviation()
+    assert np.array_equal(deviation.indptr, expected_deviation.indptr)
+    assert np.array_equal(deviation.indices, expected_deviation.indices)
+    assert np.allclose(deviation.data, expected_deviation.data)
+
+    snapshot = Stock.default_registry.pin()
+    Stock.update_prices({'S300': 600})
+    trades = rebalance_book_in_parallel(book, workers=workers, shards=4,
+                                        snapshot=snapshot)
+    expected.rebalance(snapshot)
+    assert np.allclose(trades.data, expected_deviation.data)
+    assert np.array_equal(book.holdings.indptr, expected.holdings.indptr)
+    assert np.array_equal(book.holdings.indices, expected.holdings.indices)
+    assert np.allclose(book.holdings.data, expected.holdings.data)
+
+
+def test_deviation_matrix_in_parallel():
+    portfolios = create_portfolios()
+    matrix = get_deviation_matrix_in_parallel(portfolios, workers=2,
+                                              shards=4)
+
+    assert len(matrix) == len(portfolios)
+    for row, portfolio in enumerate(portfolios):
+        columns, quantities = matrix.get_row(row)
+        expected = portfolio.get_stocks_qty_deviation()
+        assert [Stock.get_by_index(column) for column in columns] == \
+            list(expected)
+        assert quantities == pytest.approx(list(expected.values()))
+
+    assert get_deviations_in_parallel([], workers=1) == []
@@ -243,3 +243,145 @@ def test_update_stock_price(stocks):
     stock_1.update_price(1200)
     stock_2.update_price(800)
     assert math.isclose(portfolio.stocks_collection.get_value(), 2000)
+
+
+def test_allocation_target_attribute(stocks, even_allocation):
+    '''
+    This test checks that the allocation target is returned as it was set,
+    with symbol keys, and that assigning it sets the allocation target.
+    '''
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1000)
+    assert portfolio.allocation_target['S100'] == 0.5
+
+    portfolio.allocation_target = {'S300': 1}
+    assert portfolio.allocation_target == {'S300': 1}
+    deviation = portfolio.get_stocks_qty_deviation()
+    assert math.isclose(deviation[Stock('S300')], 1000 / 300)
+    assert math.isclose(deviation[Stock('S100')], -5)
+
+    with pytest.raises(ValueError):
+        portfolio.allocation_target = {'S300': 0.5}
+    assert portfolio.allocation_target == {'S300': 1}
+
+
+def test_stocks_qty_target_cache(stocks,
+                                 even_allocation,
+                                 same_qty_allocation):
+    '''
+    This test checks that the stocks qty target is only recomputed when the
+    prices, the portfolio value or the allocation target change.
+    '''
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation=even_allocation,
+        total_value=1000)
+
+    target = portfolio.stocks_qty_target
+    portfolio.get_stocks_qty_deviation()
+    assert portfolio.stocks_qty_target is target
+
+    Stock('S100').update_price(100)
+    portfolio.get_stocks_qty_deviation()
+    assert portfolio.stocks_qty_target is not target
+
+    target = portfolio.stocks_qty_target
+    portfolio.set_allocation_target(same_qty_allocation)
+    portfolio.get_stocks_qty_deviation()
+    assert portfolio.stocks_qty_target is not target
+
+
+def test_incremental_deviation(stocks,
+                               even_allocation):
+    '''
+    This test swaps quantities between stocks without changing the portfolio
+    value, so the cached deviation is updated only for the modified stocks. It
+    must match a deviation computed from scratch.
+    '''
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation=even_allocation,
+        total_value=1200)
+    portfolio.get_stocks_qty_deviation()
+
+    # Sell 200 of S200 and buy 200 of S100
+    portfolio.stocks_collection.modify_stock_qty(Stock('S200'), -1)
+    portfolio.stocks_collection.modify_stock_qty(Stock('S100'), 2)
+
+    deviation = portfolio.get_stocks_qty_deviation()
+    assert math.isclose(deviation[Stock('S100')], -2)
+    assert math.isclose(deviation[Stock('S200')], 1)
+    assert math.isclose(deviation[Stock('S300')], 0, abs_tol=1e-9)
+
+    portfolio.stocks_collection.delete_stock(Stock('S300'))
+    portfolio.stocks_collection.modify_stock_qty(Stock('S300'), 1)
+    deviation = portfolio.get_stocks_qty_deviation()
+
+    # Same deviation computed from scratch
+    portfolio._deviation = None
+    assert deviation == portfolio.get_stocks_qty_deviation()
+
+
+def test_incremental_deviation_after_trade(stocks,
+                                           even_allocation,
+                                           monkeypatch):
+    '''
+    This test checks that a trade that changes the portfolio value does not
+    recompute the deviation from scratch: only the traded stock is updated
+    and the cached targets are scaled by the new value.
+    '''
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation=even_allocation,
+        total_value=1200)
+    portfolio.get_stocks_qty_deviation()
+
+    calls = []
+    compute_deviation_arrays = Portfolio._compute_deviation_arrays
+
+    def count_calls(self):
+        calls.append(self)
+        return compute_deviation_arrays(self)
+
+    monkeypatch.setattr(Portfolio, '_compute_deviation_arrays', count_calls)
+
+    # Buy 300 of S300: the value goes from 1200 to 1500
+    portfolio.stocks_collection.modify_stock_qty(Stock('S300'), 1)
+    deviation = portfolio.get_stocks_qty_deviation()
+    assert calls == []
+    assert math.isclose(deviation[Stock('S100')], 1)
+    assert math.isclose(deviation[Stock('S200')], 0.5)
+    assert math.isclose(deviation[Stock('S300')], -2/3)
+
+    # A price change recomputes the deviation from scratch
+    Stock('S100').update_price(200)
+    portfolio.get_stocks_qty_deviation()
+    Stock('S100').update_price(100)
+    fresh = portfolio.get_stocks_qty_deviation()
+    assert calls == [portfolio, portfolio]
+    assert fresh == pytest.approx(deviation)
+
+
+def test_indexed_portfolio_target_cache(stocks,
+                                        even_allocation):
+    '''
+    This test checks that an indexed portfolio only recomputes its target
+    when the price of one of its stocks changes.
+    '''
+    Stock('OTHER', price=10)
+    portfolio = Portfolio(
+        name='Test Portfolio',
+        stocks_allocation=even_allocation,
+        total_value=1000,
+        indexed=True)
+
+    target = portfolio.stocks_qty_target
+    Stock('OTHER').update_price(20)
+    portfolio.get_stocks_qty_deviation()
+    assert portfolio.stocks_qty_target is target
+
+    Stock('S100').update_price(100)
+    portfolio.get_stocks_qty_deviation()
+    assert portfolio.stocks_qty_target is not target
@@ -0,0 +1,247 @@
+'''
+This test file is for testing the StockRegistry class: independent price
+universes in the same process and concurrent access from many threads.
+'''
+
+import pytest
+import math
+import sys
+import threading
+import numpy as np
+from src.stocks import Stock, StockCollection, StockRegistry
+from src.portfolio import Portfolio
+from src.book import PortfolioBook
+from src.netting import OrderNetting
+from src.parallel import get_deviations_in_parallel
+
+
+@pytest.fixture
+def fast_switching():
+    # Switch threads very often, so the races show up in a short test
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    yield
+    sys.setswitchinterval(interval)
+
+
+@pytest.fixture
+def registry():
+    registry = StockRegistry()
+    Stock('S100', 100, registry=registry)
+    Stock('S200', 200, registry=registry)
+    return registry
+
+
+def test_registries_are_independent(registry):
+    live = Stock('S100', 100)
+    simulated = Stock('S100', registry=registry)
+    assert simulated is not live
+    assert simulated.registry is registry
+
+    simulated.update_price(150)
+    assert live.price == 100
+    assert simulated.price == 150
+
+    Stock.update_prices({'S100': 120}, registry=registry)
+    assert live.price == 100
+    assert simulated.price == 120
+    assert Stock.exists_instance('S200', registry=registry)
+    assert Stock.get_by_index(simulated.index, registry=registry) is simulated
+
+
+def test_collection_bound_to_registry(registry):
+    Stock('S100', 100)
+    collection = StockCollection(stocks_qty={'S100': 2}, registry=registry)
+    assert collection.get_value() == 200
+    assert Stock('S100') not in collection.stocks
+    assert Stock('S100', registry=registry) in collection.stocks
+
+    with pytest.raises(ValueError):
+        collection.modify_stock_qty(Stock('S100'), 1)
+
+    with pytest.raises(ValueError):
+        registry.update_prices({Stock('S100'): 10})
+
+
+def test_portfolio_bound_to_registry(registry):
+    Stock('S100', 100)
+    portfolio = Portfolio(name='Simulated',
+                          stocks_allocation={'S100': 0.5, 'S200': 0.5},
+                          total_value=1000,
+                          indexed=True,
+                          registry=registry)
+
+    Stock('S100').update_price(1)
+    assert math.isclose(portfolio.stocks_collection.get_value(), 1000)
+
+    registry.update_prices({'S100': 200})
+    assert math.isclose(portfolio.stocks_collection.get_value(), 1500)
+    portfolio.rebalance()
+    assert math.isclose(portfolio.get_allocation_drift(), 0, abs_tol=1e-9)
+
+
+def test_batch_tools_use_the_registry(registry):
+    # The default registry has other stocks with the same indexes
+    Stock('AAA', 1)
+    Stock('BBB', 2)
+    portfolio = Portfolio('P', {'S100': 0.5, 'S200': 0.5}, 1000,
+                          registry=registry)
+    portfolio.set_allocation_target({'S100': 1})
+    expected = portfolio.get_stocks_qty_deviation()
+    s100 = Stock('S100', registry=registry)
+
+    book = PortfolioBook([portfolio], registry=registry)
+    assert np.allclose(book.get_values(), [1000])
+    assert book.get_stocks_qty_deviation(0) == pytest.approx(expected)
+    assert book.get_portfolio(0).registry is registry
+
+    deviations = get_deviations_in_parallel([portfolio], workers=1,
+                                            registry=registry)
+    assert deviations[0] == pytest.approx(expected)
+
+    netting = OrderNetting([portfolio], registry=registry)
+    assert netting.get_orders() == pytest.approx(expected)
+    netting.apply_fills()
+    assert math.isclose(portfolio.stocks_collection.stocks[s100], 10)
+
+    # The default registry is used when none is given
+    with pytest.raises(ValueError):
+        PortfolioBook([portfolio])
+    with pytest.raises(ValueError):
+        get_deviations_in_parallel([portfolio], workers=1)
+    with pytest.raises(ValueError):
+        OrderNetting([portfolio])
+
+
+def test_concurrent_creation():
+    registry = StockRegistry()
+    stocks = []
+
+    def create():
+        stocks.append(Stock('RACE', 10, registry=registry))
+
+    threads = [threading.Thread(target=create) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(registry) == 1
+    assert all(stock is stocks[0] for stock in stocks)
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_readers_never_see_partial_batches(indexed, fast_switching):
+    '''
+    The writer always sets every price to the same value, so a reader that
+    sees two different prices read half of a batch.
+    '''
+    registry = StockRegistry()
+    stocks = [Stock(f'B{i}', 1, registry=registry) for i in range(1000)]
+    collection = StockCollection(
+        stocks_qty={stock.symbol: 1 for stock in stocks}, indexed=indexed,
+        registry=registry)
+    indexes = np.array([stock.index for stock in stocks])
+    stop = threading.Event()
+    torn = []
+
+    def read():
+        while not stop.is_set():
+            prices = registry._book.gather(indexes)
+            if prices.min() != prices.max():
+                torn.append(prices)
+            value = collection.get_value()
+            if value % len(stocks) != 0:
+                torn.append(value)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for price in range(2, 300):
+        registry.update_prices((indexes, np.full(len(indexes), price)))
+    stop.set()
+    for reader in readers:
+        reader.join()
+
+    assert torn == []
+    assert collection.get_value() == 299 * len(stocks)
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_concurrent_trades_and_prices(indexed, fast_switching):
+    '''
+    One thread trades while another one updates the prices. The running
+    total must match the value computed from scratch at the end.
+    '''
+    registry = StockRegistry()
+    stocks = [Stock(f'C{i}', 10, registry=registry) for i in range(100)]
+    collection = StockCollection(
+        stocks_qty={stock.symbol: 100 for stock in stocks}, indexed=indexed,
+        registry=registry)
+    indexes = np.array([stock.index for stock in stocks])
+
+    def trade():
+        for indx in range(5000):
+            collection.modify_stock_qty(stocks[indx % len(stocks)], 1)
+            collection.get_value()
+
+    trader = threading.Thread(target=trade)
+    trader.start()
+    generator = np.random.default_rng(0)
+    while trader.is_alive():
+        registry.update_prices(
+            (indexes, generator.uniform(1, 20, len(indexes))))
+    trader.join()
+
+    assert collection.get_value() == pytest.approx(
+        collection._compute_value())
+
+
+def test_pinned_prices_do_not_change(registry):
+    snapshot = registry.pin()
+    assert registry.pin() is snapshot
+
+    registry.update_prices({'S100': 150})
+    assert snapshot.get('S100') == 100
+    assert registry.pin() is not snapshot
+    assert registry.pin().get('S100') == 150
+
+    with pytest.raises(ValueError):
+        snapshot.prices[0] = 1
+
+    # A snapshot can only value collections of its registry
+    Stock('S100', 100)
+    with pytest.raises(ValueError):
+        StockCollection(stocks_qty={'S100': 1}).get_value(snapshot)
+
+
+def test_collection_value_with_snapshot(registry):
+    collection = StockCollection(stocks_qty={'S100': 1, 'S200': 1},
+                                 registry=registry)
+    snapshot = registry.pin()
+    registry.update_prices({'S100': 300})
+
+    assert collection.get_value(snapshot) == 300
+    assert collection.get_value() == 500
+    allocation = collection.get_allocation(snapshot)
+    assert math.isclose(allocation[Stock('S100', registry=registry)], 1/3)
+
+
+def test_portfolio_rebalance_with_snapshot(registry):
+    portfolio = Portfolio(name='Pinned',
+                          stocks_allocation={'S100': 0.5, 'S200': 0.5},
+                          total_value=1000,
+                          registry=registry)
+    snapshot = registry.pin()
+    registry.update_prices({'S100': 200})
+
+    # With the prices of the snapshot the portfolio is balanced
+    deviation = portfolio.get_stocks_qty_deviation(snapshot)
+    assert all(math.isclose(qty, 0, abs_tol=1e-9)
+               for qty in deviation.values())
+    assert math.isclose(portfolio.get_allocation_drift(snapshot), 0,
+                        abs_tol=1e-9)
+
+    portfolio.rebalance()
+    assert math.isclose(portfolio.get_allocation_drift(), 0, abs_tol=1e-9)
+    assert portfolio.get_allocation_drift(snapshot) > 0
@@ -0,0 +1,153 @@
+'''
+This test file is for testing the RebalanceScheduler class and the allocation
+drift of the portfolios.
+'''
+
+import pytest
+import math
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.scheduler import RebalanceScheduler
+
+
+@pytest.fixture
+def portfolios():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+
+    portfolios = []
+    for indx in range(20):
+        portfolio = Portfolio(
+            name=f'Portfolio {indx}',
+            stocks_allocation={'S100': 0.5, 'S200': 0.5},
+            total_value=1000)
+        drift = indx / 100
+        portfolio.set_allocation_target({'S100': 0.5 - drift,
+                                         'S200': 0.5 + drift})
+        portfolios.append(portfolio)
+
+    return portfolios
+
+
+def test_allocation_drift(portfolios):
+    assert math.isclose(portfolios[5].get_allocation_drift(), 0.05)
+
+    portfolios[5].set_allocation_target({'S300': 1})
+    assert math.isclose(portfolios[5].get_allocation_drift(), 1)
+
+    portfolios[5].rebalance()
+    assert math.isclose(portfolios[5].get_allocation_drift(), 0,
+                        abs_tol=1e-9)
+
+
+def test_scheduler_queries(portfolios):
+    scheduler = RebalanceScheduler(portfolios)
+    assert len(scheduler) == 20
+
+    over_threshold = scheduler.get_over_threshold(0.145)
+    assert set(over_threshold) == set(portfolios[15:])
+
+    top = scheduler.get_top(3)
+    assert [portfolio for portfolio, _ in top] == portfolios[:16:-1]
+    assert math.isclose(top[0][1], 0.19)
+
+
+def test_scheduler_updates(portfolios):
+    scheduler = RebalanceScheduler(portfolios)
+
+    portfolios[19].rebalance()
+    portfolios[0].set_allocation_target({'S300': 1})
+    scheduler.refresh()
+
+    assert math.isclose(scheduler.get_drift(portfolios[19]), 0,
+                        abs_tol=1e-9)
+    assert scheduler.get_top(1)[0][0] is portfolios[0]
+
+    scheduler.remove(portfolios[0])
+    assert portfolios[0] not in scheduler
+    assert scheduler.get_top(1)[0][0] is portfolios[18]
+
+    with pytest.raises(ValueError):
+        scheduler.remove(portfolios[0])
+
+
+def test_scheduler_queries_refresh(portfolios):
+    scheduler = RebalanceScheduler(portfolios)
+
+    # No explicit refresh: the queries see the changes
+    portfolios[19].rebalance()
+    portfolios[0].set_allocation_target({'S300': 1})
+    assert scheduler.get_top(1)[0][0] is portfolios[0]
+    assert portfolios[19] not in scheduler.get_over_threshold(0.145)
+    assert math.isclose(scheduler.get_drift(portfolios[19]), 0,
+                        abs_tol=1e-9)
+
+    Stock.update_prices({'S200': 400})
+    expected = [portfolio for portfolio in portfolios
+                if portfolio.get_allocation_drift() > 0.1]
+    assert len(expected) > 2
+    assert set(scheduler.get_over_threshold(0.1)) == set(expected)
+
+
+def test_scheduler_refresh_is_incremental(portfolios, monkeypatch):
+    scheduler = RebalanceScheduler(portfolios)
+
+    refreshed = []
+    get_allocation_drift = Portfolio.get_allocation_drift
+
+    def counting_drift(portfolio, *args, **kwargs):
+        refreshed.append(portfolio)
+        return get_allocation_drift(portfolio, *args, **kwargs)
+
+    monkeypatch.setattr(Portfolio, 'get_allocation_drift', counting_drift)
+
+    # Only the portfolio that traded is visited
+    portfolios[19].rebalance()
+    scheduler.refresh()
+    assert refreshed == [portfolios[19]]
+    assert math.isclose(scheduler.get_drift(portfolios[19]), 0,
+                        abs_tol=1e-9)
+
+    # Only the portfolios with the stock are affected by its price
+    refreshed.clear()
+    portfolios[3].set_allocation_target({'S100': 0.5, 'S300': 0.5})
+    Stock('S300').update_price(310)
+    scheduler.refresh()
+    assert refreshed == [portfolios[3]]
+    scheduler.refresh()
+    assert refreshed == [portfolios[3]]
+
+    refreshed.clear()
+    Stock('S100').update_price(110)
+    scheduler.refresh()
+    assert set(refreshed) == set(portfolios)
+
+    # The scheduler stops watching the stocks of the removed portfolios
+    holders = Stock.default_registry._holders
+    assert scheduler in holders.get_holders(Stock('S300').index)
+    scheduler.remove(portfolios[3])
+    assert scheduler not in holders.get_holders(Stock('S300').index)
+    assert portfolios[3].stocks_collection._observers is None
+
+    refreshed.clear()
+    Stock('S300').update_price(320)
+    portfolios[3].rebalance()
+    scheduler.refresh()
+    assert refreshed == []
+
+
+def test_scheduler_registry(portfolios):
+    registry = StockRegistry()
+    Stock('S100', 100, registry=registry)
+    portfolio = Portfolio(name='Other',
+                          stocks_allocation={'S100': 1},
+                          total_value=1000,
+                          registry=registry)
+    scheduler = RebalanceScheduler([portfolio], registry=registry)
+    assert portfolio in scheduler
+
+    with pytest.raises(ValueError):
+        RebalanceScheduler([portfolio])
+    with pytest.raises(ValueError):
+        scheduler.add(portfolios[0])
@@ -0,0 +1,129 @@
+'''
+This test file is for testing the asyncio layer. The price feed is a local
+server started in the same event loop.
+'''
+
+import asyncio
+import math
+import pytest
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.service import PriceFeed, PortfolioService, parse_tick
+
+
+@pytest.fixture
+def registry():
+    registry = StockRegistry()
+    Stock('S100', 100, registry=registry)
+    Stock('S200', 200, registry=registry)
+    return registry
+
+
+@pytest.fixture
+def service(registry):
+    service = PortfolioService(registry=registry, chunk_size=10)
+    for i in range(100):
+        service.add_portfolio(Portfolio(
+            name=f'P{i}',
+            stocks_allocation={'S100': 0.5, 'S200': 0.5},
+            total_value=1000,
+            registry=registry))
+    return service
+
+
+async def start_feed_server(lines: list[bytes]):
+    '''
+    This function starts a feed server that sends the lines to every client
+    and closes the connection.
+    '''
+    async def handle(reader, writer):
+        for line in lines:
+            writer.write(line)
+            await writer.drain()
+            await asyncio.sleep(0)
+        writer.close()
+        await writer.wait_closed()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, port
+
+
+def test_parse_tick():
+    assert parse_tick(b'S100 101.5 3\n') == ('S100', 101.5, 3.0)
+    assert parse_tick(b'S100 abc 3') is None
+    assert parse_tick(b'S100 101') is None
+
+
+def test_price_feed(registry):
+    lines = [b'S100 101 0\nS200 2', b'01 0\n', b'S100 102 1\nbad line\n',
+             b'UNKNOWN 5 1\nS100 103 5']
+
+    async def run():
+        server, port = await start_feed_server(lines)
+        async with server:
+            feed = PriceFeed(registry=registry, window=2)
+            await feed.connect('127.0.0.1', port)
+        return feed
+
+    feed = asyncio.run(run())
+    assert feed.ticks == 5
+    assert feed.skipped == 1
+    assert Stock('S100', registry=registry).price == 103
+    assert Stock('S200', registry=registry).price == 201
+
+
+def test_service_queries(service, registry):
+    async def run():
+        values = await service.get_values()
+        deviation = await service.get_deviation('P0')
+        registry.update_prices({'S100': 200})
+        await service.rebalance('P1')
+        await service.rebalance_all(['P2', 'P3'])
+        return values, deviation, await service.get_value('P1')
+
+    values, deviation, value = asyncio.run(run())
+    assert len(values) == 100
+    assert all(math.isclose(v, 1000) for v in values.values())
+    assert all(math.isclose(qty, 0, abs_tol=1e-9)
+               for qty in deviation.values())
+    assert math.isclose(value, 1500)
+    for name in ('P1', 'P2', 'P3'):
+        drift = service.portfolios[name].get_allocation_drift()
+        assert math.isclose(drift, 0, abs_tol=1e-9)
+
+    with pytest.raises(ValueError):
+        asyncio.run(service.get_value('missing'))
+    with pytest.raises(ValueError):
+        service.add_portfolio(Portfolio(
+            name='Other', stocks_allocation={'S100': 1}, total_value=100))
+
+
+def test_queries_while_ticks_stream(service, registry):
+    '''
+    Thousands of queries run in the same event loop as the feed. A query on
+    many portfolios uses one version of the prices, so all its values are
+    equal even when ticks arrive while it yields.
+    '''
+    lines = [f'S100 {100 + i} {i}\n'.encode() for i in range(200)]
+
+    async def query(i):
+        if i % 100 == 0:
+            values = await service.get_values()
+            return len(set(values.values())) == 1
+        await service.get_value(f'P{i % 100}')
+        return True
+
+    async def run():
+        server, port = await start_feed_server(lines)
+        async with server:
+            feed = PriceFeed(registry=registry, window=1)
+            results = await asyncio.gather(
+                feed.connect('127.0.0.1', port),
+                *(query(i) for i in range(2000)))
+        return feed, results
+
+    feed, results = asyncio.run(run())
+    assert all(results[1:])
+    assert feed.ticks == 200
+    assert Stock('S100', registry=registry).price == 299
@@ -0,0 +1,113 @@
+'''
+This test file is for testing the binary price snapshots.
+'''
+
+import pytest
+import numpy as np
+from src.stocks import Stock, StockRegistry
+from src.snapshot import PriceSnapshot, write_snapshot, convert_yaml
+from src.snapshot import write_registry_snapshot, HEADER
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'prices.snap')
+    write_snapshot(path, ['AAA', 'BONO EN UF 2030', 'ÑÑ'], [1.5, 2, 3])
+
+    snapshot = PriceSnapshot(path)
+    assert len(snapshot) == 3
+    assert snapshot.symbols == ['AAA', 'BONO EN UF 2030', 'ÑÑ']
+    assert np.array_equal(snapshot.prices, [1.5, 2, 3])
+
+    # The prices are a read-only view of the file
+    with pytest.raises(ValueError):
+        snapshot.prices[0] = 10
+    snapshot.close()
+
+
+def test_snapshot_close_with_views(tmp_path):
+    path = str(tmp_path / 'prices.snap')
+    write_snapshot(path, ['AAA', 'BBB'], [1.5, 2])
+
+    snapshot = PriceSnapshot(path)
+    prices = snapshot.prices
+    top = prices[1:]
+    snapshot.close()
+    snapshot.close()
+
+    # The views held by the caller are still valid after closing
+    assert snapshot.prices is None
+    assert np.array_equal(prices, [1.5, 2])
+    assert top[0] == 2
+    del prices, top
+
+
+def test_snapshot_invalid_files(tmp_path):
+    path = tmp_path / 'prices.snap'
+    with pytest.raises(ValueError):
+        write_snapshot(str(path), ['AAA'], [-1])
+    assert not path.exists()
+
+    path.write_bytes(b'not a snapshot file, just some bytes')
+    with pytest.raises(ValueError):
+        PriceSnapshot(str(path))
+
+    write_snapshot(str(path), ['AAA'], [1])
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        PriceSnapshot(str(path))
+
+
+def test_snapshot_invalid_prices(tmp_path):
+    # A file written by another tool, with a NaN and a negative price
+    path = tmp_path / 'prices.snap'
+    write_snapshot(str(path), ['NEWX', 'NEWY'], [1, 2])
+    data = bytearray(path.read_bytes())
+    data[HEADER.size:HEADER.size + 16] = \
+        np.array([np.nan, -5], dtype='<f8').tobytes()
+    path.write_bytes(bytes(data))
+
+    registry = StockRegistry()
+    with pytest.raises(ValueError):
+        PriceSnapshot(str(path)).load_into_registry(registry)
+    assert not registry.exists_instance('NEWX')
+    assert not registry.exists_instance('NEWY')
+
+
+def test_convert_yaml_and_load(tmp_path):
+    stocks_file = tmp_path / 'stocks.yaml'
+    stocks_file.write_text('snap1: 10\nSNAP2: 20\n')
+    path = str(tmp_path / 'prices.snap')
+
+    Stock('SNAP1', 5)
+    convert_yaml(str(stocks_file), path)
+    snapshot = PriceSnapshot(path)
+    assert snapshot.to_dict() == {'SNAP1': 10, 'SNAP2': 20}
+
+    snapshot.load_into_registry()
+    assert Stock('SNAP1').price == 10
+    assert Stock('SNAP2').price == 20
+    snapshot.close()
+
+    write_registry_snapshot(path)
+    snapshot = PriceSnapshot(path)
+    assert snapshot.to_dict()['SNAP2'] == 20
+    assert len(snapshot) == len(Stock._book)
+    snapshot.close()
+
+
+def test_snapshot_of_registry(tmp_path):
+    path = str(tmp_path / 'prices.snap')
+    registry = StockRegistry()
+    Stock('REG1', 5, registry=registry)
+    Stock('REG2', 7, registry=registry)
+    write_registry_snapshot(path, registry)
+
+    snapshot = PriceSnapshot(path)
+    assert snapshot.to_dict() == {'REG1': 5, 'REG2': 7}
+    other = StockRegistry()
+    Stock('REG2', 1, registry=other)
+    snapshot.load_into_registry(other)
+    snapshot.close()
+    assert Stock('REG1', registry=other).price == 5
+    assert Stock('REG2', registry=other).price == 7
+    assert not Stock.exists_instance('REG1')
@@ -0,0 +1,124 @@
+'''
+This test file is for testing the SparseBook class. The results of the book
+are compared with the results of the Portfolio and PortfolioBook classes.
+'''
+
+import pytest
+import math
+import numpy as np
+from src.stocks import Stock, StockRegistry
+from src.portfolio import Portfolio
+from src.book import PortfolioBook
+from src.sparse import CSRMatrix, SparseBook
+
+
+@pytest.fixture
+def portfolios():
+    Stock(symbol='S100', price=100)
+    Stock(symbol='S200', price=200)
+    Stock(symbol='S300', price=300)
+
+    portfolio_1 = Portfolio(
+        name='Portfolio 1',
+        stocks_allocation={'S100': 0.5, 'S200': 0.5},
+        total_value=1000)
+    portfolio_1.set_allocation_target({'S200': 0.25, 'S300': 0.75})
+
+    portfolio_2 = Portfolio(
+        name='Portfolio 2',
+        stocks_allocation={'S100': 0.2, 'S200': 0.3, 'S300': 0.5},
+        total_value=3000)
+    portfolio_2.set_allocation_target({'S100': 1})
+
+    return [portfolio_1, portfolio_2]
+
+
+def test_csr_matrix():
+    matrix = CSRMatrix.from_coo([1, 0, 1, 1], [5, 2, 0, 5], [1, 2, 3, 4], 3)
+    assert np.array_equal(matrix.indptr, [0, 1, 3, 3])
+    assert np.array_equal(matrix.indices, [2, 0, 5])
+    assert np.array_equal(matrix.data, [2, 3, 5])
+    assert np.array_equal(matrix.to_dense(6),
+                          [[0, 0, 2, 0, 0, 0],
+                           [3, 0, 0, 0, 0, 5],
+                           [0, 0, 0, 0, 0, 0]])
+    assert np.array_equal(matrix.dot(np.arange(6.0)), [4, 25, 0])
+
+    stacked = matrix.vstack(matrix)
+    assert len(stacked) == 6
+    assert np.array_equal(stacked.to_dense(6)[3:], matrix.to_dense(6))
+
+
+def test_sparse_book_values_and_deviation(portfolios):
+    book = SparseBook(portfolios)
+
+    assert len(book) == 2
+    assert book.holdings.nnz == 5
+    assert np.allclose(book.get_values(), [1000, 3000])
+
+    for row, portfolio in enumerate(portfolios):
+        deviation = portfolio.get_stocks_qty_deviation()
+        book_deviation = book.get_stocks_qty_deviation(row)
+        assert deviation.keys() == book_deviation.keys()
+        for stock, qty in deviation.items():
+            assert math.isclose(book_deviation[stock], qty)
+
+    rows, columns, quantities = book.get_trades()
+    dense_rows, dense_columns, dense_quantities = \
+        PortfolioBook(portfolios).get_trades()
+    assert np.array_equal(rows, dense_rows)
+    assert np.array_equal(columns, dense_columns)
+    assert np.allclose(quantities, dense_quantities)
+
+
+def test_sparse_book_exposures(portfolios):
+    book = SparseBook(portfolios)
+
+    exposures = book.get_exposures()
+    assert exposures[Stock('S100')] == pytest.approx(500 + 600)
+    assert exposures[Stock('S300')] == pytest.approx(1500)
+
+    targets = book.get_exposures(target=True)
+    assert targets == pytest.approx({Stock('S100'): 3000,
+                                     Stock('S200'): 250,
+                                     Stock('S300'): 750})
+
+
+def test_sparse_book_rebalance_and_round_trip(portfolios):
+    book = SparseBook(portfolios)
+    book.rebalance()
+
+    for row, portfolio in enumerate(portfolios):
+        portfolio.rebalance()
+        recovered = book.get_portfolio(row)
+        assert recovered.name == portfolio.name
+        assert recovered.stocks_collection == portfolio.stocks_collection
+        assert recovered.allocation_target == {
+            Stock(symbol): weight for symbol, weight
+            in portfolio.allocation_target.items()}
+        assert book.holdings.get_collection(row) == \
+            portfolio.stocks_collection
+
+    assert np.allclose(SparseBook(book.get_portfolios()).get_values(),
+                       [1000, 3000])
+
+
+def test_sparse_book_registry():
+    registry = StockRegistry()
+    for i in range(1000):
+        Stock(f'S{i}', 10 + i, registry=registry)
+    portfolio = Portfolio(name='P',
+                          stocks_allocation={'S999': 0.5, 'S3': 0.5},
+                          total_value=1000,
+                          registry=registry)
+    book = SparseBook([portfolio], registry=registry)
+    assert book.holdings.nnz == 2
+    assert np.allclose(book.get_values(), [1000])
+
+    snapshot = registry.pin()
+    Stock('S3', registry=registry).update_price(26)
+    assert np.allclose(book.get_values(snapshot), [1000])
+    assert np.allclose(book.get_values(), [1500])
+
+    with pytest.raises(ValueError):
+        SparseBook([portfolio])
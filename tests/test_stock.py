@@ -4,6 +4,7 @@ and main capabilities.
 '''
 
 import pytest
+import numpy as np
 from src.stocks import Stock
 
 
@@ -63,3 +64,40 @@ def test_stock_singleton_different_symbols():
     assert stock2.price == 155
     assert stock1.symbol == "AAPL"
     assert stock2.symbol == "GOOGL"
+
+
+def test_stock_update_prices_mapping():
+    stock1 = Stock("AAPL", 150)
+    stock2 = Stock("GOOGL", 155)
+    Stock.update_prices({"aapl": 160, stock2: 165})
+    assert stock1.price == 160
+    assert stock2.price == 165
+
+
+def test_stock_update_prices_arrays():
+    stock1 = Stock("AAPL", 150)
+    stock2 = Stock("GOOGL", 155)
+    Stock.update_prices(
+        (np.array([stock1.index, stock2.index]), np.array([170., 175.])))
+    assert stock1.price == 170
+    assert stock2.price == 175
+
+    Stock.update_prices((["AAPL", "GOOGL"], [180, 185]))
+    assert stock1.price == 180
+    assert stock2.price == 185
+
+
+def test_stock_update_prices_invalid_batch():
+    stock1 = Stock("AAPL", 150)
+    stock2 = Stock("GOOGL", 155)
+
+    # The batch is rejected as a whole, no price is updated
+    with pytest.raises(ValueError):
+        Stock.update_prices({"AAPL": 160, "GOOGL": -1})
+    with pytest.raises(ValueError):
+        Stock.update_prices({"AAPL": 160, "NOT_A_STOCK": 1})
+    with pytest.raises(ValueError):
+        Stock.update_prices((["AAPL", "GOOGL"], [160]))
+
+    assert stock1.price == 150
+    assert stock2.price == 155
@@ -111,3 +111,138 @@ def test_modify_stock_qty(stock_singleton):
 
     with pytest.raises(ValueError):
         stock_collection.modify_stock_qty(Stock('S100'), -10)
+
+
+def test_holdings_dict_interface(stock_singleton):
+    stock_collection = StockCollection(stocks_qty={'S100': 1,
+                                                   'S200': 2,
+                                                   'S300': 3})
+    stock_collection.delete_stock(Stock('S100'))
+
+    assert dict(stock_collection.stocks) == {Stock('S300'): 3,
+                                             Stock('S200'): 2}
+    assert Stock('S100') not in stock_collection.stocks
+
+    stock_collection.stocks[Stock('S100')] = 4
+    assert stock_collection.stocks[Stock('S100')] == 4
+    assert math.isclose(stock_collection.get_value(), 1700)
+
+
+def test_get_allocation(stock_singleton):
+    stock_collection = StockCollection(stocks_qty={'S100': 3,
+                                                   'S300': 1})
+    allocation = stock_collection.get_allocation()
+
+    assert math.isclose(allocation[Stock('S100')], 0.5)
+    assert math.isclose(allocation[Stock('S300')], 0.5)
+
+    Stock('S300').update_price(100)
+    allocation = stock_collection.get_allocation()
+    assert math.isclose(allocation[Stock('S300')], 0.25)
+    Stock('S300').update_price(300)
+
+
+def test_running_total_value(stock_singleton):
+    StockCollection.debug = True
+    try:
+        stock_collection = StockCollection(stocks_qty={'S100': 1,
+                                                       'S200': 1})
+        stock_collection.modify_stock_qty(Stock('S300'), 2)
+        stock_collection.set_stock_qty('S100', 3)
+        stock_collection.delete_stock(Stock('S200'))
+        assert math.isclose(stock_collection.get_value(), 900)
+
+        # A price change marks the running total as outdated
+        Stock('S300').update_price(400)
+        assert math.isclose(stock_collection.get_value(), 1100)
+        Stock('S300').update_price(300)
+        assert math.isclose(stock_collection.get_value(), 900)
+    finally:
+        StockCollection.debug = False
+
+
+def test_running_total_value_debug_check(stock_singleton):
+    stock_collection = StockCollection(stocks_qty={'S100': 1})
+    stock_collection.get_value()
+    stock_collection._total_value = 50
+
+    StockCollection.debug = True
+    try:
+        with pytest.raises(RuntimeError):
+            stock_collection.get_value()
+    finally:
+        StockCollection.debug = False
+
+
+def test_indexed_collection(stock_singleton):
+    StockCollection.debug = True
+    try:
+        stock_collection = StockCollection(stocks_qty={'S100': 1,
+                                                       'S200': 2},
+                                           indexed=True)
+        holders = Stock._holders.get_holders(Stock('S100').index)
+        assert any(holder is stock_collection for holder in holders)
+
+        # Only the price changes of its own stocks affect the collection
+        Stock('S300').update_price(400)
+        assert stock_collection.price_changes == 0
+        Stock.update_prices({'S100': 150, 'S300': 300})
+        assert stock_collection.price_changes == 1
+        assert math.isclose(stock_collection.get_value(), 550)
+
+        stock_collection.delete_stock(Stock('S100'))
+        holders = Stock._holders.get_holders(Stock('S100').index)
+        assert not any(holder is stock_collection for holder in holders)
+        Stock('S100').update_price(100)
+        assert math.isclose(stock_collection.get_value(), 400)
+    finally:
+        StockCollection.debug = False
+
+
+def test_indexed_collection_weak_reference(stock_singleton):
+    stock_collection = StockCollection(stocks_qty={'S300': 1},
+                                       indexed=True)
+    holders_count = len(Stock._holders.get_holders(Stock('S300').index))
+
+    del stock_collection
+    assert len(Stock._holders.get_holders(Stock('S300').index)) == \
+        holders_count - 1
+
+
+def test_modify_stocks_qty(stock_singleton):
+    stock_collection = StockCollection(stocks_qty={'S100': 1,
+                                                   'S200': 1})
+    stock_collection.modify_stocks_qty({Stock('S100'): 2,
+                                        Stock('S200'): -1,
+                                        Stock('S300'): 1})
+    assert stock_collection.stocks[Stock('S100')] == 3
+    assert Stock('S200') not in stock_collection.get_stocks_set()
+    assert stock_collection.stocks[Stock('S300')] == 1
+
+    # The changes are applied completely or not at all
+    with pytest.raises(ValueError):
+        stock_collection.modify_stocks_qty({Stock('S100'): 1,
+                                            Stock('S300'): -2})
+    assert stock_collection.stocks[Stock('S100')] == 3
+
+
+def test_compact_storage(stock_singleton):
+    '''
+    The stocks and the collections have no __dict__, and the rows of a
+    collection are kept sorted by stock index whatever the insertion order.
+    '''
+    stock = Stock('S100')
+    assert not hasattr(stock, '__dict__')
+
+    collection = StockCollection()
+    for symbol in ['S300', 'S100', 'S200']:
+        collection.set_stock_qty(symbol, 1)
+    assert not hasattr(collection, '__dict__')
+
+    indexes = collection._price_idx[:collection._size].tolist()
+    assert indexes == sorted(indexes)
+    assert collection.stocks[Stock('S200')] == 1
+
+    collection.delete_stock(Stock('S100'))
+    assert Stock('S100') not in collection.stocks
+    assert collection.get_value() == 500
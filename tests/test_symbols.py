@@ -0,0 +1,52 @@
+'''
+This test file is for testing the SymbolTable class and the dense stock ids
+used by the Stock class and the collections.
+'''
+
+import pytest
+from src.symbols import SymbolTable
+from src.stocks import Stock, StockCollection
+
+
+def test_symbol_table_intern():
+    table = SymbolTable()
+    assert table.intern('aapl') == 0
+    assert table.intern('MSFT') == 1
+    assert table.intern('Aapl') == 0
+    assert len(table) == 2
+    assert table.get_symbol(0) == 'AAPL'
+
+
+def test_symbol_table_get_id():
+    table = SymbolTable()
+    table.intern('AAPL')
+    assert table.get_id('aapl') == 0
+    assert table.get_id('GOOG') is None
+    with pytest.raises(ValueError):
+        table.get_id(12)
+
+
+def test_stock_ids_match_book_indexes():
+    stock = Stock('idtest', 10)
+    assert Stock._symbols.get_id('IDTEST') == stock.index
+    assert Stock.get_by_index(stock.index) is stock
+    assert Stock('IdTest') is stock
+    assert stock.symbol == 'IDTEST'
+
+
+def test_collection_rows_by_id():
+    stock_1 = Stock('IDTEST1', 10)
+    stock_2 = Stock('IDTEST2', 20)
+    collection = StockCollection()
+    collection.set_stock_qty('idtest1', 2)
+    collection.set_stock_qty('IDTEST2', 1)
+
+    assert collection._price_idx[:collection._size].tolist() == \
+        sorted([stock_1.index, stock_2.index])
+    assert collection.stocks[stock_1] == 2
+    assert 'IDTEST1' not in collection.stocks
+    assert collection.get_value() == 40
+
+    collection.delete_stock(stock_1)
+    assert stock_1 not in collection.stocks
+    assert collection._pop_changes() == {stock_1.index, stock_2.index}